@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+asyncpex -- drive many pexpect sessions from one thread
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+A small event loop in the style of asyncio (which python 2 doesn't have).
+The loop polls the pty of every session it was given with add_reader(), and
+expect() returns a Future instead of blocking, so dozens of remote commands
+can be waited on at once without a thread per session.
+
+Tasks are generators that yield Futures (or lists of them) and get the
+result back from the yield, raise Return(value) to return a value:
+
+    def build(loop, ses, cmd):
+        aio = asyncpex.AsyncCli(loop, ses)
+        try:
+            rval = yield aio.docmd(cmd, [ses.session.PROMPT], timeout=600)
+        finally:
+            aio.detach()
+        raise asyncpex.Return(rval)
+
+    loop = asyncpex.EventLoop()
+    results = loop.run_until_complete(asyncpex.gather(loop,
+                    *[loop.create_task(build(loop, s, c)) for s, c in work]))
+'''
+import sys
+import time
+import heapq
+import select
+import types
+import logging
+import pexpect
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-28'
+__updated__ = '2014-08-28'
+
+log = logging.getLogger('env-o-matic (%s)' % __name__)
+
+# Specialized Exceptions
+class ASYNCPEX_StateError(RuntimeError): pass
+
+
+class Return(Exception):
+    """
+    Raised by a task generator to finish with a value
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """
+    The result of something that hasn't finished yet
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise ASYNCPEX_StateError("result() of a future that isn't done")
+        if self._exc_info:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._result
+
+    def exception(self):
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        if self._done:
+            self.loop.call_soon(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc):
+        self.set_exc_info((type(exc), exc, None))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            raise ASYNCPEX_StateError("future finished twice")
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self.loop.call_soon(callback, self)
+
+
+class Task(Future):
+    """
+    Run a generator on the loop, resuming it each time the Future it
+    yielded is done.  The Task is done when the generator is.
+    """
+    def __init__(self, loop, gen):
+        Future.__init__(self, loop)
+        self.gen = gen
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info:
+                fut = self.gen.throw(*exc_info)
+            else:
+                fut = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return, r:
+            self.set_result(r.value)
+        except BaseException:
+            self.set_exc_info(sys.exc_info())
+        else:
+            if isinstance(fut, (list, tuple)):
+                fut = gather(self.loop, *fut)
+            if not isinstance(fut, Future):
+                self.loop.call_soon(self._step, None,
+                    (ASYNCPEX_StateError,
+                     ASYNCPEX_StateError("task yielded %r, not a future" % (fut,)),
+                     None))
+                return
+            fut.add_done_callback(self._wakeup)
+
+    def _wakeup(self, fut):
+        if fut._exc_info:
+            self._step(None, fut._exc_info)
+        else:
+            self._step(fut._result, None)
+
+
+class Timer(object):
+    """
+    Handle for a call_later() callback, cancel() stops it from running
+    """
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    Single threaded loop of fd readers, timers and callbacks
+    """
+    def __init__(self):
+        self._readers = {}
+        self._ready = []
+        self._timers = []
+        self._seq = 0
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        self._seq += 1
+        heapq.heappush(self._timers, (timer.when, self._seq, timer))
+        return timer
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        return self._readers.pop(fd, None) is not None
+
+    def create_task(self, gen):
+        return Task(self, gen)
+
+    def run_until_complete(self, fut):
+        """
+        Run the loop until fut (a Future or a generator) is done and return
+        its result, or raise its exception
+        """
+        if isinstance(fut, types.GeneratorType):
+            fut = self.create_task(fut)
+        while not fut.done():
+            self._run_once()
+        return fut.result()
+
+    def _run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        elif self._readers:
+            timeout = None
+        else:
+            raise ASYNCPEX_StateError("nothing to wait for, the loop would"
+                                      " never finish")
+        if self._readers:
+            try:
+                rlist, _, _ = select.select(self._readers.keys(), [], [],
+                                            timeout)
+            except select.error, e:
+                if e[0] != 4:   # EINTR
+                    raise
+                rlist = []
+            for fd in rlist:
+                reader = self._readers.get(fd)
+                if reader:
+                    reader[0](*reader[1])
+        elif timeout:
+            time.sleep(timeout)
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._ready.append((timer.callback, timer.args))
+        ready, self._ready = self._ready, []
+        for callback, args in ready:
+            callback(*args)
+
+
+def gather(loop, *futures):
+    """
+    A Future for the list of results of all the futures, in order.  It
+    fails with the first exception raised by any of them.
+    """
+    outer = Future(loop)
+    results = [None] * len(futures)
+    pending = [len(futures)]
+    if not futures:
+        outer.set_result(results)
+        return outer
+
+    def collect(i, fut):
+        if outer.done():
+            return
+        if fut._exc_info:
+            outer.set_exc_info(fut._exc_info)
+            return
+        results[i] = fut._result
+        pending[0] -= 1
+        if not pending[0]:
+            outer.set_result(results)
+
+    for i, fut in enumerate(futures):
+        if isinstance(fut, types.GeneratorType):
+            fut = loop.create_task(fut)
+        fut.add_done_callback(lambda fut, i=i: collect(i, fut))
+    return outer
+
+
+def sleep(loop, delay, result=None):
+    fut = Future(loop)
+    loop.call_later(delay, fut.set_result, result)
+    return fut
+
+
+class AsyncSpawn(object):
+    """
+    Wrap a pexpect.spawn (or pxssh) so that expect() returns a Future.
+    With a capture set on the child its pty is read whenever it has output,
+    whether an expect() is waiting or not, and only the tail that a search
+    may still look at is kept in memory (as in spawn.expect_loop()).
+    Without one the pty is only read while an expect() is waiting.  Until
+    detach() is called the child must only be used through this object.
+    The usual before, after, match, match_index and before_span attributes
+    are set on the child when an expect() finishes.
+    """
+    def __init__(self, loop, child):
+        self.loop = loop
+        self.child = child
+        self._incoming = bytearray(child.buffer)
+        child.buffer = ''
+        self._pending = None
+        self._keep = None
+        self._eof = False
+        self._reading = False
+        # a sleep before each send would stall every other session
+        self._delaybeforesend = child.delaybeforesend
+        child.delaybeforesend = 0
+        if child.capture is not None:
+            self._read(True)
+
+    def _read(self, on):
+        # without a capture, output read with no expect() waiting could
+        # only pile up, leave it in the pty until one is
+        if on and not self._reading and not self._eof:
+            self.loop.add_reader(self.child.child_fd, self._on_readable)
+        elif not on and self._reading:
+            self.loop.remove_reader(self.child.child_fd)
+        self._reading = on and not self._eof
+
+    def _trim(self, keep):
+        # the capture has it all, only keep what a search may still look
+        # at and the ring
+        incoming = self._incoming
+        if keep is not None and len(incoming) > 2 * keep:
+            del incoming[:len(incoming) - keep]
+
+    def detach(self):
+        """
+        Stop reading the child and hand the unread output back to it
+        """
+        if self._pending:
+            raise ASYNCPEX_StateError("detach() with an expect() pending")
+        self._read(False)
+        self.child.buffer = str(self._incoming) + self.child.buffer
+        self._incoming = bytearray()
+        self.child.delaybeforesend = self._delaybeforesend
+
+    def send(self, s):
+        return self.child.send(s)
+
+    def sendline(self, s=''):
+        return self.child.sendline(s)
+
+    def expect(self, pattern, timeout=-1, searchwindowsize=-1, maxmatchlen=-1):
+        compiled_pattern_list = self.child.compile_pattern_list(pattern)
+        if maxmatchlen == -1:
+            maxmatchlen = self.child.maxmatchlen
+        return self._expect(pexpect.searcher_re(compiled_pattern_list,
+                                                maxmatchlen),
+                            timeout, searchwindowsize)
+
+    def expect_exact(self, pattern_list, timeout=-1, searchwindowsize=-1):
+        if (type(pattern_list) in types.StringTypes or
+                pattern_list in (pexpect.TIMEOUT, pexpect.EOF)):
+            pattern_list = [pattern_list]
+        return self._expect(pexpect.searcher_string(pattern_list),
+                            timeout, searchwindowsize)
+
+    def _expect(self, searcher, timeout, searchwindowsize):
+        if self._pending:
+            raise ASYNCPEX_StateError("expect() while another is pending")
+        child = self.child
+        if timeout == -1:
+            timeout = child.timeout
+        if searchwindowsize == -1:
+            searchwindowsize = child.searchwindowsize
+        fut = Future(self.loop)
+        timer = None
+        if timeout is not None:
+            timer = self.loop.call_later(timeout, self._on_timeout)
+        origin = None
+        self._keep = None
+        capture = child.capture
+        if capture is not None:
+            origin = max(0, capture.tell() - len(self._incoming))
+            keep = searcher.lookback
+            if searchwindowsize is not None:
+                keep = (min(keep, searchwindowsize) if keep is not None
+                        else searchwindowsize)
+            if keep is not None:
+                self._keep = max(keep, capture.ring_size)
+        self._pending = (fut, searcher, searchwindowsize, timer, origin)
+        child.searcher = searcher
+        child.before_span = None
+        self._search(len(self._incoming))
+        if self._pending:
+            if self._eof:
+                self._on_eof()
+            else:
+                self._read(True)
+        return fut
+
+    def _span(self, origin, end):
+        capture = self.child.capture
+        if capture is None:
+            return None
+        return capture.span(origin, end)
+
+    def _search(self, freshlen):
+        fut, searcher, searchwindowsize, timer, origin = self._pending
+        incoming = self._incoming
+        index = searcher.search(incoming, freshlen, searchwindowsize)
+        if index < 0:
+            self._trim(self._keep)
+            return
+        child = self.child
+        if child.capture is not None:
+            child.before_span = self._span(origin,
+                child.capture.tell() - len(incoming) + searcher.start)
+        child.before = str(incoming[:searcher.start])
+        child.after = str(incoming[searcher.start:searcher.end])
+        child.match = searcher.match
+        child.match_index = index
+        del incoming[:searcher.end]
+        self._done(fut, timer, index)
+
+    def _done(self, fut, timer, result=None, exc=None):
+        self._pending = None
+        if self.child.capture is None:
+            self._read(False)
+        if timer:
+            timer.cancel()
+        if exc is None:
+            fut.set_result(result)
+        else:
+            fut.set_exception(exc)
+
+    def _on_readable(self):
+        try:
+            data = self.child.read_nonblocking(self.child.maxread, 0)
+        except pexpect.TIMEOUT:
+            return
+        except pexpect.EOF:
+            self._read(False)
+            self._eof = True
+            if self._pending:
+                self._on_eof()
+            return
+        self._incoming.extend(data)
+        if self._pending:
+            self._search(len(data))
+        else:
+            self._trim(self.child.capture.ring_size)
+
+    def _on_eof(self):
+        fut, searcher, searchwindowsize, timer, origin = self._pending
+        child = self.child
+        if child.capture is not None:
+            child.before_span = self._span(origin, child.capture.tell())
+        child.before = str(self._incoming)
+        child.after = pexpect.EOF
+        self._incoming = bytearray()
+        if searcher.eof_index >= 0:
+            child.match = pexpect.EOF
+            child.match_index = searcher.eof_index
+            self._done(fut, timer, searcher.eof_index)
+        else:
+            child.match = None
+            child.match_index = None
+            self._done(fut, timer, exc=pexpect.EOF(
+                "End Of File (EOF) in expect().\n%s" % child))
+
+    def _on_timeout(self):
+        if not self._pending:
+            return
+        fut, searcher, searchwindowsize, timer, origin = self._pending
+        child = self.child
+        if child.capture is not None:
+            child.before_span = self._span(origin, child.capture.tell())
+        child.before = str(self._incoming)
+        child.after = pexpect.TIMEOUT
+        if searcher.timeout_index >= 0:
+            child.match = pexpect.TIMEOUT
+            child.match_index = searcher.timeout_index
+            self._done(fut, None, searcher.timeout_index)
+        else:
+            child.match = None
+            child.match_index = None
+            self._done(fut, None, exc=pexpect.TIMEOUT(
+                "Timeout exceeded in expect().\n%s" % child))
+
+
+class AsyncCli(object):
+    """
+    jiralab.CliHelper.docmd() for a session driven by an EventLoop.  The
+    CliHelper (typically leased from jiralab.SESSION_POOL) must already be
+    logged in, call detach() before using it the usual way again.
+    """
+    def __init__(self, loop, ses):
+        self.loop = loop
+        self.ses = ses
+        self.spawn = AsyncSpawn(loop, ses.session)
+
+    def detach(self):
+        self.spawn.detach()
+
+    def docmd(self, cmd, match, notimeout=False, consumeprompt=True,
+              timeout=30):
+        """
+        Same arguments and return value as CliHelper.docmd(), returns a
+        Task to yield on
+        """
+        return self.loop.create_task(self._docmd(cmd, match, notimeout,
+                                                 consumeprompt, timeout))
+
+    def _docmd(self, cmd, match, notimeout, consumeprompt, timeout):
+        ses = self.ses
+        child = ses.session
+        search_list = list(match)
+        if not search_list:
+            self.spawn.sendline(cmd)
+            yield self.spawn.expect([child.PROMPT, pexpect.TIMEOUT], 1)
+            ses.before = child.before
+            ses.after = child.after
+            ses.before_span = None
+            raise Return(1)
+        if not notimeout:
+            search_list.insert(0, pexpect.TIMEOUT)
+        self.spawn.sendline(cmd)
+        rval = yield self.spawn.expect(search_list, timeout)
+        ses.before = child.before
+        ses.after = child.after
+        ses.before_span = child.before_span
+        if consumeprompt:
+            # same as CliHelper._consume_prompt(), the prompt may already
+            # have been matched
+            yield self.spawn.expect([child.PROMPT, pexpect.TIMEOUT], 1)
+        raise Return(rval)
@@ -71,6 +71,8 @@ def main(argv=None):  # IGNORE:C0111
                                                      program_build_date)
     program_shortdesc ="dbgen -- Create Delphix and Siebel based Databases"
 
+    reg_session = None
+    reg_at_relmgt = False   # the reg session is back at its relmgt prompt
     try:
         # Setup argument parser
         parser = ArgumentParser(description=program_shortdesc,
@@ -150,23 +152,13 @@ def main(argv=None):  # IGNORE:C0111
         auth = jiralab.Auth(args)
         auth.getcred()
 
-        # Login to the reg server
-        log.info("Logging into %s" % REGSERVER)
-        reg_session = jiralab.CliHelper(REGSERVER)
-        reg_session.login(auth.user, auth.password, prompt="\$[ ]",
-                          timeout=CMD_TO)
-        if DEBUG:
-            log.debug("before: %s\nafter: %s" % (reg_session.before,
-                        reg_session.after))
+        # Login to the reg server and become relmgt, the pool multiplexes
+        # the ssh connection so this is cheap if eom is already logged in
+        reg_session = jiralab.SESSION_POOL.lease(REGSERVER, auth, log,
+                                name="dbgen", debug=DEBUG, timeout=CMD_TO)
 
-        log.info ("Becoming relmgt")
-        rval = reg_session.docmd("sudo -i -u relmgt", [reg_session.session.PROMPT],
-                                 timeout=CMD_TO)
-        if DEBUG:
-            log.debug ("Rval= %d; before: %s\nafter: %s" % (rval,
-                        reg_session.before, reg_session.after))
-
-        #login to the db server
+        #login to the db server, the session only goes back to the pool
+        #once it is back from there (reg_at_relmgt)
         log.info("Logging into DB Server : srwd00dbs015")
         rval = reg_session.docmd("ssh srwd00dbs015.stubcorp.dev",
                         ["yes", reg_session.session.PROMPT],
@@ -223,15 +215,13 @@ def main(argv=None):  # IGNORE:C0111
             log.info("%s%s\nSuccess.\n" % (reg_session.before,
                         reg_session.after))
 
-            old_db_search_space = re.search(
-                                'Found Database[ ]+(?P<odb>D(08|19|16|12|15)[DQ]E[0-9]{2})'
-                                        , reg_session.before)
-            sn_search_space = re.search(
-                                'DBNAME\:[ ]+(?P<sn>D(08|19|16|12|15)[DQ]E[0-9]{2})',
-                                        reg_session.before)
-            lp_search_space = re.search(
-                                'LISTENER_PORT\:[ ]+(?P<lp>15[0-9]{2})',
-                                        reg_session.before)
+            # search all of the output, before only has the tail of it
+            old_db_search_space = reg_session.search(
+                                'Found Database[ ]+(?P<odb>D(08|19|16|12|15)[DQ]E[0-9]{2})')
+            sn_search_space = reg_session.search(
+                                'DBNAME\:[ ]+(?P<sn>D(08|19|16|12|15)[DQ]E[0-9]{2})')
+            lp_search_space = reg_session.search(
+                                'LISTENER_PORT\:[ ]+(?P<lp>15[0-9]{2})')
            
            
             log.info("Dropping back to relmgt")
@@ -246,6 +236,7 @@ def main(argv=None):  # IGNORE:C0111
             if DEBUG:
                 log.debug ("Rval= %d; before: %s\nafter: %s" % (rval,
                             reg_session.before, reg_session.after))
+            reg_at_relmgt = (rval == 1)
 
 
             if not (sn_search_space and lp_search_space) :  # make sure we found something
@@ -367,33 +358,29 @@ def main(argv=None):  # IGNORE:C0111
                     exit(1)
 
                 if args.withsiebel:
-                    # Login to the reg server
-                    log.info("Logging into %s" % SIEBEL_DEPLOY_SERVER)
-                    siebel_session = jiralab.CliHelper(SIEBEL_DEPLOY_SERVER)
-                    siebel_session.login(auth.user, auth.password, prompt="\$[ ]",
-                                      timeout=CMD_TO)
-                    if DEBUG:
-                        log.debug("before: %s\nafter: %s" % (siebel_session.before,
-                                   siebel_session.after))
-                    log.info ("Becoming relmgt")
-                    rval = siebel_session.docmd("sudo -i -u relmgt", [siebel_session.session.PROMPT],
-                                             timeout=CMD_TO)
-                    if DEBUG:
-                        log.debug ("Rval= %d; before: %s\nafter: %s" % (rval,
-                                   siebel_session.before,siebel_session.after))
+                    # Login to the siebel deploy server and become relmgt
+                    siebel_session = jiralab.SESSION_POOL.lease(
+                                SIEBEL_DEPLOY_SERVER, auth, log,
+                                name="siebel", debug=DEBUG, timeout=CMD_TO)
 
                     siebel_service_name = service_name[0:4] + "S" + service_name[5:]
                     dbhost_fqdn = dbhost + ".stubcorp.dev"
                     siebel_conf_cmd = ( "deploy-siebel -e %s -d %s -n %s  -x -k"
                                                     % ( args.env, dbhost_fqdn, siebel_service_name))
                     log.info("Cmd: %s" % siebel_conf_cmd)
-                    rval =siebel_session.docmd(siebel_conf_cmd,[siebel_session.session.PROMPT], timeout=SIEBEL_DEP_TO)
-                    if rval == 1:
-                        log.info("%s%s\nSiebel Config Success.\n" % (siebel_session.before,
-                            siebel_session.after))
-                    if DEBUG:
-                        log.debug("Rval= %d; before: %s\nafter: %s" % (rval,
-                                   siebel_session.before,siebel_session.after))
+                    rval = None
+                    try:
+                        rval =siebel_session.docmd(siebel_conf_cmd,[siebel_session.session.PROMPT], timeout=SIEBEL_DEP_TO)
+                        if rval == 1:
+                            log.info("%s%s\nSiebel Config Success.\n" % (siebel_session.before,
+                                siebel_session.after))
+                        if DEBUG:
+                            log.debug("Rval= %d; before: %s\nafter: %s" % (rval,
+                                       siebel_session.before,siebel_session.after))
+                    finally:
+                        # a deploy-siebel that timed out is still running
+                        jiralab.SESSION_POOL.release(siebel_session,
+                                                     reusable=(rval == 1))
                
             print("Exiting.")
             exit(0)
@@ -410,6 +397,12 @@ def main(argv=None):  # IGNORE:C0111
         sys.stderr.write(indent + "  for help use --help\n")
         return 2
 
+    finally:
+        # the exits on errors can leave the session on the db server or as
+        # oracle, only a session back at its relmgt prompt is pooled
+        if reg_session is not None:
+            jiralab.SESSION_POOL.release(reg_session, reusable=reg_at_relmgt)
+
 
 if __name__ == "__main__":
     main()
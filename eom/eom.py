@@ -15,16 +15,19 @@ import errno
 import re
 from jira.client import JIRA    # http://jira-python.readthedocs.org/en/latest/
 import jiralab
+import stagesched
+import readiness
+import journal
+import metrics
 import json
+import copy
 import time
 from datetime import date
 import mylog
 import logging
 import socket
 import yaml
-import Queue
 import getpass
-import inspect
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 from argparse import REMAINDER
@@ -55,14 +58,26 @@ CTOOL_TO = 4000                  # time to wait for content tool (deprecated)
 BPM_TO = 2400                    # time to wait for BPM operations to complete
 TJOIN_TO = 60.0
 PREPOST_TO = 240
-BIGIP_TO = 900
+BIGIP_TO = 900                  # longest to wait for the BigIP pools to come up
+REIMAGE_SETTLE_TO = 300         # longest to wait for roles after a reimage
+SSH_PORT = 22                   # a re-imaged role is back once sshd answers
 SIEBEL_TO = 2400
+STAGE_WORKERS = stagesched.STAGE_WORKERS  # stages allowed to run concurrently
+BATCH_WORKERS = 4               # environments built at once in --batch mode
+# options that aren't saved in the run journal, an environment of a --batch
+# is resumed on its own
+JOURNAL_OMIT = ("password", "resume", "rem", "batch", "batch_workers")
+# options --resume takes from the command line instead of the journal
+RESUME_KEEP = ("user", "password", "logfile", "syslog", "debug",
+               "stage_workers", "resume", "eom_ini_file", "eom_profile",
+               "ignore_ini", "prom_file", "rem")
 
 ###############################################################################
 #    Workhorse functions
 ###############################################################################
 
-def assignSequence(seq):
+def assignSequence(seq, depends=(), uses=(), produces=(), rerun=False,
+                   overlap=None):
     '''
     Decorator to assign a ranking to methods defined in the Eom class so that
     we can schedule the execution of the various stages.  If you don't use this
@@ -70,9 +85,27 @@ def assignSequence(seq):
     schedule __init__, it is the Eom constructor and will be the first routine
     to be executed on start-up.   Also any "private" methods should not be
     assigned a sequence number
+    depends - names of the stages that must be complete before this one runs
+    uses    - shared resources the stage needs to itself while it runs, i.e.
+              "regsession" for stages that drive the main reg server shell
+    produces- attributes of the Eom the stage sets that later stages need,
+              (dotted names for the options, i.e. "args.deploy_success").
+              They are written to the run journal when the stage completes
+              and put back when the run is resumed
+    rerun   - run the stage again on --resume even if it completed, for
+              stages whose results can't be saved, like the login session
+    overlap - stages with the same overlap name share a --stage_workers
+              slot, they run side by side even with a single worker
+    Stages that don't depend on each other are run concurrently, the sequence
+    number orders stages that are ready at the same time.
     '''
     def do_assignment(to_func):
         to_func.seq = seq
+        to_func.depends = tuple(depends)
+        to_func.uses = tuple(uses)
+        to_func.produces = tuple(produces)
+        to_func.rerun = rerun
+        to_func.overlap = overlap
         return to_func
     return do_assignment
 
@@ -80,13 +113,23 @@ def stage_entry(log):
     """
     Code that should be executed at the entry of each stage
     """
-    log.info("eom.stgentry: stage %s ENTRY" % inspect.stack()[1][3])
+    log.info("eom.stgentry: stage %s ENTRY" % sys._getframe(1).f_code.co_name)
 
 def stage_exit(log):
     """
     Code that should be executed at the exit of each stage
     """
-    log.info("eom.stgexit: stage %s EXIT" % inspect.stack()[1][3])
+    name = sys._getframe(1).f_code.co_name
+    stage = stagesched.current_stage()
+    if stage is None:
+        log.info("eom.stgexit: stage %s EXIT" % name)
+        return
+    execs = stage.execs
+    log.info("eom.stgexit: stage %s EXIT after %.1f sec, %d command(s)"
+             " %.1f sec waiting on output, %d bytes" %
+             (name, metrics.monotonic() - stage.start_time, len(execs),
+              sum(ex["wait"] for ex in execs),
+              sum(ex["bytes"] for ex in execs)))
 
 def execute(s, cmd, debug, log, to=CMD_TO, result_set=None, dbstring=None):
     """
@@ -97,11 +140,21 @@ def execute(s, cmd, debug, log, to=CMD_TO, result_set=None, dbstring=None):
     to  -  timeout to wait for command completion
     result_set - array of tuples, (see pexpect doc)
     dbstring  -  debug string to print if debug switch is set
+    The time taken, the time spent waiting for output and the bytes read are
+    added to the figures of the stage running the command, see metrics.
     """
+    child = s.session
+    read_wait = child.read_wait
+    bytes_read = child.bytes_read
+    start = metrics.monotonic()
     if result_set:
         rval = s.docmd(cmd, result_set, timeout=to)
     else:
         rval = s.docmd(cmd,[s.session.PROMPT],timeout=to)
+    metrics.record_exec(stagesched.current_stage(), cmd,
+                        metrics.monotonic() - start,
+                        child.read_wait - read_wait,
+                        child.bytes_read - bytes_read, rval)
     if debug:
         if dbstring:
             log.debug(dbstring % rval)
@@ -117,34 +170,178 @@ def main():
     '''
     This is the main routine.
     Note that the methods in the Eom class that are decorated with
-    @assignSequence are methods that will be called and executed, in sequence,
-    based on the sequence number that is assigned to them. The methods are
-    gathered via the dir() and then only the methods that have the "seq"
-    attribute are sorted and executed in sequence
+    @assignSequence are the stages that will be called and executed. The
+    methods are gathered via the dir() and handed to the stage scheduler
+    which runs each one as soon as the stages it depends on are complete,
+    up to --stage_workers of them at a time.
+    Every stage that completes is written to the run journal, with
+    --resume the stages that completed in that run are skipped.  At the end
+    the run summary is written (and the --prom_file if asked for).
     '''
     try:  # Catch keyboard interrupts (^C)
-        eom = Eom()
-        functions = sorted(
-                     #get a list of fields that have the sequence
-                     [getattr(eom, field) for field in dir(eom)
-                      if hasattr(getattr(eom, field), "seq")
-                     ],
-                     #sort them by their sequence
-                     key = (lambda field: field.seq)
-                    )
-        for func in functions:
-            func()
+        start_ctx = eom_startup()
+        if start_ctx.args.batch:
+            sys.exit(batch_main(start_ctx))
+        eom = Eom(start_ctx=start_ctx)
+        scheduler = stagesched.StageScheduler(eom.log,
+                                              int(eom.args.stage_workers))
+        scheduler.add_stages(eom)
+        scheduler.on_stage_done = eom.stage_done
+        eom.resume(scheduler)
+        failed = True
+        try:
+            scheduler.run()
+            failed = False
+        finally:
+            scheduler.report()
+            eom.journal_end(failed)
+            summary = eom.run_summary(scheduler, failed)
+            if eom.args.prom_file:
+                write_prom_file(eom.log, [summary], eom.args.prom_file)
 
     except KeyboardInterrupt:
         ### handle keyboard interrupt ###
         sys.exit(0)
+
+def batch_envs(batch):
+    '''
+    The environments to build for --batch, either a comma or space separated
+    list or the name of a file with one environment per line (# comments)
+    '''
+    if os.path.isfile(batch):
+        with open(batch) as bf:
+            words = [line.split("#", 1)[0] for line in bf]
+    else:
+        words = [batch]
+    envs = []
+    for word in " ".join(words).replace(",", " ").split():
+        if word.lower() not in envs:
+            envs.append(word.lower())
+    return envs
+
+def batch_main(start_ctx):
+    '''
+    Build every environment given to --batch on one shared stage scheduler.
+    Each environment gets an Eom of its own and its stages are put in a group
+    named after it, at most --stage_workers stages of an environment and
+    --batch_workers environments are in progress at once.  The reg server
+    sessions come from the jiralab session pool and the JIRA connection is
+    shared, so they are set up once rather than once per environment.  A
+    failing environment doesn't stop the others.
+    Returns the exit status, 0 if every environment was built.
+    '''
+    args = start_ctx.args
+    envs = batch_envs(args.batch)
+    log = eom_log(args, "batch")
+    if not envs:
+        log.error("eom.batchempty: No environments in --batch %s" % args.batch)
+        return 1
+    log.info('eom.batchstart: %s :: %d environment(s): %s' %
+             (start_ctx.program_log_id, len(envs), ", ".join(envs)))
+
+    # one set of credentials for the lot
+    auth = jiralab.Auth(args)
+    auth.getcred()
+
+    batch_workers = max(1, int(args.batch_workers))
+    stage_workers = max(1, int(args.stage_workers))
+    scheduler = stagesched.StageScheduler(log,
+                                          batch_workers * stage_workers,
+                                          group_workers=stage_workers,
+                                          max_groups=batch_workers,
+                                          isolate_groups=True)
+    eoms = {}
+    for env in envs:
+        eom = eoms[env] = Eom(start_ctx=start_ctx, env=env, auth=auth)
+        scheduler.add_stages(eom, group=env)
+    # every environment has a run journal of its own
+    scheduler.on_stage_done = lambda stage: eoms[stage.group].stage_done(stage)
+
+    done = []
+    def env_done(env, failed):
+        # hand the main session back so the next environment can use it
+        ses = getattr(eoms[env], "ses", None)
+        if ses is not None:
+            jiralab.SESSION_POOL.release(ses)
+        eoms[env].journal_end(failed)
+        done.append(env)
+        log.info("eom.batchprog: %s %s, %d/%d environment(s) finished,"
+                 " %d failed" % (env, "FAILED" if failed else "done",
+                 len(done), len(envs), len(scheduler.failures)))
+    scheduler.on_group_done = env_done
+
+    try:
+        scheduler.run()
+    finally:
+        scheduler.report()
+        scheduler.group_report()
+        jiralab.SESSION_POOL.close()
+        summaries = [eoms[env].run_summary(scheduler,
+                                           env in scheduler.failures
+                                           or env not in done, group=env)
+                     for env in envs]
+        if args.prom_file:
+            write_prom_file(log, summaries, args.prom_file)
+    if scheduler.failures:
+        log.error("eom.batchfail: Failed: %s" %
+                  ", ".join(sorted(scheduler.failures)))
+        return 1
+    return 0
+
+def write_prom_file(log, summaries, path):
+    '''
+    Write the run summaries to path as a Prometheus text file
+    '''
+    try:
+        metrics.write_prom(summaries, path)
+        log.info("eom.promfile: Run metrics written to %s" % path)
+    except (IOError, OSError), exc:
+        log.warn("eom.promerr: Can't write %s: %s" % (path, exc))
+
+def eom_log(args, envid_l, name='env-o-matic'):
+    '''
+    Set up logging the way args asks for it, every line is tagged with
+    envid_l.  Returns the logger
+    '''
+    if args.syslog is not None:
+        if ':' in args.syslog:
+            sp =  "(?P<hst>.+):(?P<prt>[0-9]+)" # Decode Host:port
+            ss = re.search(sp,args.syslog)
+            if ss:
+                syslog_obj =  ( ss.group("hst"), int(ss.group("prt")))
+    else:
+        syslog_obj = args.syslog
+
+    try:
+        if args.logfile:
+            log = mylog.logg(name, llevel='INFO',
+                    gmt=True, lfile=args.logfile, cnsl=True, syslog=syslog_obj)
+        else:
+            log = mylog.logg(name, llevel='INFO',
+                    gmt=True, cnsl=True, sh=sys.stdout, syslog=syslog_obj)
+    except UnboundLocalError:
+        print("Can't open Log file, check path\n")
+        sys.exit(1)
+    except socket.error:
+        print("Bad value passed to syslog call, %s" % args.syslog)
+        sys.exit(1)
+
+    #set the formatter so that it adds the envid
+    lfstr = ('%(asctime)s %(levelname)s: %(name)s:'
+             '[%(process)d] {0}:: %(message)s'.format(envid_l))
+    formatter = logging.Formatter(lfstr,
+        datefmt='%Y-%m-%d %H:%M:%S +0000')
+    for h in log.handlers:
+        h.setFormatter(formatter)
+
+    if args.debug:
+        log.setLevel("DEBUG")
+    return log
 ###############################################################################
-#    These classes implement threads that can be started in parallel
-#    Right now there are two things that proceed in parallel, reimaging and db
-#    creation,  this is implemented by the two classes below, both inherit from
-#    jiralab.Job they employ a semaphore queue mechanism, see 
-#    http://www.ibm.com/developerworks/aix/library/au-threadingpython/
-#    As a general example of how this is coded
+#    These classes implement the reimaging and db creation jobs, both inherit
+#    from jiralab.Job so each one gets a ssh session of its own on a reg
+#    server. The stage scheduler runs them on its worker pool, in parallel
+#    with any other stage that doesn't depend on them.
 ###############################################################################
 class EOMreimage(jiralab.Job):
     '''
@@ -172,19 +369,41 @@ class EOMreimage(jiralab.Job):
             # Start re-imaging
             log.info("eom.reimg.start:(%s) Reimaging %s start @ %s UTC" %
                      (name, envid, time.asctime(time.gmtime(time.time()))))
+            # tee the output to the session too, the roles are read out of it
             reimage_cmd = (('time provision -e %s reimage -v 2>&1'
-            '|jcmnt -f -u %s -i %s -t "Re-Imaging Environment for code deploy"')
+            ' |tee /dev/tty'
+            ' |jcmnt -f -u %s -i %s -t "Re-Imaging Environment for code deploy"')
                 % ( envid_l, user, ppj))
             rval = execute(ses, reimage_cmd, debug, log, to=reimage_to)
             if rval == PEXTO:
                 log.warn("eom.rimgto: Re-image operation timed out")
                 execute(ses,"jcmnt -u %s -i %s re-image operation time-out"
                         % (user,ppj), debug, log)
+                self.failed = True
                 return
 
-            log.info("eom.sleep:(%s) Re-image complete, sleeping 5 minutes"
-                          % name)
-            time.sleep(300)
+            # provision's verify step prints "verify: server: <fqdn>: <state>"
+            # for every server of the env, a role is back once ssh answers
+            roles = sorted(set(m.group(1) for m in
+                    [re.search(r"verify: server: (%s\S*): " % envid_l, line)
+                     for line in ses.lines()] if m))
+            if roles:
+                log.info("eom.rimgwait:(%s) Re-image complete, waiting up to"
+                         " %d sec for ssh on %d roles" %
+                         (name, REIMAGE_SETTLE_TO, len(roles)))
+                readiness.wait_until(
+                    readiness.AllProbe(
+                        # from the reg server, this host may not reach them
+                        [readiness.CommandProbe(ses, "nc -z -w5 %s %d" %
+                                                (role, SSH_PORT))
+                         for role in roles],
+                        "ssh up on the roles of %s" % envid_l),
+                    REIMAGE_SETTLE_TO, log, name=name)
+            else:
+                log.warn("eom.rimgwait:(%s) no roles in the provision output,"
+                         " waiting %d sec for them to come back" %
+                         (name, REIMAGE_SETTLE_TO))
+                time.sleep(REIMAGE_SETTLE_TO)
 
             log.info("eom.rimgval: Verifying re-imaging of roles in %s" % envid)
 
@@ -198,9 +417,11 @@ class EOMreimage(jiralab.Job):
             log.info("eom.reimg.done:(%s) Reimaging done @ %s UTC" %
                           (name, time.asctime(time.gmtime(time.time()))))
 
-        except:
-            log.error(
-                "eom.threadexcpt: exception occurred in thread %s" % name)
+        except Exception, e:
+            self.log.error(
+                "eom.threadexcpt: exception occurred in thread %s: %s" %
+                (self.name, e))
+            self.failed = True
         finally:
             if q:
                 q.task_done()
@@ -220,7 +441,6 @@ class EOMdbgen(jiralab.Job):
             ses = self.ses
             args = self.args
             user = self.auth.user
-            password = self.auth.password
             log = self.log
             dbt = self.pprd["dbtask"]
             name = self.name
@@ -261,9 +481,15 @@ class EOMdbgen(jiralab.Job):
                 log.warn(
                     "eom.dbcreate.to:(%s) dbgen did not complete within %d sec"
                     % (name, args.DBGEN_TO))
-            # Look for errors in the delphix-auto-provision output
-            if 'Error' in ses.session.before:
+                self.failed = True
+                return
+            # Look for errors in the delphix-auto-provision output, all of
+            # it, before only has the tail of a long output.  dbgen did
+            # finish, so this doesn't fail the job, it only has it run
+            # again on --resume
+            if ses.search("Error"):
                 log.warn("eom.dbcreate.err:(%s) dbgen encountered an error" % name)
+                self.errors = True
 
             #if there wasn't an error and if siebel was specified, create a GG dataset ticket
             elif self.use_siebel:
@@ -287,7 +513,7 @@ class EOMdbgen(jiralab.Job):
                 jira_options = {'server': 'https://jira.stubcorp.com/',
                         'verify' : False,
                         }
-                jira = JIRA(jira_options,basic_auth=(user,password))
+                jira = jiralab.jira_connection(jira_options, self.auth)
                 new_db = jira.create_issue(fields=db_dict)
                 log.info("eom.dbcreate.siebelGG: creating GG ticket for siebel")
 
@@ -295,9 +521,11 @@ class EOMdbgen(jiralab.Job):
             log.info("eom.dbcreate.done:(%s) Database DONE @ %s UTC," %
                      (name, time.asctime(time.gmtime(time.time()))))
 
-        except:
-            log.error(
-                "eom.threadexcpt: exception occurred in thread %s" % self.name)
+        except Exception, e:
+            self.log.error(
+                "eom.threadexcpt: exception occurred in thread %s: %s" %
+                (self.name, e))
+            self.failed = True
         finally:
             if q:
                 q.task_done()
@@ -354,6 +582,10 @@ class eom_startup(object):
                             "--build_label=rb_ecomm_13_5-186593.209")
         parser.add_argument("-R", "--restart", dest="restart_issue",
                             help="ENV or PROPROJ issue to restart from, ")
+        parser.add_argument("--resume", dest="resume", default=None,
+                            metavar="RUN_ID",
+                            help="resume an earlier run, skipping the stages "
+                            "it completed (the run id is logged at start)")
         parser.add_argument("-l", "--logfile", dest="logfile",
                             default=DEFAULT_LOG_PATH,
                             help="file to log to (if none, log to console)" )
@@ -381,6 +613,23 @@ class eom_startup(object):
                             help="continue with deploy, even with env-validate"
                             " warnings. note: sudo/ssh warnings will not"
                             " be ignored")
+        parser.add_argument("--stage_workers", dest="stage_workers",
+                            default=STAGE_WORKERS, type=int,
+                            help="max number of stages to run concurrently,"
+                            " with 1 only the re-image and the db creation"
+                            " run side by side, as they always have")
+        parser.add_argument("--prom_file", dest="prom_file", default=None,
+                            help="also write the run metrics to this file in"
+                            " the Prometheus text format (ex. for the "
+                            "node_exporter textfile collector)")
+        parser.add_argument("--batch", dest="batch", default=None,
+                            help="build several environments, a comma "
+                            "separated list or a file with one per line "
+                            "(ex. --batch srwd03,srwd17); --env is ignored")
+        parser.add_argument("--batch_workers", dest="batch_workers",
+                            default=BATCH_WORKERS, type=int,
+                            help="max number of environments to build at "
+                            "once in --batch mode")
         switch_grp = parser.add_argument_group('Switches',
                             "Example: --skipreimage=no will TURN ON re-imaging "
                             "if skipreimage was set to true in the eom.ini file"
@@ -507,11 +756,18 @@ class eom_startup(object):
                     eom_ini_file = eom_path + "/.eom_ini"
             self._parse_ini_file(eom_ini_file)
 
+        # --resume, pick the options and the completed stages of the run
+        # up from its journal
+        self.journal = None
+        self.resume_stages = {}
+        if self.args.resume:
+            self._load_journal(self.args.resume)
+
         exit_status = 0
         if not self.args.release:
             print("ERROR: No release specified")
             exit_status = 1
-        if not self.args.env:
+        if not self.args.env and not self.args.batch:
             print("ERROR: No environment specified")
             exit_status = 1
         if not self.args.deploy:
@@ -525,6 +781,29 @@ class eom_startup(object):
             parser.print_usage()
             exit(exit_status)
 
+    def _load_journal(self, run_id):
+        """
+        Open the journal of the run being resumed, the options saved in it
+        replace the ones from the command line and .eom_ini (except for the
+        ones in RESUME_KEEP, like the credentials and the log file)
+        """
+        if self.args.batch:
+            print("ERROR: --resume resumes one environment, not a --batch")
+            exit(1)
+        jdir = journal.journal_dir(self.args.logfile or DEFAULT_LOG_PATH)
+        try:
+            self.journal = journal.Journal.open(jdir, run_id)
+            options, self.resume_stages = self.journal.replay()
+        except (IOError, OSError), exc:
+            print("eom.nojnl: Can't resume run %s: %s" % (run_id, exc))
+            exit(1)
+        if not options:
+            print("eom.nojnl: Journal of run %s has no options" % run_id)
+            exit(1)
+        for key, value in options.iteritems():
+            if key not in RESUME_KEEP:
+                setattr(self.args, key, value)
+
     def _parse_ini_file(self, inifile):
         """
         Open and parse the .eomini file. Values in the .eomini file can
@@ -569,7 +848,7 @@ class eom_startup(object):
 #                        Class Eom
 ###############################################################################
 class Eom(object):
-    def __init__(self,argv=None):
+    def __init__(self, argv=None, start_ctx=None, env=None, auth=None):
         #######################################################################
         # Get cmd line options, start logging, read ini file, validate options
         #######################################################################
@@ -578,17 +857,23 @@ class Eom(object):
         if argv:
             sys.argv.extend(argv)
 
-        start_ctx = eom_startup()
+        if start_ctx is None:
+            start_ctx = eom_startup()
         args = self.args = start_ctx.args
+        if env:
+            # --batch, each environment gets its own copy of the options
+            args = self.args = copy.deepcopy(start_ctx.args)
+            args.env = env
 
         # Authenticate user name and password
-        self.auth = auth = jiralab.Auth(args)
-        auth.getcred()
+        if auth is None:
+            auth = jiralab.Auth(args)
+            auth.getcred()
+        self.auth = auth
 
         self.envid = envid = args.env.upper()
         self.envid_l = envid_l = args.env.lower()
         self.envnum = envid[-2:]            #just the number
-        self.stage_q = Queue.Queue()        # use this queue for thread seq
 
         # A little ugly, but the alternative is changing a bunch of code which could
         # introduce more subtle errors
@@ -600,42 +885,13 @@ class Eom(object):
         #######################################################################
         #                  Set up and start Logging
         #######################################################################
-        if args.syslog is not None:
-            if ':' in args.syslog:
-                sp =  "(?P<hst>.+):(?P<prt>[0-9]+)" # Decode Host:port
-                ss = re.search(sp,args.syslog)
-                if ss:
-                    syslog_obj =  ( ss.group("hst"), int(ss.group("prt")))
+        if env:
+            # a logger per environment, so the lines of each are tagged
+            self.log = log = eom_log(args, envid_l,
+                                     name='env-o-matic.%s' % envid_l)
+            log.propagate = False
         else:
-            syslog_obj = args.syslog
-           
-        try:
-            if args.logfile:
-                self.log = log = mylog.logg('env-o-matic', llevel='INFO',
-                        gmt=True, lfile=args.logfile, cnsl=True, syslog=syslog_obj)
-            else:
-                self.log = log = mylog.logg('env-o-matic', llevel='INFO',
-                        gmt=True, cnsl=True, sh=sys.stdout, syslog=syslog_obj)
-        except UnboundLocalError:
-            print("Can't open Log file, check path\n")
-            sys.exit(1)
-        except socket.error:
-            print("Bad value passed to syslog call, %s" % args.syslog)
-            sys.exit(1)
-
-        #set the formatter so that it adds the envid
-        lfstr = ('%(asctime)s %(levelname)s: %(name)s:'
-                 '[%(process)d] {0}:: %(message)s'.format(envid_l))
-        formatter = logging.Formatter(lfstr,
-            datefmt='%Y-%m-%d %H:%M:%S +0000')
-        for h in log.handlers:
-            h.setFormatter(formatter)
-
-        if args.debug:
-            DEBUG = True
-            log.setLevel("DEBUG")
-        else:
-            DEBUG = False
+            self.log = log = eom_log(args, envid_l)
 
 
         #######################################################################
@@ -644,7 +900,113 @@ class Eom(object):
         log.info('eom.start: %s :: %s' % (start_ctx.program_log_id, args))
         # Get the login credentials from the user or from the vault
 
-    @assignSequence(100)
+        #######################################################################
+        #                   Run journal
+        #######################################################################
+        self.journal = None
+        self.resumed = {}
+        self.rerun_stages = set()   # completed, but not journaled
+        if start_ctx.journal and not env:
+            self.journal = start_ctx.journal
+            self.resumed = start_ctx.resume_stages
+            self.run_id = self.journal.run_id
+            self.journal.write(journal.RESUME,
+                               completed=sorted(self.resumed))
+            log.info("eom.runid: Resuming run %s, %d stage(s) completed" %
+                     (self.run_id, len(self.resumed)))
+        else:
+            self.run_id = journal.new_run_id(envid_l)
+            options = dict((key, value) for key, value
+                           in vars(args).iteritems() if key not in JOURNAL_OMIT)
+            try:
+                self.journal = journal.Journal.create(
+                        journal.journal_dir(args.logfile or DEFAULT_LOG_PATH),
+                        self.run_id, options)
+                log.info("eom.runid: Run %s, journal %s (restart it with"
+                         " --resume %s)" % (self.run_id, self.journal.path,
+                                            self.run_id))
+            except (IOError, OSError), exc:
+                log.warn("eom.nojnl: Can't write a journal for run %s,"
+                         " it can't be resumed: %s" % (self.run_id, exc))
+
+    def stage_done(self, stage):
+        """
+        Write a completed stage and what it produced to the run journal,
+        called by the stage scheduler.  A stage in rerun_stages isn't
+        written, so --resume runs it again.
+        """
+        if self.journal is None:
+            return
+        name = stage.name.split(":", 1)[-1]     # drop the --batch group
+        if name in self.rerun_stages:
+            return
+        produced = {}
+        for attr in getattr(getattr(self, name), "produces", ()):
+            try:
+                produced[attr] = journal.get_dotted(self, attr)
+            except AttributeError:
+                pass        # the stage took a path that doesn't set it
+        try:
+            self.journal.stage_done(name, produced)
+        except (IOError, OSError, TypeError, ValueError), exc:
+            self.log.warn("eom.jnlerr: Can't journal stage %s: %s" %
+                          (name, exc))
+
+    def resume(self, scheduler):
+        """
+        Put back what the completed stages of the run being resumed produced
+        and mark them done in the scheduler, so the run picks up at the first
+        stage that didn't complete
+        """
+        log = self.log
+        for name, produced in sorted(self.resumed.iteritems()):
+            func = getattr(self, name, None)
+            if name not in scheduler.stages:
+                continue
+            if getattr(func, "rerun", False):
+                log.info("eom.rsmrerun: %s completed in run %s, running it"
+                         " again" % (name, self.run_id))
+                continue
+            for attr, value in produced.iteritems():
+                journal.set_dotted(self, attr, value)
+            scheduler.mark_done(name)
+            log.info("eom.rsmskip: %s completed in run %s, skipping" %
+                     (name, self.run_id))
+
+    def run_summary(self, scheduler, failed, group=None):
+        """
+        Log the run summary (stage times, remote command figures) and write
+        all of it as JSON next to the run journal.  Returns the summary
+        """
+        log = self.log
+        summary = metrics.run_summary(scheduler, self.envid_l, self.run_id,
+                                      failed, group)
+        log.info("eom.summary: %s" % json.dumps(metrics.brief(summary),
+                                                 sort_keys=True))
+        path = os.path.join(
+                journal.journal_dir(self.args.logfile or DEFAULT_LOG_PATH),
+                self.run_id + ".json")
+        try:
+            metrics.write_json(summary, path)
+            log.info("eom.sumfile: Run summary written to %s" % path)
+        except (IOError, OSError), exc:
+            log.warn("eom.sumerr: Can't write the run summary: %s" % exc)
+        return summary
+
+    def journal_end(self, failed):
+        if self.journal is None:
+            return
+        try:
+            self.journal.write(journal.END,
+                               state="failed" if failed else "done")
+            self.journal.close()
+        except (IOError, OSError), exc:
+            self.log.warn("eom.jnlerr: Can't close the journal: %s" % exc)
+        if failed:
+            self.log.info("eom.runid: Run %s did not complete, resume it with"
+                          " --resume %s" % (self.run_id, self.run_id))
+
+    @assignSequence(100, uses=["regsession"], rerun=True)
     def login_stage(self):
         # Login to the reg server
         # We do all orchestration from a single reg erver
@@ -653,22 +1015,16 @@ class Eom(object):
         args = self.args
         stage_entry(log)
 
-        log.info ("eom.login: Logging into %s  @ %s UTC" %\
-                (REGSERVER, time.asctime(time.gmtime(time.time()))))
-        self.ses = ses = jiralab.CliHelper(REGSERVER,log)
-        # Die if the login failed.
-        if not ses.login(auth.user,auth.password,prompt="\$[ ]"):
+        # Lease a shell that is logged in and has become the relmgt user,
+        # all tools are run as this user
+        try:
+            self.ses = ses = jiralab.SESSION_POOL.lease(REGSERVER, auth, log,
+                                    name="main", debug=DEBUG, timeout=CMD_TO)
+        except jiralab.JIRALAB_CLI_LoginError:
+            # Die if the login failed.
             log.error("eom.badexit: Exiting with error")
             sys.exit(2)
-
-        if DEBUG:
-            log.debug ("eom.deb: before: %s\nafter: %s" % (ses.before,
-                                                           ses.after))
-        # Become the relmgt user, all tools are run as this user
-        log.info ("eom.relmgt: Becoming relmgt @ %s UTC" %\
-                  time.asctime(time.gmtime(time.time())))
-
-        rval = execute(ses,"sudo -i -u relmgt",DEBUG,log)
+        rval = PEXOK
 
         log.info ("eom.lckout: Clecking for ENV lock-out")
         if not args.override:
@@ -688,7 +1044,9 @@ class Eom(object):
         stage_exit(log)
         return rval
 
-    @assignSequence(200)
+    @assignSequence(200, depends=["login_stage"], uses=["regsession"],
+                    produces=["use_siebel", "pprj", "proproj_result_dict",
+                              "jira_options"])
     def create_issue_stage(self):
     #######################################################################
     #                   restart option
@@ -766,15 +1124,27 @@ class Eom(object):
                     (ses.before, ses.after))
                 exit(2)
 
-        # Login to JIRA so we can manipulate tickets...
-        self.jira_options = jira_options = {'server': 'https://jira.stubcorp.com/',
+        self.jira_options = {'server': 'https://jira.stubcorp.com/',
                     'verify' : False,
                     }
-        jira = JIRA(jira_options,basic_auth= (auth.user,auth.password))
+        rval=1
+        stage_exit(log)
+        return rval
+
+    @assignSequence(250, depends=["create_issue_stage"])
+    def jira_provision_stage(self):
+        args = self.args
+        auth = self.auth
+        envid = self.envid
+        log = self.log
+        pprj = self.pprj
+        stage_entry(log)
 
         # If there is an ENV ticket, and this is not a restart,
         # link the proproj to it. And set the ENVREQ Status to Provisioning
         if args.envreq and not args.restart_issue:
+            # Login to JIRA so we can manipulate tickets...
+            jira = jiralab.jira_connection(self.jira_options, auth)
             log.info("eom.tlink: Linking propoj:%s to ENV request:%s" %\
                      (pprj, args.envreq))
 
@@ -802,16 +1172,20 @@ class Eom(object):
         stage_exit(log)
         return rval
 
-    @assignSequence(300)
+    @assignSequence(300, depends=["login_stage"])
     def prevalidate_stage(self):
         args = self.args
         auth = self.auth
         envid = self.envid
         envid_l = self.envid_l
         log = self.log
-        ses = self.ses
         stage_entry(log)
         if args.full_replace:
+            # This stage runs alongside ticket creation and the reimage/dbgen
+            # jobs, so it uses a reg server session of its own.
+            ses = jiralab.SESSION_POOL.lease(REGSERVER, auth, log,
+                                    name="tokentable", debug=DEBUG,
+                                    timeout=CMD_TO)
             update_tt_cmd = ("eom-update-token-table "
                                  "-e %s --release-id %s --full-replacement" %
                                  (envid_l, args.release))
@@ -821,8 +1195,11 @@ class Eom(object):
                 log.info("eom.ttrpl: SUCCESS %s" % update_tt_cmd)
             else:
                 log.error("eom.ttfail: FAIL %s" % update_tt_cmd)
+            jiralab.SESSION_POOL.release(ses)
         stage_exit(log)
-    @assignSequence(400)
+
+    @assignSequence(400, depends=["create_issue_stage"],
+                    produces=["args.skipreimage"], overlap="provision")
     def reimaging_stage(self):
         #######################################################################
         #                   Handle re-image here
@@ -846,26 +1223,32 @@ class Eom(object):
             stage_exit(log)
             return None
         else:
-            # Start re-imaging in a thread
+            # This stage already runs on a scheduler worker, so the job is
+            # run in-line rather than started as yet another thread
             reimage_task = EOMreimage(args, auth, log,
                             name="re-image-thread",
                             proproj_result_dict=self.proproj_result_dict,
-                            queue = self.stage_q,
                             )
-            self.stage_q.put(reimage_task)
-            reimage_task.daemon = True
-            reimage_task.start()
-            self.reimage_task = reimage_task # FIXME need to refactor this for threads
+            self.reimage_task = reimage_task
+            try:
+                reimage_task.run()
+            finally:
+                reimage_task.release()
+            if reimage_task.failed:
+                # fail the stage so a --resume runs the re-image again
+                log.error("eom.reimgfail: Re-image of %s failed, exiting"
+                          % envid)
+                sys.exit(1)
             rval = 1
             stage_exit(log)
             return rval
 
-    @assignSequence(410)
+    @assignSequence(410, depends=["create_issue_stage"],
+                    produces=["args.skipdbgen"], overlap="provision")
     def dbgen_stage(self):
         args = self.args
         auth = self.auth
         envid = self.envid
-        ses = self.ses
         log = self.log
         pprj = self.pprj
         stage_entry(log)
@@ -885,20 +1268,30 @@ class Eom(object):
             dbgen_task = EOMdbgen(args, auth, log,
                             name="dbgen-thread",
                             proproj_result_dict=self.proproj_result_dict,
-#                            session=ses,
                             use_siebel=self.use_siebel,
-                            queue=self.stage_q
                             )
-            self.stage_q.put(dbgen_task)
-            dbgen_task.daemon = True
-            dbgen_task.start()
             self.dbgen_task = dbgen_task
+            try:
+                dbgen_task.run()
+            finally:
+                dbgen_task.release()
+            if dbgen_task.failed:
+                # fail the stage so a --resume runs dbgen again
+                log.error("eom.dbgenfail: Database creation for %s failed,"
+                          " exiting" % envid)
+                sys.exit(1)
+            if dbgen_task.errors:
+                log.warn("eom.dbgenerr: Database creation for %s reported"
+                         " errors, --resume will run it again" % envid)
+                self.rerun_stages.add("dbgen_stage")
 
             rval = 1
             stage_exit(log)
             return rval
 
-    @assignSequence(500)
+    @assignSequence(500, depends=["prevalidate_stage", "reimaging_stage",
+                                  "dbgen_stage"], uses=["regsession"],
+                    produces=["args.enval_success"])
     def validate_stage(self):
         args = self.args
         auth = self.auth
@@ -909,16 +1302,8 @@ class Eom(object):
         pprj = self.pprj
         stage_entry(log)
 
-        #######################################################################
-        #   Wait for all the threads to complete
-        #######################################################################
-
-        if not args.skipdbgen or not args.skipreimage:
-            time.sleep(10)
-            log.info("eom.jobwait: waiting for parallel jobs from previous"
-                     " stage to complete")
-            self.stage_q.join()
-            log.info("eom.jobdone: jobs are done, merging execution")
+        # The scheduler only starts this stage once the token table, reimage
+        # and dbgen stages are complete, so there is nothing left to wait on.
 
         #######################################################################
         # We should be done with Provisioning, run the env-validate suit
@@ -966,12 +1351,13 @@ class Eom(object):
         rgx_envsshFAIL = "env-validate\[[0-9]*\] PRIORITY=WARNING .+ssh test"
         rgx_envdbFAIL = ("env-validate\[[0-9]*\] "
                         "PRIORITY=WARNING .+D(08|19|16)DE[0-9]{2}.+Failed")
-        if not re.search(rgx_envPASS,ses.before):
+        # the output can be long, search it in the session transcript
+        if not ses.search(rgx_envPASS):
             # validation didn't pass, see if we want to ignore it
             if args.ignorewarnings and (
-                not re.search(rgx_envsudoFAIL, ses.before) and
-                not re.search(rgx_envsshFAIL, ses.before)  and
-                not re.search(rgx_envdbFAIL, ses.before)
+                not ses.search(rgx_envsudoFAIL) and
+                not ses.search(rgx_envsshFAIL)  and
+                not ses.search(rgx_envdbFAIL)
 
                 ):
                 log.warn("eom.prvwarn: Warnings present, proceeding anyway")
@@ -986,7 +1372,7 @@ class Eom(object):
         stage_exit(log)
         return rval
 
-    @assignSequence(600)
+    @assignSequence(600, depends=["validate_stage"], uses=["regsession"])
     def pre_deploy_stage(self):
         args = self.args
         auth = self.auth
@@ -1010,7 +1396,42 @@ class Eom(object):
         stage_exit(log)
         return rval
 
-    @assignSequence(700)
+    @assignSequence(650, depends=["validate_stage", "jira_provision_stage"])
+    def jira_appdeploy_stage(self):
+        args = self.args
+        auth = self.auth
+        log = self.log
+        stage_entry(log)
+        #######################################################################
+        # If there is an ENV ticket, and this is not a restart,
+        # Set the ENV ticket to App Deployment, runs alongside the predeploy
+        #######################################################################
+        if (args.deploy[0] != 'no' and args.envreq
+            and not args.restart_issue):
+            log.info("eom.appstate: Setting %s App Deploy state"
+                     % args.envreq)
+            # Make sure were logged into JIRA
+            jira = jiralab.jira_connection(self.jira_options, auth)
+            env_issue = jira.issue(args.envreq)
+            env_transitions = jira.transitions(env_issue)
+            for t in env_transitions:
+                if 'App Deployment' in t['name']:
+                    jira.transition_issue(env_issue, int( t['id']),
+                                          fields={})
+                    log.info(
+                        "eom.appsts: ENVREQ:%s set to App Deployment state" %\
+                        args.envreq)
+                    break;
+            else:
+                log.warn(
+                    "eom.notpro: ENV REQ:%s cannot be set to"
+                    " App Deployment state" % args.envreq)
+        stage_exit(log)
+        return None
+
+    @assignSequence(700, depends=["pre_deploy_stage", "jira_appdeploy_stage"],
+                    uses=["regsession"],
+                    produces=["args.deploy_success", "bl_result_dict"])
     def app_deploy_stage(self):
         args = self.args
         auth = self.auth
@@ -1033,29 +1454,6 @@ class Eom(object):
             return None
         else:
             args.deploy_success = True
-            # If there is an ENV ticket, and this is not a restart,
-            # Set the ENV ticket to App Deployment
-            if args.envreq and not args.restart_issue:
-                log.info("eom.appstate: Setting %s App Deploy state"
-                         % args.envreq)
-                # Make sure were logged into JIRA
-                jira = JIRA(self.jira_options ,
-                            basic_auth=(auth.user,auth.password))
-                env_issue = jira.issue(args.envreq)
-                env_transitions = jira.transitions(env_issue)
-                for t in env_transitions:
-                    if 'App Deployment' in t['name']:
-                        jira.transition_issue(env_issue, int( t['id']),
-                                              fields={})
-                        log.info(
-                            "eom.appsts: ENVREQ:%s set to App Deployment state" %\
-                            args.envreq)
-                        break;
-                else:
-                    log.warn(
-                        "eom.notpro: ENV REQ:%s cannot be set to"
-                        " App Deployment state" % args.envreq)
-
             cr = "--content-refresh" if args.content_refresh else ""
             deploy_timeout = (args.DEPLOY_TO + args.CONTENT_TO
                               if args.content_refresh else args.DEPLOY_TO)
@@ -1115,9 +1513,9 @@ class Eom(object):
                                log, to=args.VERIFY_TO)
                 sys.exit(1)
 
-            dply_result = ses.before.split('\n')
-
-            for line in dply_result:
+            # read the deploy output back a line at a time from the session
+            # transcript, it can be hundreds of MB
+            for line in ses.lines():
                 if 'RABBIT Deployment' in line:
                     if 'SUCCESSFUL' in line:
                         args.deploy_success = True
@@ -1135,7 +1533,7 @@ class Eom(object):
             stage_exit(log)
             return rval
 
-    @assignSequence(800)
+    @assignSequence(800, depends=["app_deploy_stage"], uses=["regsession"])
     def post_deploy_stage(self):
         args = self.args
         auth = self.auth
@@ -1184,11 +1582,12 @@ class Eom(object):
         stage_exit(log)
         return rval
 
-    @assignSequence(810)
+    @assignSequence(810, depends=["app_deploy_stage"])
     def net_deploy_stage(self):
         return None
 
-    @assignSequence(900)
+    @assignSequence(900, depends=["post_deploy_stage", "net_deploy_stage"],
+                    uses=["regsession"])
     def verification_stage(self):
         args = self.args
         auth = self.auth
@@ -1204,8 +1603,12 @@ class Eom(object):
 
             if args.envreq:
                 pprj = args.envreq
-            log.info ("eom.netsleep: Waiting %d seconds for pools to come up", BIGIP_TO )
-            time.sleep(BIGIP_TO)
+            log.info ("eom.netwait: Waiting up to %d seconds for pools to"
+                      " come up" % BIGIP_TO)
+            readiness.wait_until(
+                readiness.CommandProbe(ses,
+                            "/nas/reg/bin/validate_bigip -e %s" % envid_l),
+                BIGIP_TO, log, name="bigip")
             valbigip_cmd = ("/nas/reg/bin/validate_bigip -e %s"
                     '| jcmnt -f -u %s -i %s -t "Big IP validation"') %\
                 (envid_l, auth.user, pprj)
@@ -1229,11 +1632,11 @@ class Eom(object):
         stage_exit(log)
         return rval
 
-    @assignSequence(950)
+    @assignSequence(950, depends=["verification_stage"])
     def smoketest_stage(self):
         return None
 
-    @assignSequence(1000)
+    @assignSequence(1000, depends=["smoketest_stage"], uses=["regsession"])
     def delivery_stage(self):
         args = self.args
         auth = self.auth
@@ -1248,7 +1651,7 @@ class Eom(object):
             log.info("eom.appstate: Setting %s Verification state"
                      % args.envreq)
             # Make sure were logged into JIRA
-            jira = JIRA(self.jira_options ,basic_auth=(auth.user,auth.password))
+            jira = jiralab.jira_connection(self.jira_options, auth)
             env_issue = jira.issue(args.envreq)
             env_transitions = jira.transitions(env_issue)
             for t in env_transitions:
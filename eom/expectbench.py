@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+expectbench -- replay a big deploy log through pexpect.expect()
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+cat's a deploy log (a synthetic one unless --log is given) through a pty and
+waits for the prompt at the end of it the same way jiralab.CliHelper.docmd()
+does, then reports how long it took.  Use it to see what a change to the
+pexpect searchers does to long running commands like eom-rabbit-deploy.
+
+    expectbench.py --size 50                       # bounded patterns only
+    expectbench.py --size 50 --unbounded           # add an unbounded pattern
+    expectbench.py --size 50 --unbounded --maxmatchlen 512
+'''
+import os
+import sys
+import time
+import tempfile
+import pexpect
+
+from argparse import ArgumentParser
+from argparse import RawDescriptionHelpFormatter
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-26'
+__updated__ = '2014-08-26'
+
+PROMPT = r"\[PEXPECT\][\$\#] "         # same prompt pxssh sets up
+ABORT = r"FATAL: deploy aborted"
+UNBOUNDED = r"ERROR: [^\r\n]* failed"   # never found in the synthetic log
+
+LOGLINE = ("2014-08-25 10:11:%02d,%03d INFO  [deploy-%d] srwd83app%03d:"
+           " pushed stubhub-app-%d.war (%d bytes) to /opt/jboss/deploy\n")
+
+
+def make_log(path, size_mb):
+    '''
+    Write about size_mb megabytes of deploy log lines to path
+    '''
+    size = int(size_mb * 1024 * 1024)
+    written = 0
+    n = 0
+    with open(path, "w") as f:
+        while written < size:
+            line = LOGLINE % (n % 60, n % 1000, n % 8, n % 200, n % 50, n * 7)
+            f.write(line)
+            written += len(line)
+            n += 1
+    return written
+
+
+def replay(path, patterns, maxread, maxmatchlen, timeout):
+    '''
+    cat path then print the prompt, expect() the prompt.
+    Returns (seconds, bytes read before the prompt)
+    '''
+    cmd = "cat %s; echo '[PEXPECT]$ '" % path
+    child = pexpect.spawn("/bin/sh", ["-c", cmd], maxread=maxread)
+    start = time.time()
+    index = child.expect(patterns, timeout=timeout, maxmatchlen=maxmatchlen)
+    elapsed = time.time() - start
+    child.close()
+    if index != 0:
+        raise RuntimeError("expected the prompt, matched %r" % patterns[index])
+    return elapsed, len(child.before)
+
+
+def main(argv=None):
+    '''Command line options.'''
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = ArgumentParser(description=__doc__.split("\n")[1],
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--log", help="replay this log instead of a"
+                        " synthetic one")
+    parser.add_argument("--size", type=float, default=50.0,
+                        help="size in MB of the synthetic log [default: 50]")
+    parser.add_argument("--maxread", type=int, default=2000,
+                        help="pexpect read size [default: 2000]")
+    parser.add_argument("--unbounded", action="store_true",
+                        help="also expect a pattern with no maximum length")
+    parser.add_argument("--maxmatchlen", type=int, default=None,
+                        help="longest match to assume for unbounded patterns")
+    parser.add_argument("--timeout", type=int, default=3600,
+                        help="give up after this many seconds [default: 3600]")
+    args = parser.parse_args(argv)
+
+    patterns = [PROMPT, ABORT]
+    if args.unbounded:
+        patterns.append(UNBOUNDED)
+
+    path = args.log
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="expectbench.", suffix=".log")
+        os.close(fd)
+        make_log(path, args.size)
+    try:
+        size = os.path.getsize(path)
+        elapsed, nread = replay(path, patterns, args.maxread,
+                                args.maxmatchlen, args.timeout)
+    finally:
+        if args.log is None:
+            os.unlink(path)
+
+    print "patterns:    %s" % ", ".join(patterns)
+    print "maxread:     %d  maxmatchlen: %s" % (args.maxread, args.maxmatchlen)
+    print "replayed:    %.1f MB (%d bytes read) in %.2f sec, %.1f MB/s" % (
+          size / 1048576.0, nread, elapsed, size / 1048576.0 / elapsed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,7 @@ import sys
 import os
 import re
 import jiralab
+import mylog
 
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
@@ -88,60 +89,57 @@ def main(argv=None):  # IGNORE:C0111
         print ("Error: Not enough arguments supplied, exiting")
         exit(0)
 
-    # Login to the reg server
-    print("Logging into %s" % REGSERVER)
-    reg_session = jiralab.CliHelper(REGSERVER)
-    reg_session.login(auth.user, auth.password, prompt="\$[ ]")
-    if DEBUG:
-        print("before: %s\nafter: %s" % (reg_session.before,
-                    reg_session.after))
-
-    print ("Becoming relmgt")
-    rval = reg_session.docmd("sudo -i -u relmgt", [reg_session.session.PROMPT],
-                             timeout=CONTENT_TO)
-    if DEBUG:
-        print ("Rval= %d; before: %s\nafter: %s" % (rval,
-                    reg_session.before, reg_session.after))
-
-    print ("Running content tool...")
-    rval = reg_session.docmd("/nas/reg/bin/content -i", ["choice?"])
-    if DEBUG:
-        print ("Rval= %d; before: %s\nafter: %s" % (rval,
-                    reg_session.before, reg_session.after))
-
-    for i in xrange(3):
-        rval = reg_session.docmd(args.rem[i], ["choice?"])
+    # Login to the reg server and become relmgt, the pool multiplexes
+    # the ssh connection so this is cheap if eom is already logged in
+    log = mylog.logg('jcontent', llevel='DEBUG' if DEBUG else 'INFO',
+                     gmt=True, cnsl=True, sh=sys.stdout)
+    reg_session = jiralab.SESSION_POOL.lease(REGSERVER, auth, log,
+                            name="jcontent", debug=DEBUG, timeout=CONTENT_TO)
+    at_prompt = False   # only pool the session once the content tool quit
+    try:
+        print ("Running content tool...")
+        rval = reg_session.docmd("/nas/reg/bin/content -i", ["choice?"])
         if DEBUG:
             print ("Rval= %d; before: %s\nafter: %s" % (rval,
                         reg_session.before, reg_session.after))
 
-    # Apply the environment ID        
-    rval = reg_session.docmd(envid_lower, ["choice?"])
-    if DEBUG:
-        print ("Rval= %d; before: %s\nafter: %s" % (rval,
-                    reg_session.before, reg_session.after))
+        for i in xrange(3):
+            rval = reg_session.docmd(args.rem[i], ["choice?"])
+            if DEBUG:
+                print ("Rval= %d; before: %s\nafter: %s" % (rval,
+                            reg_session.before, reg_session.after))
+
+        # Apply the environment ID        
+        rval = reg_session.docmd(envid_lower, ["choice?"])
+        if DEBUG:
+            print ("Rval= %d; before: %s\nafter: %s" % (rval,
+                        reg_session.before, reg_session.after))
         
-    # Hit the "go" button
-    rval = reg_session.docmd("1", ["choice?", "Exiting with code"]
-                             ,timeout=CONTENT_TO)
-    if DEBUG:
-        print ("Rval= %d; before: %s\nafter: %s" % (rval,
-                    reg_session.before, reg_session.after))
-
-    if rval == 2:
-        print ("ERROR: CONTENT TOOL ABORTED!:\n%s%s" % 
-               (reg_session.before,reg_session.after))
-        exit(1)
+        # Hit the "go" button
+        rval = reg_session.docmd("1", ["choice?", "Exiting with code"]
+                                 ,timeout=CONTENT_TO)
+        if DEBUG:
+            print ("Rval= %d; before: %s\nafter: %s" % (rval,
+                        reg_session.before, reg_session.after))
+
+        if rval == 2:
+            print ("ERROR: CONTENT TOOL ABORTED!:\n%s%s" % 
+                   (reg_session.before,reg_session.after))
+            exit(1)
 
-    print ("%s%s" % (reg_session.before, reg_session.after))
+        print ("%s%s" % (reg_session.before, reg_session.after))
     
-    # Hit the "quit" button
-    rval = reg_session.docmd("q", [reg_session.session.PROMPT])
-    if DEBUG:
-        print ("Rval= %d; before: %s\nafter: %s" % (rval,
-                    reg_session.before, reg_session.after))
+        # Hit the "quit" button
+        rval = reg_session.docmd("q", [reg_session.session.PROMPT])
+        if DEBUG:
+            print ("Rval= %d; before: %s\nafter: %s" % (rval,
+                        reg_session.before, reg_session.after))
+
+        print ("%s%s" % (reg_session.before, reg_session.after))
+        at_prompt = (rval == 1)
+    finally:
+        jiralab.SESSION_POOL.release(reg_session, reusable=at_prompt)
 
-    print ("%s%s" % (reg_session.before, reg_session.after))
     sys.exit(0)
     
 if __name__ == "__main__":
@@ -15,6 +15,7 @@ import os
 import re
 import pexpect
 import pxssh
+import transcript
 import logging
 import mylog
 import time
@@ -28,6 +29,12 @@ __updated__ = '2013-06-24'
 
 AES_BLOCKSIZE = 128
 REGSERVER = "srwd00reg010.stubcorp.dev"
+POOL_MAX_IDLE = 4       # warm sessions kept per (host, user)
+POOL_PING_TO = 10       # time allowed for a pooled session to answer a ping
+POOL_MULTIPLEX = True   # share one ssh connection per host (ControlMaster)
+POOL_CAPTURE = True     # pooled sessions spill their output to a transcript
+SSH_MULTIPLEX_OPTS = ("-o ControlMaster=auto -o ControlPersist=600"
+                      " -o ControlPath=~/.ssh/eom-%r@%h:%p")
 
 log = logging.getLogger('env-o-matic (%s)' % __name__)
 
@@ -35,6 +42,7 @@ log = logging.getLogger('env-o-matic (%s)' % __name__)
 class JIRALAB_CLI_TypeError(TypeError): pass
 class JIRALAB_CLI_ValueError(ValueError): pass
 class JIRALAB_AUTH_ValueError(ValueError): pass
+class JIRALAB_CLI_LoginError(RuntimeError): pass
 
 class Reg():
     """
@@ -85,6 +93,8 @@ class Job(threading.Thread):
             debug   - set to True to print out debugging
             session - if set, don't perform a login, but use this session
                       context to run the job.
+        If no session is supplied one is leased from SESSION_POOL, call
+        release() when the job is done with it.
         '''
         #  Call the initializer of the superclass
         threading.Thread.__init__(self)
@@ -99,26 +109,163 @@ class Job(threading.Thread):
         self.name = kwargs.get('name', None)
         self.use_siebel = kwargs.get('use_siebel', None)
         self.stage_q = kwargs.get('queue', None)
-
+        self.leased = False
+        self.failed = False         # set by run() if the job didn't complete
+        self.errors = False         # set by run() if it completed with errors
 
         if not self.ses :
-            # Login to the reg server
-            log.info ("eom.login:(%s) Logging into %s  @ %s UTC" %
-                      (self.name, REGSERVER,
-                       time.asctime(time.gmtime(time.time()))))
-            # Create a remote shell object
-            self.ses = CliHelper(REGSERVER,log)
-            self.ses.login(self.auth.user, self.auth.password,prompt="\$[ ]")
-            if self.debug:
-                log.debug ("eom.deb:(%s) before: %s\nafter: %s" %
-                           (self.name, self.session.before, self.session.after))
-            # sudo to the relmgt user
-            log.info ("eom.relmgt:(%s) Becoming relmgt @ %s UTC" %
-                      (self.name, time.asctime(time.gmtime(time.time()))))
-            rval = self.ses.docmd("sudo -i -u relmgt",[self.ses.session.PROMPT])
-            if self.debug:
-                log.debug ("eom.deb:(%s) Rval= %d; before: %s\nafter: %s" %
-                           (self.name, rval, self.ses.before, self.ses.after))
+            self.ses = SESSION_POOL.lease(REGSERVER, self.auth, log,
+                                          name=self.name, debug=self.debug)
+            self.leased = True
+
+    def release(self):
+        '''
+        Hand a leased session back to the pool
+        '''
+        if self.leased and self.ses:
+            SESSION_POOL.release(self.ses)
+            self.ses = None
+            self.leased = False
+
+
+def relmgt_session(host, auth, log, name=None, debug=False, timeout=30,
+                   multiplex=False, capture=False):
+    '''
+    Log into host as auth.user and become the relmgt user, all of the reg
+    tools are run as relmgt. Returns the CliHelper for the session.
+    Raises JIRALAB_CLI_LoginError if the login fails.
+    '''
+    log.info ("eom.login:(%s) Logging into %s  @ %s UTC" %
+              (name, host, time.asctime(time.gmtime(time.time()))))
+    # Create a remote shell object
+    ses = CliHelper(host,log,multiplex=multiplex,capture=capture)
+    if not ses.login(auth.user, auth.password,prompt="\$[ ]"):
+        raise JIRALAB_CLI_LoginError("Login failure to %s user: %s" %
+                                     (host, auth.user))
+    if debug:
+        log.debug ("eom.deb:(%s) before: %s\nafter: %s" %
+                   (name, ses.before, ses.after))
+    # sudo to the relmgt user
+    log.info ("eom.relmgt:(%s) Becoming relmgt @ %s UTC" %
+              (name, time.asctime(time.gmtime(time.time()))))
+    rval = ses.docmd("sudo -i -u relmgt",[ses.session.PROMPT],
+                     timeout=timeout)
+    if debug:
+        log.debug ("eom.deb:(%s) Rval= %d; before: %s\nafter: %s" %
+                   (name, rval, ses.before, ses.after))
+    ses.pool_key = (host, auth.user)
+    return ses
+
+
+class SessionPool(object):
+    '''
+    Keep warm relmgt shells, already logged in and sudo'd, per (host, user)
+    and lease them out so that the login cost is paid once per host rather
+    than once per job.  Idle sessions are health checked before they are
+    leased again, dead ones are evicted and replaced by a fresh login.
+    With multiplex set, new logins to a host share a single ssh connection
+    (ssh ControlMaster) so even those skip the tcp and auth round trips.
+    With capture set, sessions keep a transcript of their output (see
+    CliHelper).
+    '''
+    def __init__(self, max_idle=POOL_MAX_IDLE, multiplex=POOL_MULTIPLEX,
+                 capture=POOL_CAPTURE):
+        self.max_idle = max_idle
+        self.multiplex = multiplex
+        self.capture = capture
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def lease(self, host, auth, log, name=None, debug=False, timeout=30):
+        key = (host, auth.user)
+        while True:
+            with self.lock:
+                sessions = self.idle.get(key)
+                ses = sessions.pop() if sessions else None
+            if ses is None:
+                break
+            if self.healthy(ses):
+                log.info("eom.poolhit:(%s) Reusing session on %s @ %s UTC" %
+                         (name, host, time.asctime(time.gmtime(time.time()))))
+                ses.log = log
+                return ses
+            log.info("eom.poolevict:(%s) Dropping dead session on %s" %
+                     (name, host))
+            self._discard(ses)
+        return relmgt_session(host, auth, log, name=name, debug=debug,
+                              timeout=timeout, multiplex=self.multiplex,
+                              capture=self.capture)
+
+    def release(self, ses, reusable=True):
+        '''
+        Hand ses back to the pool. With reusable False the shell is in a
+        state the next lease can't use (i.e. it was left logged into another
+        host), it is hung up instead.
+        '''
+        key = getattr(ses, "pool_key", None)
+        if not reusable or key is None or not ses.session.isalive():
+            self._discard(ses)
+            return
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            if len(sessions) < self.max_idle:
+                sessions.append(ses)
+                return
+        self._discard(ses)
+
+    def healthy(self, ses):
+        '''
+        A session is healthy if it is still a relmgt shell that answers
+        '''
+        try:
+            if not ses.session.isalive():
+                return False
+            # the echoed command has "$(id -un)" where the answer has relmgt
+            rval = ses.docmd("echo EOMPING_$(id -un)", ["EOMPING_relmgt"],
+                             timeout=POOL_PING_TO)
+        except (pexpect.ExceptionPexpect, OSError):
+            return False
+        return rval == 1
+
+    def close(self):
+        '''
+        Log out of all the idle sessions
+        '''
+        with self.lock:
+            sessions = [ses for key in self.idle for ses in self.idle[key]]
+            self.idle = {}
+        for ses in sessions:
+            self._discard(ses)
+
+    def _discard(self, ses):
+        # the shell is sudo'd, an exit only drops back to the login shell,
+        # so just hang up the connection
+        try:
+            ses.session.close()
+        except (pexpect.ExceptionPexpect, OSError):
+            pass
+        if ses.transcript is not None:
+            ses.transcript.close()
+
+SESSION_POOL = SessionPool()
+
+
+_jira_connections = {}
+_jira_lock = threading.Lock()
+
+def jira_connection(options, auth):
+    '''
+    Return a JIRA client for options['server'] logged in as auth.user. The
+    connection is made once and shared by every caller in the process.
+    '''
+    from jira.client import JIRA
+    key = (options.get('server'), auth.user)
+    with _jira_lock:
+        jira = _jira_connections.get(key)
+        if jira is None:
+            jira = JIRA(options, basic_auth=(auth.user, auth.password))
+            _jira_connections[key] = jira
+    return jira
 
 
 class Auth():
@@ -177,14 +324,26 @@ class Auth():
 
 class CliHelper:
     '''Helper class to do  CLI login, command stream execution
-    and file transfers '''
+    and file transfers
+
+    With capture set, everything the session reads is spilled to a
+    transcript.Transcript and before only holds the tail of a long output.
+    All of the output of the last command is in before_span, use lines()
+    and search() to look through it without reading it into memory.'''
 
-    def __init__(self, host, log=None, port=22, debug=False):
+    def __init__(self, host, log=None, port=22, debug=False, multiplex=False,
+                 capture=False):
         self.host = host
         self.port = port
         self.debug = debug
         self.log = log
         self.session = pxssh.pxssh()
+        if multiplex:
+            self.session.SSH_EXTRA_OPTS = SSH_MULTIPLEX_OPTS
+        self.transcript = None
+        self.before_span = None
+        if capture:
+            self.transcript = self.session.capture = transcript.Transcript()
 
     def login(self, user="admin", password="admin", prompt="[#$]", timeout=30):
         self.user = user
@@ -218,6 +377,22 @@ class CliHelper:
         self.after = self.session.after
         self.session.prompt(timeout=1)
 
+    def lines(self):
+        '''
+        Iterate over the lines of the output of the last command
+        '''
+        if self.before_span is not None:
+            return self.before_span.lines()
+        return iter(self.before.split('\n'))
+
+    def search(self, pattern, flags=0):
+        '''
+        re.search() the output of the last command
+        '''
+        if self.before_span is not None:
+            return self.before_span.search(pattern, flags)
+        return re.search(pattern, self.before, flags)
+
     def set_prompt(self, prompt):
         rval = self.PROMPT
         self.PROMPT = self.session.PROMPT = prompt
@@ -230,6 +405,7 @@ class CliHelper:
             if not len(match):
                 self.session.sendline(cmd)
                 self._consume_prompt()
+                self.before_span = None
                 return 1
 
             if not notimeout:
@@ -239,6 +415,7 @@ class CliHelper:
             rval = self.session.expect(search_list, timeout)
             self.before = self.session.before
             self.after = self.session.after
+            self.before_span = self.session.before_span
             if consumeprompt:
                 self._consume_prompt()
             return rval
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+journal -- checkpoint eom runs so they can be resumed
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+Every eom run gets a run id and an append only journal, one JSON record per
+line, next to the log file.  The first record has the options the run was
+started with, then there is one record per completed stage with the values
+the stage produced (the proproj ticket structure, the deploy outcome ...).
+eom --resume <run-id> reads it back, restores those values and only runs the
+stages that didn't complete, so a run that died in app deploy doesn't redo
+an hour of reimage and dbgen.
+'''
+import os
+import json
+import time
+import errno
+import logging
+import threading
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-30'
+__updated__ = '2014-08-30'
+
+JOURNAL_DIR = "eom-journal"     # sub directory of the log directory
+JOURNAL_EXT = ".jnl"
+
+# Record types
+START = "start"
+RESUME = "resume"
+STAGE = "stage"
+END = "end"
+
+log = logging.getLogger('env-o-matic (%s)' % __name__)
+
+# Specialized Exceptions
+class JOURNAL_NotFoundError(IOError): pass
+
+
+def journal_dir(logfile):
+    '''
+    The journal directory that goes with logfile
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(logfile)), JOURNAL_DIR)
+
+
+def new_run_id(envid_l):
+    return "%s-%s" % (envid_l, time.strftime("%Y%m%dT%H%M%S", time.gmtime()))
+
+
+def get_dotted(obj, name):
+    '''
+    getattr() that follows dots, get_dotted(eom, "args.deploy_success")
+    '''
+    for part in name.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def set_dotted(obj, name, value):
+    parts = name.split(".")
+    for part in parts[:-1]:
+        obj = getattr(obj, part)
+    setattr(obj, parts[-1], value)
+
+
+class Journal(object):
+    """
+    Append only journal of one run, every record is flushed to disk before
+    write() returns so a crash loses at most the record being written
+    """
+    def __init__(self, path, run_id):
+        self.path = path
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    @classmethod
+    def create(cls, directory, run_id, options):
+        '''
+        Start the journal of a new run, options is a dict of the options the
+        run was started with (leave out anything secret)
+        '''
+        try:
+            os.makedirs(directory)
+        except OSError, exc:
+            if not (exc.errno == errno.EEXIST and os.path.isdir(directory)):
+                raise
+        journal = cls(os.path.join(directory, run_id + JOURNAL_EXT), run_id)
+        journal.write(START, options=options)
+        return journal
+
+    @classmethod
+    def open(cls, directory, run_id):
+        '''
+        Reopen the journal of an earlier run to resume it
+        '''
+        path = os.path.join(directory, run_id + JOURNAL_EXT)
+        if not os.path.isfile(path):
+            raise JOURNAL_NotFoundError(errno.ENOENT,
+                                        "No journal for run %s" % run_id, path)
+        journal = cls(path, run_id)
+        # a crash in the middle of a write leaves half a line, make sure what
+        # is written now starts on a line of its own
+        with open(path) as jf:
+            jf.seek(0, os.SEEK_END)
+            if jf.tell():
+                jf.seek(-1, os.SEEK_END)
+                if jf.read(1) != "\n":
+                    journal.file.write("\n")
+        return journal
+
+    def write(self, record, **fields):
+        fields["record"] = record
+        fields["run_id"] = self.run_id
+        fields["time"] = time.time()
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def stage_done(self, stage, produced):
+        self.write(STAGE, stage=stage, state="done", produced=produced)
+
+    def replay(self):
+        '''
+        Read the journal back.  Returns (options, stages) where options are
+        the options of the START record and stages is a dict of stage name
+        to the values it produced, for every stage that completed.
+        '''
+        options = None
+        stages = {}
+        with open(self.path) as jf:
+            for n, line in enumerate(jf):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    log.warn("eom.jnlbad: %s:%d unreadable record, ignored" %
+                             (self.path, n + 1))
+                    continue
+                if rec.get("record") == START:
+                    options = rec.get("options")
+                elif rec.get("record") == STAGE and rec.get("state") == "done":
+                    stages[rec["stage"]] = rec.get("produced") or {}
+        return options, stages
+
+    def close(self):
+        with self.lock:
+            self.file.close()
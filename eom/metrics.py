@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+metrics -- timing and throughput figures for eom runs
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+eom.execute() records every remote command against the stage that ran it:
+how long it took, how much of that was spent waiting for the remote side to
+say something (select() in pexpect) rather than matching what it said, and
+how many bytes came back.  With the stage times kept by the scheduler this
+makes up the run summary, a JSON document written next to the run journal,
+and optionally a Prometheus text file for the node_exporter textfile
+collector so build times can be graphed over time.
+'''
+import os
+import json
+import time
+import ctypes
+import ctypes.util
+import logging
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-31'
+__updated__ = '2014-08-31'
+
+CMD_LEN = 200               # longest command kept in the summary
+CLOCK_MONOTONIC = 1         # from <time.h>, Linux
+
+log = logging.getLogger('env-o-matic (%s)' % __name__)
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _monotonic_clock():
+    '''
+    clock_gettime(CLOCK_MONOTONIC) through ctypes, python 2 has no
+    time.monotonic().  Falls back on time.time() where it isn't there.
+    '''
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or
+                            ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    try:
+        monotonic()
+    except OSError:
+        return time.time
+    return monotonic
+
+# Seconds from an arbitrary point, unaffected by changes to the system clock.
+# Only differences between two readings mean anything.
+monotonic = _monotonic_clock()
+
+
+def record_exec(stage, cmd, elapsed, wait, nbytes, rval):
+    '''
+    Add a remote command to the figures of stage (a stagesched.Stage, the
+    command is dropped if it wasn't run by one)
+    elapsed - seconds from sending the command to the match
+    wait    - seconds of that spent waiting for output from the remote side
+    nbytes  - bytes of output read
+    '''
+    if stage is None:
+        return
+    stage.execs.append({
+        "cmd": cmd[:CMD_LEN],
+        "elapsed": round(elapsed, 3),
+        "wait": round(wait, 3),
+        "bytes": nbytes,
+        "rval": rval,
+        })
+
+
+def run_summary(scheduler, env, run_id, failed, group=None):
+    '''
+    Summary of a run as a dict that can be dumped as JSON: the run, then per
+    stage its state, when it started (seconds from the start of the run),
+    how long it was ready before a worker picked it up, how long it ran and
+    what its commands added up to.  With a group only the stages of that
+    group (a --batch environment) are included.
+    '''
+    end = scheduler.end_time if scheduler.end_time else monotonic()
+    start = scheduler.start_time if scheduler.start_time is not None else end
+    stages = []
+    for stage in sorted(scheduler.stages.itervalues(),
+                        key=lambda stage: (stage.start_time is None,
+                                           stage.start_time, stage.seq)):
+        if group is not None and stage.group != group:
+            continue
+        execs = stage.execs
+        cmd_time = sum(ex["elapsed"] for ex in execs)
+        wait = sum(ex["wait"] for ex in execs)
+        started = stage.start_time is not None
+        stages.append({
+            "name": stage.name.split(":", 1)[-1],
+            "state": stage.state,
+            "resumed": stage.resumed,
+            "start": round(stage.start_time - start, 3) if started else None,
+            "queued": round(stage.start_time -
+                            (stage.ready_time or stage.start_time), 3)
+                            if started else None,
+            "run": round(stage.duration, 3),
+            "commands": len(execs),
+            "command_time": round(cmd_time, 3),
+            "expect_wait": round(wait, 3),
+            "processing": round(cmd_time - wait, 3),
+            "bytes": sum(ex["bytes"] for ex in execs),
+            "execs": execs,
+            })
+    path = scheduler.critical_path(group)
+    started = [stage["start"] for stage in stages if stage["start"] is not None]
+    ended = [stage["start"] + stage["run"] for stage in stages
+             if stage["start"] is not None]
+    return {
+        "env": env,
+        "run_id": run_id,
+        "state": "failed" if failed else "done",
+        "started": scheduler.started_at,
+        "elapsed": round(max(ended) - min(started) if started
+                         else end - start, 3),
+        "workers": scheduler.max_workers,
+        "worker_idle": dict((name, round(idle, 3)) for name, idle
+                            in scheduler.worker_idle.iteritems()),
+        "critical_path": [stage.name.split(":", 1)[-1] for stage in path],
+        "critical_path_time": round(sum(stage.duration for stage in path), 3),
+        "stages": stages,
+        }
+
+
+def brief(summary):
+    '''
+    The summary without the per command detail, small enough to log
+    '''
+    short = dict(summary)
+    short["stages"] = [dict((key, value) for key, value in stage.iteritems()
+                            if key != "execs")
+                       for stage in summary["stages"]]
+    return short
+
+
+def write_json(summary, path):
+    _write_atomic(path, json.dumps(summary, sort_keys=True, indent=2) + "\n")
+
+
+def _label(value):
+    return (unicode(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+# name, help, value of the run summary
+PROM_RUN = [
+    ("eom_run_duration_seconds", "Wall clock time of the eom run",
+     lambda run: run["elapsed"]),
+    ("eom_run_critical_path_seconds", "Time on the critical path of the run",
+     lambda run: run["critical_path_time"]),
+    ("eom_run_success", "1 if the run completed, 0 if it failed",
+     lambda run: 0 if run["state"] == "failed" else 1),
+    ("eom_run_timestamp_seconds", "When the run started, unix time",
+     lambda run: run["started"]),
+    ]
+# name, help, value of a stage of the run summary
+PROM_STAGE = [
+    ("eom_stage_duration_seconds", "Time the stage ran",
+     lambda stage: stage["run"]),
+    ("eom_stage_queued_seconds", "Time the stage was ready but not started",
+     lambda stage: stage["queued"]),
+    ("eom_stage_commands", "Remote commands run by the stage",
+     lambda stage: stage["commands"]),
+    ("eom_stage_command_seconds", "Time spent in remote commands",
+     lambda stage: stage["command_time"]),
+    ("eom_stage_expect_wait_seconds",
+     "Time remote commands spent waiting for output",
+     lambda stage: stage["expect_wait"]),
+    ("eom_stage_output_bytes", "Bytes of output read from remote commands",
+     lambda stage: stage["bytes"]),
+    ]
+
+
+def prom_text(summaries):
+    '''
+    The run summaries in the Prometheus text exposition format, labelled
+    with the environment (and stage)
+    '''
+    lines = []
+    for name, help, value in PROM_RUN:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s gauge" % name)
+        for run in summaries:
+            lines.append('%s{env="%s"} %s' % (name, _label(run["env"]),
+                                              repr(float(value(run)))))
+    for name, help, value in PROM_STAGE:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s gauge" % name)
+        for run in summaries:
+            for stage in run["stages"]:
+                if stage["start"] is None:
+                    continue        # skipped or completed in an earlier run
+                lines.append('%s{env="%s",stage="%s"} %s' %
+                             (name, _label(run["env"]), _label(stage["name"]),
+                              repr(float(value(stage)))))
+    return "\n".join(lines) + "\n"
+
+
+def write_prom(summaries, path):
+    _write_atomic(path, prom_text(summaries).encode("utf-8"))
+
+
+def _write_atomic(path, data):
+    '''
+    Write data to path by way of a temporary file and a rename, so a reader
+    (the textfile collector) never sees half of it
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.rename(tmp, path)
@@ -69,6 +69,8 @@ try:
     import select
     import string
     import re
+    import sre_parse
+    import sre_constants
     import struct
     import resource
     import types
@@ -317,6 +319,22 @@ class spawn (object):
         effect the size of the incomming data buffer. You will still have
         access to the full buffer after expect() returns.
 
+        The maxmatchlen attribute is the length of the longest match any of
+        the regular expressions given to expect() can make. Patterns with a
+        bounded length (no *, + or {n,}) work this out for themselves, so
+        after each read only the last few bytes of the old data and the new
+        data are searched again. Set maxmatchlen for unbounded patterns, the
+        default of None searches them from the start of the buffer every time.
+
+        The capture attribute, when set, is an object that gets everything
+        read from the child. It needs write(data), tell() (total bytes
+        written), span(start, end) and a ring_size attribute. With a capture
+        set, expect() drops data from the front of its buffer once the
+        searcher can no longer need it, so 'before' holds at most the last
+        2 * ring_size bytes of output. The whole of it is in 'before_span',
+        which is capture.span() of the range 'before' covers. See
+        transcript.Transcript for a capture that spills to disk.
+
         The logfile member turns on or off logging. All input and output will
         be copied to the given file object. Set logfile to None to stop
         logging. This is the default. Set logfile to sys.stdout to echo
@@ -388,6 +406,10 @@ class spawn (object):
         self.after = None
         self.match = None
         self.match_index = None
+        self.capture = None # Gets a copy of everything read, see below.
+        self.before_span = None # The 'before' text in the capture.
+        self.read_wait = 0.0 # Seconds spent waiting in select() for output.
+        self.bytes_read = 0 # Bytes read from the child.
         self.terminated = True
         self.exitstatus = None
         self.signalstatus = None
@@ -403,6 +425,7 @@ class spawn (object):
         self.maxread = maxread # max bytes to read at one time into buffer
         self.buffer = '' # This is the read buffer. See maxread.
         self.searchwindowsize = searchwindowsize # Anything before searchwindowsize point is preserved, but not searched.
+        self.maxmatchlen = None # Longest possible regex match, bounds how much old data gets searched again.
         # Most Linux machines don't like delaybeforesend to be below 0.03 (30 ms).
         self.delaybeforesend = 0.05 # Sets sleep time used just before sending data to child. Time in seconds.
         self.delayafterclose = 0.1 # Sets delay in close() method to allow kernel time to update process status. Time in seconds.
@@ -476,6 +499,7 @@ class spawn (object):
         s.append('maxread: ' + str(self.maxread))
         s.append('ignorecase: ' + str(self.ignorecase))
         s.append('searchwindowsize: ' + str(self.searchwindowsize))
+        s.append('maxmatchlen: ' + str(self.maxmatchlen))
         s.append('delaybeforesend: ' + str(self.delaybeforesend))
         s.append('delayafterclose: ' + str(self.delayafterclose))
         s.append('delayafterterminate: ' + str(self.delayafterterminate))
@@ -813,7 +837,9 @@ class spawn (object):
                 self.flag_eof = True
                 raise EOF ('End Of File (EOF) in read_nonblocking(). Pokey platform.')
 
+        wait_start = time.time()
         r,w,e = self.__select([self.child_fd], [], [], timeout)
+        self.read_wait += time.time() - wait_start
 
         if not r:
             if not self.isalive():
@@ -840,6 +866,9 @@ class spawn (object):
             if self.logfile_read is not None:
                 self.logfile_read.write (s)
                 self.logfile_read.flush()
+            if self.capture is not None:
+                self.capture.write (s)
+            self.bytes_read += len(s)
 
             return s
 
@@ -1231,7 +1260,7 @@ class spawn (object):
 
         return compiled_pattern_list
 
-    def expect(self, pattern, timeout = -1, searchwindowsize=None):
+    def expect(self, pattern, timeout = -1, searchwindowsize=None, maxmatchlen = -1):
 
         """This seeks through the stream until a pattern is matched. The
         pattern is overloaded and may take several types. The pattern can be a
@@ -1309,9 +1338,9 @@ class spawn (object):
         """
 
         compiled_pattern_list = self.compile_pattern_list(pattern)
-        return self.expect_list(compiled_pattern_list, timeout, searchwindowsize)
+        return self.expect_list(compiled_pattern_list, timeout, searchwindowsize, maxmatchlen)
 
-    def expect_list(self, pattern_list, timeout = -1, searchwindowsize = -1):
+    def expect_list(self, pattern_list, timeout = -1, searchwindowsize = -1, maxmatchlen = -1):
 
         """This takes a list of compiled regular expressions and returns the
         index into the pattern_list that matched the child output. The list may
@@ -1321,9 +1350,12 @@ class spawn (object):
         may help if you are trying to optimize for speed, otherwise just use
         the expect() method.  This is called by expect(). If timeout==-1 then
         the self.timeout value is used. If searchwindowsize==-1 then the
-        self.searchwindowsize value is used. """
+        self.searchwindowsize value is used. If maxmatchlen==-1 then the
+        self.maxmatchlen value is used. """
 
-        return self.expect_loop(searcher_re(pattern_list), timeout, searchwindowsize)
+        if maxmatchlen == -1:
+            maxmatchlen = self.maxmatchlen
+        return self.expect_loop(searcher_re(pattern_list, maxmatchlen), timeout, searchwindowsize)
 
     def expect_exact(self, pattern_list, timeout = -1, searchwindowsize = -1):
 
@@ -1360,31 +1392,53 @@ class spawn (object):
         if searchwindowsize == -1:
             searchwindowsize = self.searchwindowsize
 
+        # A bytearray grows in place, adding each read to a string would
+        # copy everything read so far every time.
+        incoming = bytearray(self.buffer)
+        capture = self.capture
+        self.before_span = None
+        if capture is not None:
+            # Everything in incoming was read after everything before it, so
+            # incoming is always the tail of the capture.
+            origin = max(0, capture.tell() - len(incoming))
+            keep = getattr(searcher, 'lookback', None)
+            if searchwindowsize is not None:
+                keep = min(keep, searchwindowsize) if keep is not None else searchwindowsize
+            if keep is not None:
+                keep = max(keep, capture.ring_size)
         try:
-            incoming = self.buffer
             freshlen = len(incoming)
             while True: # Keep reading until exception or return.
                 index = searcher.search(incoming, freshlen, searchwindowsize)
                 if index >= 0:
-                    self.buffer = incoming[searcher.end : ]
-                    self.before = incoming[ : searcher.start]
-                    self.after = incoming[searcher.start : searcher.end]
+                    if capture is not None:
+                        self.before_span = capture.span(origin,
+                            capture.tell() - len(incoming) + searcher.start)
+                    self.buffer = str(incoming[searcher.end : ])
+                    self.before = str(incoming[ : searcher.start])
+                    self.after = str(incoming[searcher.start : searcher.end])
                     self.match = searcher.match
                     self.match_index = index
                     return self.match_index
                 # No match at this point
+                if capture is not None and keep is not None and len(incoming) > 2 * keep:
+                    # The capture has it all, only keep what the searcher
+                    # may still look at and the ring.
+                    del incoming[ : len(incoming) - keep]
                 if timeout < 0 and timeout is not None:
                     raise TIMEOUT ('Timeout exceeded in expect_any().')
                 # Still have time left, so read more data
                 c = self.read_nonblocking (self.maxread, timeout)
                 freshlen = len(c)
                 time.sleep (0.0001)
-                incoming = incoming + c
+                incoming.extend(c)
                 if timeout is not None:
                     timeout = end_time - time.time()
         except EOF, e:
+            if capture is not None:
+                self.before_span = capture.span(origin, capture.tell())
             self.buffer = ''
-            self.before = incoming
+            self.before = str(incoming)
             self.after = EOF
             index = searcher.eof_index
             if index >= 0:
@@ -1396,8 +1450,10 @@ class spawn (object):
                 self.match_index = None
                 raise EOF (str(e) + '\n' + str(self))
         except TIMEOUT, e:
-            self.buffer = incoming
-            self.before = incoming
+            if capture is not None:
+                self.before_span = capture.span(origin, capture.tell())
+            self.buffer = str(incoming)
+            self.before = self.buffer
             self.after = TIMEOUT
             index = searcher.timeout_index
             if index >= 0:
@@ -1409,7 +1465,7 @@ class spawn (object):
                 self.match_index = None
                 raise TIMEOUT (str(e) + '\n' + str(self))
         except:
-            self.before = incoming
+            self.before = str(incoming)
             self.after = None
             self.match = None
             self.match_index = None
@@ -1579,6 +1635,75 @@ class spawn (object):
 # End of spawn class
 ##############################################################################
 
+class _automaton (object):
+
+    """This is an Aho-Corasick automaton built from a list of (index, string)
+    pairs. It finds every occurence of every string in a single pass over the
+    input, and the pass can be suspended and resumed with more input because
+    all of the scanning state is a single integer. Use _compile_strings() to
+    get one, the automatons are cached by the tuple of strings.
+
+    Attributes:
+
+        goto     - per state, dict of character -> next state
+        fail     - per state, the state for the longest proper suffix
+        out      - per state, tuple of the (index, string) pairs that end here
+        first    - regular expression matching the first character of any
+                   string, used to skip ahead while in the root state
+        maxlen   - length of the longest string
+    """
+
+    def __init__(self, strings):
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        self.maxlen = 0
+        for n, s in strings:
+            state = 0
+            for c in s:
+                nextstate = self.goto[state].get(c)
+                if nextstate is None:
+                    nextstate = len(self.goto)
+                    self.goto[state][c] = nextstate
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = nextstate
+            self.out[state] = self.out[state] + ((n, s),)
+            self.maxlen = max(self.maxlen, len(s))
+        # Breadth first, so the fail state of a state is always done first.
+        queue = self.goto[0].values()
+        while queue:
+            state = queue.pop(0)
+            for c, nextstate in self.goto[state].iteritems():
+                queue.append(nextstate)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                self.fail[nextstate] = f
+                self.out[nextstate] = self.out[nextstate] + self.out[f]
+        if self.goto[0]:
+            self.first = re.compile('|'.join([re.escape(c) for c in self.goto[0]]))
+        else:
+            self.first = None
+
+_automaton_cache = {}
+
+def _compile_strings(strings):
+
+    """This returns the (cached) _automaton for a tuple of (index, string)
+    pairs. expect_exact() is usually called with the same few prompts over and
+    over, so they are only compiled once. """
+
+    ac = _automaton_cache.get(strings)
+    if ac is None:
+        if len(_automaton_cache) >= 100:
+            _automaton_cache.clear()
+        ac = _automaton_cache[strings] = _automaton(strings)
+    return ac
+
 class searcher_string (object):
 
     """This is a plain string search helper for the spawn.expect_any() method.
@@ -1588,6 +1713,8 @@ class searcher_string (object):
         eof_index     - index of EOF, or -1
         timeout_index - index of TIMEOUT, or -1
 
+        lookback      - bytes before the fresh data a search may look at
+
     After a successful match by the search() method the following attributes
     are available:
 
@@ -1612,6 +1739,20 @@ class searcher_string (object):
                 self.timeout_index = n
                 continue
             self._strings.append((n, s))
+        # The empty string is found wherever the search starts, keep it out of
+        # the automaton and only remember the first one.
+        self._empty_index = None
+        for n, s in self._strings:
+            if not s:
+                self._empty_index = n
+                break
+        self._automaton = _compile_strings(tuple([(n, s) for n, s in self._strings if s]))
+        # Bytes before the fresh data a search may need to look at again.
+        self.lookback = self._automaton.maxlen
+        # Scanning state carried between calls to search(): the automaton
+        # state after the last byte seen and how much of the buffer that was.
+        self._state = 0
+        self._scanned = 0
 
     def __str__(self):
 
@@ -1637,40 +1778,79 @@ class searcher_string (object):
 
         See class spawn for the 'searchwindowsize' argument.
 
+        All the strings are searched for at once with an Aho-Corasick
+        automaton. When 'buffer' is the buffer of the previous call with the
+        fresh data appended (as it is in expect_loop()), the scan picks up
+        where the last one stopped, so every byte is looked at only once no
+        matter how many strings there are.
+
         If there is a match this returns the index of that string, and sets
         'start', 'end' and 'match'. Otherwise, this returns -1. """
 
-        absurd_match = len(buffer)
-        first_match = absurd_match
-
-        # 'freshlen' helps a lot here. Further optimizations could
-        # possibly include:
-        #
-        # using something like the Boyer-Moore Fast String Searching
-        # Algorithm; pre-compiling the search through a list of
-        # strings into something that can scan the input once to
-        # search for all N strings; realize that if we search for
-        # ['bar', 'baz'] and the input is '...foo' we need not bother
-        # rescanning until we've read three more bytes.
-        #
-        # Sadly, I don't know enough about this interesting topic. /grahn
-
-        for index, s in self._strings:
+        ac = self._automaton
+        goto, fail, out, first = ac.goto, ac.fail, ac.out, ac.first
+        buflen = len(buffer)
+        pos = buflen - freshlen
+        if pos != self._scanned:
+            # Not the buffer we saw last time, start over. A match ending in
+            # the fresh data can start up to maxlen-1 bytes before it.
+            self._state = 0
+            pos = max(0, pos - ac.maxlen + 1)
+        state = self._state
+        if searchwindowsize is None:
+            window = 0
+        else:
+            # better obey searchwindowsize
+            window = max(0, buflen - searchwindowsize)
+            if pos < window:
+                state = 0
+                pos = window
+
+        # best is (start, index, string) of the leftmost match so far, ties
+        # go to the string that came first in the list.
+        best = None
+        limit = buflen
+        if self._empty_index is not None:
             if searchwindowsize is None:
-                # the match, if any, can only be in the fresh data,
-                # or at the very end of the old data
-                offset = -(freshlen+len(s))
+                best = (max(0, buflen - freshlen), self._empty_index, '')
             else:
-                # better obey searchwindowsize
-                offset = -searchwindowsize
-            n = buffer.find(s, offset)
-            if n >= 0 and n < first_match:
-                first_match = n
-                best_index, best_match = index, s
-        if first_match == absurd_match:
+                best = (window, self._empty_index, '')
+            limit = min(limit, best[0] + ac.maxlen)
+        if first is None:
+            pos = limit
+        if isinstance(buffer, bytearray):
+            # only the part still to be scanned is needed as a string
+            text, base = str(buffer[pos:limit]), pos
+        else:
+            text, base = buffer, 0
+        while pos < limit:
+            if not state:
+                m = first.search(text, pos - base, limit - base)
+                if m is None:
+                    pos = limit
+                    break
+                pos = m.start() + base
+            c = text[pos - base]
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            pos = pos + 1
+            if out[state]:
+                for n, s in out[state]:
+                    start = pos - len(s)
+                    if start < window:
+                        continue
+                    if best is None or (start, n) < best[:2]:
+                        best = (start, n, s)
+                if best is not None:
+                    # a longer string ending further on could still start
+                    # before this one
+                    limit = min(limit, best[0] + ac.maxlen)
+        self._state = state
+        self._scanned = pos
+        if best is None:
             return -1
-        self.match = best_match
-        self.start = first_match
+        self.start, best_index, self.match = best
         self.end = self.start + len(self.match)
         return best_index
 
@@ -1683,6 +1863,8 @@ class searcher_re (object):
 
         eof_index     - index of EOF, or -1
         timeout_index - index of TIMEOUT, or -1
+        lookback      - bytes before the fresh data a search may look at,
+                        or None for all of them
 
     After a successful match by the search() method the following attributes
     are available:
@@ -1693,15 +1875,18 @@ class searcher_re (object):
 
     """
 
-    def __init__(self, patterns):
+    def __init__(self, patterns, maxmatchlen=None):
 
         """This creates an instance that searches for 'patterns' Where
         'patterns' may be a list or other sequence of compiled regular
-        expressions, or the EOF or TIMEOUT types."""
+        expressions, or the EOF or TIMEOUT types. 'maxmatchlen', if given, is
+        the length of the longest match any of the patterns can make; see
+        class spawn."""
 
         self.eof_index = -1
         self.timeout_index = -1
         self._searches = []
+        self._widths = []
         for n, s in zip(range(len(patterns)), patterns):
             if s is EOF:
                 self.eof_index = n
@@ -1710,6 +1895,19 @@ class searcher_re (object):
                 self.timeout_index = n
                 continue
             self._searches.append((n, s))
+            width = _maxwidth(s)
+            if maxmatchlen is not None:
+                if width is None:
+                    width = maxmatchlen
+                else:
+                    width = min(width, maxmatchlen)
+            self._widths.append(width)
+        # Bytes before the fresh data a search may need to look at again,
+        # None if any of the patterns may need all of them.
+        if None in self._widths:
+            self.lookback = None
+        else:
+            self.lookback = max([0] + self._widths)
 
     def __str__(self):
 
@@ -1734,18 +1932,28 @@ class searcher_re (object):
 
         See class spawn for the 'searchwindowsize' argument.
 
-        If there is a match this returns the index of that string, and sets
-        'start', 'end' and 'match'. Otherwise, returns -1."""
+        The old data has been searched already without a match, so a new match
+        has to end in the fresh data. A pattern whose longest match is known
+        is only searched again from that many bytes before the fresh data;
+        one that is unbounded is searched from the start of the buffer.
 
-        absurd_match = len(buffer)
+        'buffer' may be a string or a bytearray. If there is a match this
+        returns the index of that string, and sets 'start', 'end' and 'match'
+        ('match' is always a match on a string). Otherwise, returns -1."""
+
+        buflen = len(buffer)
+        absurd_match = buflen
         first_match = absurd_match
-        # 'freshlen' doesn't help here -- we cannot predict the
-        # length of a match, and the re module provides no help.
         if searchwindowsize is None:
-            searchstart = 0
+            window = 0
         else:
-            searchstart = max(0, len(buffer)-searchwindowsize)
-        for index, s in self._searches:
+            window = max(0, buflen-searchwindowsize)
+        oldlen = buflen - freshlen
+        for (index, s), width in zip(self._searches, self._widths):
+            if width is None:
+                searchstart = window
+            else:
+                searchstart = max(window, oldlen - width)
             match = s.search(buffer, searchstart)
             if match is None:
                 continue
@@ -1756,11 +1964,52 @@ class searcher_re (object):
                 best_index = index
         if first_match == absurd_match:
             return -1
+        if not isinstance(buffer, basestring):
+            # Matching a bytearray gives bytearray groups, redo the match on
+            # a string. It starts at the same place so it is the same match.
+            the_match = the_match.re.match(str(buffer), first_match)
         self.start = first_match
         self.match = the_match
         self.end = self.match.end()
         return best_index
 
+def _maxwidth(pattern):
+
+    """This returns the length of the longest string the compiled regular
+    expression 'pattern' can match, or None if there is no limit or it can't
+    be worked out. A lookahead or a back reference makes a match depend on
+    more than the text it covers, those count as no limit. """
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (sre_constants.error, AttributeError, TypeError):
+        return None
+    if _needs_context(parsed):
+        return None
+    width = parsed.getwidth()[1]
+    if width >= sre_constants.MAXREPEAT:
+        return None
+    return int(width)
+
+def _needs_context(node):
+
+    """This returns True if the parsed regular expression 'node' has a
+    lookahead or a back reference anywhere in it. """
+
+    if isinstance(node, sre_parse.SubPattern):
+        for op, av in node.data:
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                return True
+            if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT) and av[0] >= 0:
+                return True
+            if _needs_context(av):
+                return True
+    elif isinstance(node, (tuple, list)):
+        for item in node:
+            if _needs_context(item):
+                return True
+    return False
+
 def which (filename):
 
     """This takes a given filename; tries to find it in the environment path;
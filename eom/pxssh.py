@@ -99,6 +99,9 @@ class pxssh (spawn):
         # disable only SSH_ASKPASS without also disabling X11 forwarding.
         # Unsetting SSH_ASKPASS on the remote side doesn't disable it! Annoying!
         self.SSH_OPTS = "-x -o'RSAAuthentication=no' -o 'PubkeyAuthentication=no'"
+        # extra options added to every ssh command line, i.e. connection
+        # multiplexing (ControlMaster) options
+        self.SSH_EXTRA_OPTS = ""
         self.force_password = False
         self.auto_prompt_reset = True
 
@@ -216,6 +219,8 @@ class pxssh (spawn):
         ssh_options = '-q'
         if self.force_password:
             ssh_options = ssh_options + ' ' + self.SSH_OPTS
+        if self.SSH_EXTRA_OPTS:
+            ssh_options = ssh_options + ' ' + self.SSH_EXTRA_OPTS
         if port is not None:
             ssh_options = ssh_options + ' -p %s'%(str(port))
         cmd = "ssh %s -l %s %s" % (ssh_options, username, server)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+readiness -- poll an environment until it is ready instead of sleeping
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+A probe answers one question, "is it ready yet?".  wait_until() keeps asking
+with an exponential backoff between attempts until the probe says yes or the
+deadline passes, so a stage can move on as soon as the environment is ready
+and never waits longer than the fixed sleep it replaces.
+'''
+import time
+import logging
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-22'
+__updated__ = '2014-08-22'
+
+PROBE_TO = 120              # time to wait for a single probe command
+FIRST_INTERVAL = 5.0        # seconds between the first and second attempt
+BACKOFF = 2.0               # interval multiplier after each failed attempt
+MAX_INTERVAL = 60.0         # never wait longer than this between attempts
+MIN_ATTEMPT = 1.0           # give up rather than try with less time left
+
+log = logging.getLogger('env-o-matic (%s)' % __name__)
+
+
+class Probe(object):
+    """
+    Base class, sub classes implement ready() which returns True once the
+    thing being probed is ready
+    """
+    def __init__(self, description, to=PROBE_TO):
+        self.description = description
+        self.to = to
+
+    def ready(self, to=None):
+        """
+        to, if given, is the most the attempt may take, it cuts down the
+        probe's own timeout
+        """
+        raise NotImplementedError
+
+    def timeout(self, to=None):
+        if to is None:
+            return self.to
+        return min(self.to, to)
+
+    def __str__(self):
+        return self.description
+
+
+class CommandProbe(Probe):
+    """
+    Ready when a command run in the (jiralab.CliHelper) session ses exits
+    with the expected status
+    """
+    def __init__(self, ses, cmd, status=0, to=PROBE_TO):
+        Probe.__init__(self, "exit status %d from '%s'" % (status, cmd), to)
+        self.ses = ses
+        self.cmd = cmd
+        self.status = status
+
+    def ready(self, to=None):
+        ses = self.ses
+        # the echoed command line has "$?" where the answer has digits
+        rval = ses.docmd("%s >/dev/null 2>&1; echo EOMRC=$?" % self.cmd,
+                         ["EOMRC=[0-9]+\s"], timeout=self.timeout(to))
+        if rval != 1:
+            _interrupt(ses)
+            return False
+        return int(ses.after.split("=")[1]) == self.status
+
+
+class AllProbe(Probe):
+    """
+    Ready when every one of probes is, a probe that was ready once isn't
+    asked again
+    """
+    def __init__(self, probes, description):
+        Probe.__init__(self, description, max([probe.to for probe in probes]
+                                              or [PROBE_TO]))
+        self.pending = list(probes)
+
+    def ready(self, to=None):
+        end_time = None if to is None else time.time() + to
+        for probe in list(self.pending):
+            if end_time is None:
+                left = None
+            else:
+                left = end_time - time.time()
+                if left <= 0:
+                    return False
+            if probe.ready(left):
+                self.pending.remove(probe)
+        return not self.pending
+
+    def __str__(self):
+        return "%s (%d to go)" % (self.description, len(self.pending))
+
+
+def _interrupt(ses):
+    # a command that timed out is still running, get the shell back to the
+    # prompt before the next attempt sends another one
+    try:
+        ses.session.sendintr()
+        ses.session.prompt(timeout=5)
+    except Exception:
+        pass
+
+
+def wait_until(probe, deadline, log=log, name=None,
+               interval=FIRST_INTERVAL, backoff=BACKOFF,
+               max_interval=MAX_INTERVAL):
+    """
+    Run probe until it is ready or deadline seconds have passed, sleeping
+    interval seconds after the first failed attempt, then backoff times
+    longer after each one after that (at most max_interval).
+    No attempt is allowed to run past the deadline.
+    Returns True if the probe became ready, False if the deadline passed.
+    """
+    start = time.time()
+    end_time = start + deadline
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if probe.ready(end_time - time.time()):
+                log.info("eom.ready:(%s) %s after %d attempt(s), %.0f sec" %
+                         (name, probe, attempt, time.time() - start))
+                return True
+        except Exception, e:
+            log.debug("eom.probeerr:(%s) %s: %s" % (name, probe, e))
+        remaining = end_time - time.time()
+        if remaining < MIN_ATTEMPT:
+            log.warn("eom.notready:(%s) gave up on %s after %d attempt(s),"
+                     " %.0f sec" % (name, probe, attempt, time.time() - start))
+            return False
+        log.debug("eom.probewait:(%s) %s not ready, next try in %.0f sec" %
+                  (name, probe, min(interval, remaining - MIN_ATTEMPT)))
+        time.sleep(min(interval, remaining - MIN_ATTEMPT))
+        interval = min(interval * backoff, max_interval)
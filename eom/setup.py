@@ -9,7 +9,8 @@ setup(
     packages = find_packages(),
     py_modules = ['ez_setup','proproj','jcomment','eom','dbgen','jclose',
                   'aes','jiralab','eom_init','mylog','pexpect','pxssh',
-                  'jcontent'],
+                  'jcontent','stagesched','readiness','transcript','asyncpex',
+                  'journal','metrics'],
     install_requires = ['jira_python>=0.13', 'PyYAML'],
 
     # metadata for upload to PyPI
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+stagesched -- dependency-graph scheduler for the eom stages
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+Every stage declares the stages it depends on (and optionally the shared
+resources it needs exclusive use of, like the reg server shell).  Stages whose
+dependencies are complete are handed to a bounded pool of worker threads, so
+independent stages run side by side instead of waiting in line.  When the run
+is over the scheduler can report the critical path, the chain of stages that
+actually gated the finish time.
+
+Stages can share a worker slot (overlap): the re-image and the db creation
+are mostly spent waiting on remote commands and always ran side by side, they
+still do with a single worker.
+
+Stages can be put in groups (eom --batch makes a group of the stages of each
+environment).  The number of stages running per group and the number of
+groups in progress at once can both be limited, and a failing stage can be
+made to only take down the rest of its own group.
+
+Stages that completed in an earlier run (eom --resume) can be marked done
+before the run starts, only the stages depending on what is left are run.
+
+Stage times are taken from a monotonic clock, current_stage() tells the code
+a stage calls which stage it is running for (eom.execute() uses it to add
+the commands it runs to the figures of the stage, see metrics).
+'''
+import sys
+import time
+import threading
+import Queue
+import logging
+from metrics import monotonic
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-20'
+__updated__ = '2014-09-02'
+
+STAGE_WORKERS = 4           # default number of stages allowed to run at once
+POLL_INTERVAL = 1.0         # keep the dispatcher responsive to ^C
+
+# Stage states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"         # not run because an earlier stage in its group failed
+
+log = logging.getLogger('env-o-matic (%s)' % __name__)
+
+_current = threading.local()  # the stage a worker thread is running
+
+# Specialized Exceptions
+class STAGESCHED_GraphError(ValueError): pass
+
+
+class Stage(object):
+    """
+    Book keeping for a single schedulable stage
+    """
+    def __init__(self, name, func, seq=0, depends=(), uses=(), group=None,
+                 overlap=None):
+        self.name = name
+        self.func = func
+        self.seq = seq
+        self.group = group
+        self.overlap = overlap      # stages with the same overlap share a slot
+        self.depends = tuple(depends)
+        self.uses = tuple(sorted(uses))
+        self.state = PENDING
+        self.rval = None
+        self.exc_info = None
+        self.ready_time = None      # all dependencies satisfied
+        self.start_time = None      # picked up by a worker
+        self.end_time = None
+        self.resumed = False        # completed in an earlier run
+        self.execs = []             # remote commands run, see metrics
+
+    @property
+    def slot(self):
+        """
+        The worker slot the stage takes, shared by the running stages of its
+        group with the same overlap
+        """
+        if self.overlap is None:
+            return self.name
+        return (self.group, self.overlap)
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+def current_stage():
+    """
+    The Stage the calling thread is running, None outside of a stage
+    """
+    return getattr(_current, "stage", None)
+
+
+class StageScheduler(object):
+    """
+    Run a graph of stages on a bounded pool of worker threads.
+    A stage is dispatched once every stage it depends on is DONE and none of
+    the resources it uses is held by a running stage.  When several stages are
+    ready at once they are dispatched in order of their sequence number.
+    Stages with the same overlap (in the same group) count as one towards the
+    limits, so a scheduler with a single worker runs the stages in sequence
+    order except for those, which run side by side, as in the old eom where
+    the re-image and the db creation were threads of their own.
+    group_workers - max stages of one group running at once (None, no limit)
+    max_groups    - max groups in progress at once, groups are started in the
+                    order they were added (None, no limit)
+    isolate_groups- when a stage in a group fails, skip the rest of that
+                    group and carry on with the others instead of raising
+    on_group_done - called with (group, failed) as each group finishes
+    on_stage_done - called with the stage as each stage completes, in the
+                    scheduler's thread
+    """
+    def __init__(self, log=log, max_workers=STAGE_WORKERS, group_workers=None,
+                 max_groups=None, isolate_groups=False):
+        self.log = log
+        self.max_workers = max(1, int(max_workers))
+        self.group_workers = group_workers
+        self.max_groups = max_groups
+        self.isolate_groups = isolate_groups
+        self.on_group_done = None
+        self.on_stage_done = None
+        self.stages = {}
+        self.groups = []            # in the order they were added
+        self.failures = {}          # group -> exc_info of its failed stage
+        self.start_time = None      # monotonic
+        self.end_time = None
+        self.started_at = None      # time.time() of the start
+        self.worker_idle = {}       # worker thread -> sec waiting for work
+
+    def add_stage(self, name, func, seq=0, depends=(), uses=(), group=None,
+                  overlap=None):
+        if name in self.stages:
+            raise STAGESCHED_GraphError("stage %s scheduled twice" % name)
+        if group is not None and group not in self.groups:
+            self.groups.append(group)
+        self.stages[name] = Stage(name, func, seq, depends, uses, group,
+                                  overlap)
+        return self.stages[name]
+
+    def add_stages(self, obj, group=None):
+        """
+        Schedule every method of obj that was decorated with a sequence
+        number (see eom.assignSequence).  With a group the stage names,
+        their dependencies and the resources they use are all prefixed with
+        "group:", so several objects of the same class can be scheduled
+        side by side.
+        """
+        prefix = "" if group is None else "%s:" % group
+        for field in dir(obj):
+            func = getattr(obj, field)
+            if hasattr(func, "seq"):
+                self.add_stage(prefix + field, func, func.seq,
+                               [prefix + dep for dep in
+                                getattr(func, "depends", ())],
+                               [prefix + res for res in
+                                getattr(func, "uses", ())],
+                               group, getattr(func, "overlap", None))
+
+    def mark_done(self, name):
+        """
+        Mark a stage that completed in an earlier run as done, it isn't run
+        again and the stages depending on it don't wait for it
+        """
+        stage = self.stages[name]
+        stage.state = DONE
+        stage.resumed = True
+        return stage
+
+    def validate(self):
+        """
+        Make sure every dependency exists and that the graph has no cycles
+        """
+        for stage in self.stages.itervalues():
+            for dep in stage.depends:
+                if dep not in self.stages:
+                    raise STAGESCHED_GraphError(
+                        "stage %s depends on unknown stage %s" %
+                        (stage.name, dep))
+        indegree = dict((name, len(stage.depends))
+                        for name, stage in self.stages.iteritems())
+        ready = [name for name, deg in indegree.iteritems() if deg == 0]
+        visited = 0
+        while ready:
+            name = ready.pop()
+            visited += 1
+            for stage in self.stages.itervalues():
+                if name in stage.depends:
+                    indegree[stage.name] -= 1
+                    if indegree[stage.name] == 0:
+                        ready.append(stage.name)
+        if visited != len(self.stages):
+            cycle = sorted(name for name, deg in indegree.iteritems() if deg)
+            raise STAGESCHED_GraphError(
+                "dependency cycle between stages: %s" % ", ".join(cycle))
+
+    def _worker(self, work_q, done_q):
+        name = threading.current_thread().name
+        while True:
+            idle = monotonic()
+            stage = work_q.get()
+            self.worker_idle[name] = (self.worker_idle.get(name, 0.0) +
+                                      monotonic() - idle)
+            if stage is None:
+                return
+            _current.stage = stage
+            stage.start_time = monotonic()
+            try:
+                stage.rval = stage.func()
+            except BaseException:
+                stage.exc_info = sys.exc_info()
+            stage.end_time = monotonic()
+            _current.stage = None
+            done_q.put(stage)
+
+    def _ready(self, held):
+        now = monotonic()
+        ready = []
+        for stage in self.stages.itervalues():
+            if stage.state != PENDING:
+                continue
+            if not all(self.stages[dep].state == DONE for dep in stage.depends):
+                continue
+            if stage.ready_time is None:
+                stage.ready_time = now
+            if not held.intersection(stage.uses):
+                ready.append(stage)
+        order = dict((group, i) for i, group in enumerate(self.groups))
+        return sorted(ready, key=lambda stage: (order.get(stage.group, -1),
+                                                stage.seq, stage.name))
+
+    def _admits(self, stage, group_running, active):
+        """
+        True if the group limits allow stage to be started now
+        """
+        group = stage.group
+        if group is None:
+            return True
+        slots = group_running.get(group, ())
+        if (self.group_workers and stage.slot not in slots and
+                len(slots) >= self.group_workers):
+            return False
+        if (self.max_groups and group not in active and
+                len(active) >= self.max_groups):
+            return False
+        return True
+
+    def _group_finished(self, group):
+        return all(stage.state not in (PENDING, RUNNING)
+                   for stage in self.stages.itervalues()
+                   if stage.group == group)
+
+    def _fail_group(self, stage):
+        """
+        Record the failure of stage and skip what is left of its group
+        """
+        group = stage.group
+        exc_type, exc_value = stage.exc_info[:2]
+        self.log.error("eom.grpfail:(%s) stage %s failed: %s %s, skipping"
+                       " the rest of %s" % (group, stage.name,
+                       exc_type.__name__, exc_value, group))
+        self.failures.setdefault(group, stage.exc_info)
+        for other in self.stages.itervalues():
+            if other.group == group and other.state == PENDING:
+                other.state = SKIPPED
+
+    def run(self):
+        """
+        Run all the stages, returns when all of them are DONE.  If a stage
+        raises (this includes sys.exit()) no further stages are dispatched and
+        the exception is re-raised here, in the caller's thread.  With
+        isolate_groups only the rest of the failing stage's group is skipped
+        (a ^C still stops everything), see failures for what went wrong.
+        """
+        self.validate()
+        work_q = Queue.Queue()
+        done_q = Queue.Queue()
+        workers = []
+        # stages sharing a slot each still need a thread of their own
+        overlaps = {}
+        for stage in self.stages.itervalues():
+            if stage.overlap is not None:
+                overlaps[stage.slot] = overlaps.get(stage.slot, -1) + 1
+        for i in xrange(self.max_workers + sum(overlaps.itervalues())):
+            worker = threading.Thread(target=self._worker,
+                                      name="stage-worker-%d" % i,
+                                      args=(work_q, done_q))
+            # daemon so that an exit from the main thread isn't held up by
+            # a long running stage, same as the old reimage/dbgen threads
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        self.start_time = monotonic()
+        self.started_at = time.time()
+        held = set()
+        running = {}                # slot -> stages running in it
+        group_running = {}          # group -> set of its slots in use
+        active = set()
+        try:
+            while True:
+                for stage in self._ready(held):
+                    if (stage.slot not in running and
+                            len(running) >= self.max_workers):
+                        continue
+                    if held.intersection(stage.uses):
+                        continue
+                    if not self._admits(stage, group_running, active):
+                        continue
+                    stage.state = RUNNING
+                    held.update(stage.uses)
+                    running[stage.slot] = running.get(stage.slot, 0) + 1
+                    if stage.group is not None:
+                        group_running.setdefault(stage.group,
+                                                 set()).add(stage.slot)
+                        active.add(stage.group)
+                    work_q.put(stage)
+                if not running:
+                    break
+                try:
+                    stage = done_q.get(True, POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+                running[stage.slot] -= 1
+                if not running[stage.slot]:
+                    del running[stage.slot]
+                held.difference_update(stage.uses)
+                group = stage.group
+                if group is not None and stage.slot not in running:
+                    group_running[group].discard(stage.slot)
+                if stage.exc_info:
+                    stage.state = FAILED
+                    exc_type, exc_value, exc_tb = stage.exc_info
+                    if (not self.isolate_groups or group is None or
+                            issubclass(exc_type, KeyboardInterrupt)):
+                        raise exc_type, exc_value, exc_tb
+                    self._fail_group(stage)
+                else:
+                    stage.state = DONE
+                    if self.on_stage_done:
+                        self.on_stage_done(stage)
+                if group is not None and self._group_finished(group):
+                    active.discard(group)
+                    if self.on_group_done:
+                        self.on_group_done(group, group in self.failures)
+        finally:
+            self.end_time = monotonic()
+            for worker in workers:
+                work_q.put(None)
+            # let the idle workers wind down, don't wait on busy ones
+            for worker in workers:
+                worker.join(0.05)
+
+        stuck = [name for name, stage in self.stages.iteritems()
+                 if stage.state == PENDING]
+        if stuck:
+            raise STAGESCHED_GraphError("stages never became ready: %s" %
+                                        ", ".join(sorted(stuck)))
+
+    def critical_path(self, group=None):
+        """
+        Walk back from the last stage to finish, at each step following the
+        dependency that finished last, i.e. the one that actually held the
+        stage up.  Returns the list of stages, first to last.  With a group,
+        only the stages of that group are considered.
+        """
+        finished = [stage for stage in self.stages.itervalues()
+                    if stage.end_time is not None and
+                    (group is None or stage.group == group)]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda stage: stage.end_time)
+        path = [stage]
+        while True:
+            deps = [self.stages[dep] for dep in stage.depends
+                    if self.stages[dep].end_time is not None]
+            if not deps:
+                break
+            stage = max(deps, key=lambda dep: dep.end_time)
+            path.append(stage)
+        path.reverse()
+        return path
+
+    def report(self):
+        """
+        Log the time spent in each stage and the critical path of the run
+        """
+        log = self.log
+        if self.start_time is None:
+            return
+        end_time = self.end_time if self.end_time else monotonic()
+        for stage in sorted(self.stages.itervalues(),
+                            key=lambda stage: (stage.start_time is None,
+                                               stage.start_time, stage.seq)):
+            if stage.start_time is None:
+                log.info("eom.stgtime: %-24s %s" % (stage.name,
+                         "resumed" if stage.resumed else stage.state))
+                continue
+            log.info("eom.stgtime: %-24s %-8s start +%7.1fs wait %7.1fs"
+                     " run %7.1fs" %
+                     (stage.name, stage.state,
+                      stage.start_time - self.start_time,
+                      stage.start_time - (stage.ready_time or stage.start_time),
+                      stage.duration))
+        path = self.critical_path()
+        log.info("eom.critpath: %s" % " -> ".join(
+                 ["%s(%.1fs)" % (stage.name, stage.duration) for stage in path]))
+        log.info("eom.runtime: %.1f sec wall clock, %.1f sec on the critical"
+                 " path, %d worker(s)" %
+                 (end_time - self.start_time,
+                  sum(stage.duration for stage in path), self.max_workers))
+
+    def group_report(self):
+        """
+        Log one line per group (state, when it started, how long it took,
+        its critical path) and a summary of the whole run
+        """
+        log = self.log
+        if self.start_time is None or not self.groups:
+            return
+        end_time = self.end_time if self.end_time else monotonic()
+        counts = {}
+        for group in self.groups:
+            stages = [stage for stage in self.stages.itervalues()
+                      if stage.group == group]
+            started = [stage.start_time for stage in stages
+                       if stage.start_time is not None]
+            ended = [stage.end_time for stage in stages
+                     if stage.end_time is not None]
+            if group in self.failures:
+                state = FAILED
+            elif all(stage.state == DONE for stage in stages):
+                state = DONE
+            elif not started:
+                state = PENDING
+            else:
+                state = "incomplete"
+            counts[state] = counts.get(state, 0) + 1
+            if not started:
+                log.info("eom.grptime:(%s) %s" % (group, state))
+                continue
+            path = self.critical_path(group)
+            log.info("eom.grptime:(%s) %-10s start +%7.1fs elapsed %7.1fs"
+                     " %d/%d stages, critical path %s" %
+                     (group, state, min(started) - self.start_time,
+                      max(ended or [end_time]) - min(started),
+                      len([stage for stage in stages if stage.state == DONE]),
+                      len(stages),
+                      " -> ".join(["%s(%.1fs)" % (stage.name.split(":", 1)[-1],
+                                   stage.duration) for stage in path])))
+        log.info("eom.grpsum: %d group(s) in %.1f sec: %s" %
+                 (len(self.groups), end_time - self.start_time,
+                  ", ".join(["%d %s" % (counts[state], state)
+                             for state in sorted(counts)])))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python2.7
+"""
+Tests of asyncpex, run from this directory with
+
+    python -m unittest test_asyncpex
+"""
+import unittest
+
+import pexpect
+import asyncpex
+import transcript
+
+LINES = 2000
+
+
+def spawn(script):
+    child = pexpect.spawn("/bin/sh", ["-c", script], timeout=30)
+    child.setecho(False)
+    return child
+
+
+class LoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncpex.EventLoop()
+        self.children = []
+
+    def tearDown(self):
+        for child in self.children:
+            child.close(force=True)
+
+    def spawn(self, script, capture=None):
+        child = spawn(script)
+        child.capture = capture
+        self.children.append(child)
+        return asyncpex.AsyncSpawn(self.loop, child)
+
+    def test_several_children(self):
+        def count(aio, i):
+            yield aio.expect(r"READY-%d\r\n" % i)
+            aio.sendline("go")
+            index = yield aio.expect([r"DONE-(\d+)", pexpect.EOF])
+            raise asyncpex.Return((index, aio.child.match.group(1),
+                                   aio.child.before.count("\n")))
+
+        work = [ self.spawn("echo READY-%d; read x; seq 1 %d; echo DONE-%d"
+                            % (i, LINES * i, i)) for i in range(1, 6) ]
+        results = self.loop.run_until_complete(asyncpex.gather(self.loop,
+                    *[ count(aio, i) for i, aio in enumerate(work, 1) ]))
+        self.assertEqual(results, [ (0, str(i), LINES * i)
+                                    for i in range(1, 6) ])
+
+    def test_eof_and_timeout(self):
+        def run(aio, patterns, timeout):
+            index = yield aio.expect(patterns, timeout=timeout)
+            raise asyncpex.Return(index)
+
+        quick = self.spawn("echo bye")
+        slow = self.spawn("sleep 30")
+        results = self.loop.run_until_complete(asyncpex.gather(self.loop,
+                    run(quick, ["never", pexpect.EOF], 5),
+                    run(slow, ["never", pexpect.TIMEOUT], 0.5)))
+        self.assertEqual(results, [1, 1])
+        self.assertEqual(quick.child.before.strip(), "bye")
+
+    def test_capture_bounds_incoming(self):
+        capture = transcript.Transcript(ring_size=1024)
+        aio = self.spawn("seq 1 %d; read x; seq 1 %d; echo DONE" %
+                         (LINES * 10, LINES * 10), capture)
+        peak = [0]
+
+        def watch():
+            # the output before "read x" arrives with no expect() waiting
+            peak[0] = max(peak[0], len(aio._incoming))
+            self.loop.call_later(0.001, watch)
+
+        def run():
+            yield asyncpex.sleep(self.loop, 1)
+            aio.sendline("go")
+            yield aio.expect("DONE")
+        watch()
+        self.loop.run_until_complete(run())
+        output = "".join("%d\r\n" % n for n in range(1, LINES * 10 + 1))
+        self.assertTrue(peak[0] <= 2 * 1024 + aio.child.maxread, peak[0])
+        self.assertTrue(len(aio.child.before) < 4 * 1024)
+        self.assertTrue(aio.child.before_span.read().endswith(output))
+        self.assertTrue(len(aio.child.before_span) > len(output))
+
+    def test_no_capture_reads_only_when_waiting(self):
+        aio = self.spawn("echo one; sleep 0.2; echo two; read x")
+
+        def run():
+            yield aio.expect("one")
+            self.assertEqual(self.loop._readers, {})
+            yield asyncpex.sleep(self.loop, 0.5)
+            self.assertFalse("two" in aio._incoming)
+            yield aio.expect("two")
+        self.loop.run_until_complete(run())
+        aio.detach()
+        self.assertEqual(self.loop._readers, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
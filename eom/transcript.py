@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+transcript -- spill everything a pexpect session reads to disk
+@author:     geowhite
+@copyright:  2014 StubHub. All rights reserved.
+@license:    Apache License 2.0
+@contact:    geowhite@stubhub.com
+
+A Transcript is hung off a pexpect spawn as its capture (jiralab.CliHelper
+does this when asked to).  Everything read from the child is appended to an
+unlinked temporary file, and expect() only keeps a bounded ring of recent
+output in memory.  The output of a command is handed back as a Span, a range
+of the file that can be searched and read a line at a time through a memory
+map, so a 4800 second deploy never has to be held in memory as one string.
+'''
+import re
+import mmap
+import tempfile
+import logging
+
+__all__ = []
+__version__ = 1.0
+__date__ = '2014-08-27'
+__updated__ = '2014-08-27'
+
+RING_SIZE = 1024 * 1024     # recent output expect() keeps in memory
+
+log = logging.getLogger('env-o-matic (%s)' % __name__)
+
+
+class Transcript(object):
+    """
+    Append only record of a session's output, backed by a temporary file
+    that is gone as soon as it is closed (or the process exits)
+    """
+    def __init__(self, ring_size=RING_SIZE, dir=None):
+        self.ring_size = ring_size
+        self.file = tempfile.TemporaryFile(prefix="eom-transcript.", dir=dir)
+        self.size = 0
+        self._map = ""
+        self._mapped = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def tell(self):
+        return self.size
+
+    def mmap(self):
+        """
+        Read only memory map of everything written so far.  The map is
+        redone when more has been written, one that was handed out before
+        stays valid (it is unmapped when the last reference goes away).
+        """
+        if self._mapped != self.size:
+            self.file.flush()
+            self._map = mmap.mmap(self.file.fileno(), self.size,
+                                  access=mmap.ACCESS_READ)
+            self._mapped = self.size
+        return self._map
+
+    def span(self, start, end=None):
+        if end is None:
+            end = self.size
+        return Span(self, start, end)
+
+    def tail(self, size=None):
+        """
+        The last size bytes (default ring_size) as a string
+        """
+        if size is None:
+            size = self.ring_size
+        return self.span(max(0, self.size - size)).read()
+
+    def close(self):
+        self._map = ""
+        self._mapped = 0
+        self.file.close()
+
+
+class Span(object):
+    """
+    The range [start, end) of a Transcript.  Searches run over the memory
+    map, only lines and matches are turned into strings.  str() reads the
+    whole span, so only do that when it is known to be small.
+    """
+    def __init__(self, transcript, start, end):
+        self.transcript = transcript
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return self.read()
+
+    def __repr__(self):
+        return "<Span %d-%d of %r>" % (self.start, self.end, self.transcript)
+
+    def __contains__(self, sub):
+        return self.find(sub) >= 0
+
+    def read(self):
+        return self.transcript.mmap()[self.start:self.end]
+
+    def find(self, sub):
+        """
+        Offset of sub from the start of the span, or -1
+        """
+        n = self.transcript.mmap().find(sub, self.start, self.end)
+        if n < 0:
+            return -1
+        return n - self.start
+
+    def search(self, pattern, flags=0):
+        """
+        re.search() over the span.  The match positions are offsets into
+        the transcript, not the span.
+        """
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern, flags)
+        return pattern.search(self.transcript.mmap(), self.start, self.end)
+
+    def finditer(self, pattern, flags=0):
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern, flags)
+        return pattern.finditer(self.transcript.mmap(), self.start, self.end)
+
+    def lines(self, keepends=False):
+        """
+        Iterate over the lines of the span, splitting on "\\n" the way
+        str.split('\\n') does
+        """
+        mm = self.transcript.mmap()
+        pos = self.start
+        end = self.end
+        while True:
+            n = mm.find("\n", pos, end)
+            if n < 0:
+                if pos < end or not keepends:
+                    yield mm[pos:end]
+                return
+            yield mm[pos:n + 1] if keepends else mm[pos:n]
+            pos = n + 1
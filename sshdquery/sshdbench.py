@@ -0,0 +1,299 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark the sshdquery log parser on a synthetic sshd log.
+
+Writes --size MB of sshd log lines (sftp sessions with their connection,
+key, accept, child pid and disconnect messages, mixed in with the usual
+noise) unless --file is given, then runs it through scan_logs() with each
+number of --workers and, with --legacy, through the old parsing loop, and
+prints lines/sec for each and the peak RSS of the process so far (run one
+configuration at a time to compare memory use).
+
+With --cidrs it times isaVCRaddr() instead, against that many random VCR
+CIDR blocks, the linear scan it used to do against the CIDRIndex one
+address and a batch at a time.
+
+    sshdbench.py --size 2048 --legacy
+    sshdbench.py --size 8192 --workers 1 2 4 8
+    sshdbench.py --cidrs 5000 --addrs 100000
+"""
+import os
+import sys
+import re
+import time
+import argparse
+import random
+import resource
+import tempfile
+import datetime
+from itertools import tee, islice, izip_longest
+
+import sshdquery
+
+LOGLINES = [
+    "%(ts)s %(host)s sshd[%(ppid)d]: Connection from %(addr)s port %(port)d\n",
+    "%(ts)s %(host)s sshd[%(ppid)d]: Found matching RSA key: %(fp)s\n",
+    "%(ts)s %(host)s sshd[%(ppid)d]: Postponed publickey for %(user)s from"
+    " %(addr)s port %(port)d ssh2\n",
+    "%(ts)s %(host)s sshd[%(ppid)d]: Found matching RSA key: %(fp)s\n",
+    "%(ts)s %(host)s sshd[%(ppid)d]: Accepted publickey for %(user)s from"
+    " %(addr)s port %(port)d ssh2\n",
+    "%(ts)s %(host)s sshd[%(ppid)d]: User child is on pid %(pid)d\n",
+    "%(ts)s %(host)s sshd[%(pid)d]: subsystem request for sftp\n",
+    "%(ts)s %(host)s internal-sftp[%(cpid)d]: session opened for local user"
+    " %(user)s from [%(addr)s]\n",
+    "%(ts)s %(host)s internal-sftp[%(cpid)d]: open \"/upload/%(user)s.csv\""
+    " flags WRITE,CREATE,TRUNCATE mode 0644\n",
+    "%(ts)s %(host)s internal-sftp[%(cpid)d]: close \"/upload/%(user)s.csv\""
+    " bytes read 0 written 1048576\n",
+    "%(ts)s %(host)s sshd[%(pid)d]: Received disconnect from %(addr)s: 11:"
+    " disconnected by user\n",
+    "%(ts)s %(host)s sshd[%(pid)d]: Closing connection to %(addr)s port"
+    " %(port)d\n",
+    ]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def make_log(path, size_mb, hosts=8, users=500, addrs=2000):
+    """Write about size_mb megabytes of sshd sessions to path"""
+    size = int(size_mb * 1024 * 1024)
+    written = 0
+    n = 0
+    with open(path, "w") as f:
+        while written < size:
+            values = {
+                "ts": "%s %2d %02d:%02d:%02d" % (MONTHS[(n / 100000) % 12],
+                      1 + (n / 3600) % 28, (n / 60) % 24, n % 60,
+                      (n * 7) % 60),
+                "host": "sftp%02d.prod.corp.dc%d.example.com" % (
+                        n % hosts, n % 3),
+                "ppid": 1000 + n % 30000,
+                "pid": 40000 + n % 20000,
+                "cpid": 60000 + n % 5000,
+                "addr": "10.%d.%d.%d" % ((n / 65536) % 8,
+                        (n % addrs) / 256, (n % addrs) % 256),
+                "port": 1024 + n % 60000,
+                "user": "cust%04d" % (n % users),
+                "fp": ":".join(["%02x" % ((n % users) * 7 + i & 0xff)
+                                for i in range(16)]),
+                }
+            chunk = "".join([line % values for line in LOGLINES])
+            f.write(chunk)
+            written += len(chunk)
+            n += 1
+    return written
+
+
+def reset():
+    """Forget what an earlier scan found"""
+    sshdquery.SrcIPs.clear()
+    sshdquery.Durations.clear()
+    del sshdquery.IPvector[:]
+
+
+def legacy_scan(logfile):
+    """
+    The parsing loop sshdquery had before scan_logfile(): four matches of
+    the line regex per line, a look-ahead on the next line and a cascade
+    of substring tests, and strptime() for the durations.  Kept here to
+    measure against.
+    """
+    def get_duration(starttime, stoptime):
+        fmt = "%b %d %H:%M:%S"
+        duration = (datetime.datetime.strptime(stoptime, fmt) -
+                    datetime.datetime.strptime(starttime, fmt))
+        if duration.days < 0:
+            return "__:__:__"
+        return str(duration)
+
+    logentry = re.compile('(?P<ss_timestamp>'
+                          '[JFMAMSOND][a-z]{2}\s+\d{1,2}\s\d{2}\:\d{2}\:\d{2})'
+                         '\s(?P<ss_hostname>'
+                          '(([a-zA-Z0-9]+|[a-zA-Z0-9][a-zA-Z0-9\-]*'
+                          '[a-zA-Z0-9])\.)*'
+                          '([A-Za-z0-9]+|[A-Za-z0-9][A-Za-z0-9\-]*))'
+                          '\s(?P<ss_process>[a-zA-Z0-9\-\[\]]*\:\s)'
+                          '(?P<ss_message>.+$)'
+                          )
+    SrcIPs = sshdquery.SrcIPs
+    Durations = sshdquery.Durations
+    items, nexts = tee(logfile, 2)
+    nexts = islice(nexts, 1, None)
+    nlines = 0
+    for line, next_line in izip_longest(items, nexts):
+        nlines += 1
+        timestamp = logentry.match(line).group("ss_timestamp")
+        sshd_hostname = logentry.match(line).group("ss_hostname")
+        sshd_process = logentry.match(line).group("ss_process")
+        sshd_message = logentry.match(line).group("ss_message")
+        if "Connection from" in sshd_message:
+            _,_,addr,_,port = sshd_message.split()
+            if addr not in SrcIPs:
+                SrcIPs[addr] = sshdquery.SourceIP(
+                    "", {}, sshdquery.isaVCRaddr(addr), addr)
+                sshdquery.IPvector.append(addr)
+        elif "Found matching" in sshd_message:
+            _,_,_,_,keyfinger = sshd_message.split()
+        elif "Postponed publickey" in sshd_message:
+            _,_,_,userid_post,_,addr_post,_,port,_ = sshd_message.split()
+        elif "Accepted publickey" in sshd_message:
+            _,_,_,userid,_,addr,_,port,_ = sshd_message.split()
+            if next_line and "User child is on pid" in next_line:
+                session_pid = logentry.match(
+                    next_line).group("ss_message").split()[5]
+                Durations[session_pid+addr] = [addr,timestamp,"",""]
+            else:
+                session_pid = ""
+            dc = sshd_hostname.split('.')[3]
+            session = sshdquery.Session(dc, sshd_hostname, userid, keyfinger,
+                                        timestamp, addr, session_pid)
+            SrcIPs[addr].new_session(session)
+        elif ("Received disconnect" in sshd_message or
+              "Closing connection" in sshd_message):
+            addr = sshd_message.split()[3]
+            if "Received disconnect" in sshd_message:
+                addr = addr[:-1]
+            durkey = re.search(r"[0-9]+", sshd_process).group(0)+addr
+            if durkey in Durations:
+                Durations[durkey][2] = timestamp
+                Durations[durkey][3] = get_duration(Durations[durkey][1],
+                                                    Durations[durkey][2])
+    return nlines
+
+
+def legacy_isaVCRaddr(addr):
+    """isaVCRaddr() before CIDRIndex, a mask compare against every block"""
+    ipaddr = sshdquery.IPAddress(addr)
+    for ipnet in sshdquery.vcrcidrdb:
+        if ipaddr == ipnet.ip and (ipnet.netmask ==
+                                   sshdquery.IPAddress('255.255.255.255')):
+            return True
+        elif (ipaddr & ipnet.netmask) == ipnet.network:
+            return True
+    return False
+
+
+def bench_cidrs(ncidrs, naddrs):
+    """Time the VCR address check of naddrs addresses against ncidrs blocks"""
+    rand = random.Random(42)
+    del sshdquery.vcrcidrdb[:]
+    for n in xrange(ncidrs):
+        prefix = rand.choice([16, 20, 24, 24, 28, 32, 32, 32])
+        addr = rand.getrandbits(32) >> (32 - prefix) << (32 - prefix)
+        sshdquery.vcrcidrdb.append(sshdquery.IPNetwork(
+            "%s/%d" % (sshdquery.IPAddress(addr), prefix)))
+    sshdquery.vcrindex.load(sshdquery.vcrcidrdb)
+    # half of them picked from inside the blocks
+    addrs = []
+    for n in xrange(naddrs):
+        if n % 2:
+            ipnet = rand.choice(sshdquery.vcrcidrdb)
+            value = rand.randint(ipnet.first, ipnet.last)
+        else:
+            value = rand.getrandbits(32)
+        addrs.append(str(sshdquery.IPAddress(value)))
+
+    runs = [("legacy", lambda: [legacy_isaVCRaddr(addr) for addr in addrs]),
+            ("isaVCRaddr", lambda: [sshdquery.isaVCRaddr(addr)
+                                    for addr in addrs]),
+            ("isaVCRaddrs", lambda: sshdquery.isaVCRaddrs(addrs))]
+    base = None
+    expected = None
+    for name, check in runs:
+        start = time.time()
+        result = check()
+        elapsed = time.time() - start
+        rate = naddrs / elapsed
+        if base is None:
+            base, expected = rate, result
+        elif result != expected:
+            print "%s: results differ from legacy!" % name
+        print ("%-11s %d addresses against %d blocks, %d VCR, in %.2f sec:"
+               " %.0f addresses/sec, %.1fx" %
+               (name, naddrs, ncidrs, sum(result), elapsed, rate, rate / base))
+
+
+def scan_with(workers, chunk_size):
+    """scan_logs() of a path with workers processes"""
+    def scan(path):
+        av = argparse.Namespace(file=[path], workers=workers,
+                                chunk_size=chunk_size)
+        return sshdquery.scan_logs(av)
+    return scan
+
+
+def scan_legacy(path):
+    with open(path) as logfile:
+        return legacy_scan(logfile)
+
+
+def peak_rss():
+    """Largest resident set size of the process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(scan, path):
+    reset()
+    start = time.time()
+    nlines = scan(path)
+    elapsed = time.time() - start
+    sessions = sum(len(ip.session_list) for ip in sshdquery.SrcIPs.values())
+    return nlines, elapsed, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the sshdquery'
+                                     ' log parser')
+    parser.add_argument('--file', "-f", default=None,
+               help="sshd log to parse instead of a synthetic one")
+    parser.add_argument('--size', "-s", type=float, default=2048.0,
+               help="size in MB of the synthetic log [default: 2048]")
+    parser.add_argument('--workers', "-w", type=int, nargs="+", default=[1],
+               help="numbers of worker processes to time [default: 1]")
+    parser.add_argument('--chunk_size', type=int, default=64,
+               help="MB of log handed to a worker at a time [default: 64]")
+    parser.add_argument('--legacy', action="store_true",
+               help="also time the old parsing loop")
+    parser.add_argument('--cidrs', type=int, default=None,
+               help="time isaVCRaddr() against this many CIDR blocks instead")
+    parser.add_argument('--addrs', type=int, default=20000,
+               help="addresses to check with --cidrs [default: 20000]")
+    args = parser.parse_args()
+
+    if args.cidrs is not None:
+        bench_cidrs(args.cidrs, args.addrs)
+        return 0
+
+    path = args.file
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="sshdbench.", suffix=".log")
+        os.close(fd)
+        print "writing %.0f MB of sshd log to %s" % (args.size, path)
+        make_log(path, args.size)
+    try:
+        size = os.path.getsize(path) / 1048576.0
+        runs = []
+        if args.legacy:
+            runs.append(("legacy", scan_legacy))
+        for workers in args.workers:
+            runs.append(("workers=%d" % workers,
+                         scan_with(workers, args.chunk_size)))
+        base = None
+        for name, scan in runs:
+            nlines, elapsed, sessions = timed(scan, path)
+            rate = nlines / elapsed
+            if base is None:
+                base = rate
+            print ("%-11s %.1f MB, %d lines, %d sessions in %.2f sec:"
+                   " %.0f lines/sec, %.1f MB/s, %.2fx, peak RSS %.0f MB" %
+                   (name, size, nlines, sessions, elapsed,
+                    rate, size / elapsed, rate / base, peak_rss()))
+    finally:
+        if args.file is None:
+            os.unlink(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,25 +4,35 @@ import argparse
 import sys
 import re
 import csv
+import gzip
+import json
+import time
+import calendar
+import sqlite3
+import cPickle
 import socket
+import struct
+import bisect
+import threading
+import multiprocessing
 from netaddr import *
 import concurrent.futures
 from dns import resolver, reversename
 import sshpubkeys
 from ipwhois import IPWhois
-from itertools import tee, islice, izip_longest
 import datetime
-
-# Code to enable look-ahead doing file IO:
-def get_next(some_iterable, window=1):
-    items, nexts = tee(some_iterable, 2)
-    nexts = islice(nexts, window, None)
-    return izip_longest(items, nexts)
+from itertools import izip, chain, imap
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None      # no --format parquet
 
 #############################   Globals  #######################################
 # This array holds a list of CIDRs for the Virtual Clean Rooms
 vcrcidrdb = []
-# Ths dict contains the customer ssh key info keyed by fingerprint
+# Ths dict contains the customer ssh key info keyed by fingerprint, both the
+# MD5 one ("aa:bb:...") and the SHA256 one ("SHA256:...")
 CustomerKeys = dict()
 # This dict contains the Connection tracking Objects, key'ed by source IP
 # address
@@ -32,29 +42,59 @@ SrcIPs = dict()
 IPresults = []
 # This arraY holds the source ips to be processed
 IPvector =[]
-# Duration calculations, key = proc_id, value= 3 element array, start, stop,
-# duration (att strings)
+# Sessions that a disconnect can be matched to, key = duration_key() of the
+# session pid and source address, value = the Session
 Durations = {}
+# Source address -> integer, for duration_key()
+AddrInts = {}
 ################################################################################
 
 #############################   Class Definitions  #############################
-class Session:
+class Session(object):
+    """
+    An sftp session.  There are millions of these: they have slots instead
+    of a __dict__, the times are epoch seconds and the host, user and key
+    strings are interned, shared with every other session.  The e-mail and
+    options of the key are looked up in CustomerKeys rather than copied.
+    """
+    __slots__ = ("dc", "counter", "sshdhost", "userid", "key_fingerprint",
+                 "start_time", "stop_time", "source_ip", "procid")
+
     def __init__(self,dc,sshdhost, userid, kfingerprint,starttime,sip,pid):
         self.dc = dc
         self.counter = 0
         self.sshdhost = sshdhost
         self.userid = userid
         self.key_fingerprint = kfingerprint
-        self.e_mail = ""
-        self.options = ""
         self.start_time = starttime
-        self.stop_time = ""
-        self.duration = ""
+        self.stop_time = None
         self.source_ip = sip
-        self.procid = pid
+        self.procid = pid       # 0 if not known
+
+    @property
+    def e_mail(self):
+        if self.key_fingerprint in CustomerKeys:
+            return CustomerKeys[self.key_fingerprint]["e_mail"]
+        return ""
 
+    @property
+    def options(self):
+        if self.key_fingerprint in CustomerKeys:
+            return CustomerKeys[self.key_fingerprint]["options"]
+        return ""
+
+    @property
+    def duration(self):
+        """The session duration, "" if it hasn't ended"""
+        if self.stop_time is None:
+            return ""
+        return format_duration(self.stop_time - self.start_time)
+
+
+class SourceIP(object):
+    __slots__ = ("counter", "addr", "domain", "whois_data", "isVCRP",
+                 "session_list")
 
-class SourceIP:
     def __init__(self,revdns,coo, isaVCR,addr):
         self.counter = 0
         self.addr = addr
@@ -62,225 +102,961 @@ class SourceIP:
         self.whois_data = coo
         self.isVCRP = isaVCR
         self.session_list = []
-        IPvector.append(addr)
 
     def new_session(self,newsession):
         self.session_list.append(newsession)
         self.counter+=1
         newsession.counter = self.counter
+
+
+# How long a cached lookup is good for, failed lookups are retried sooner
+CACHE_TTL = 30 * 86400
+NEGATIVE_TTL = 86400
+# Threads doing reverse DNS and RDAP lookups, tries after the first one and
+# the wait before the first retry (doubled for each one after)
+DNS_WORKERS = 64
+RDAP_WORKERS = 16
+LOOKUP_RETRIES = 2
+RETRY_BACKOFF = 0.5
+
+class LookupCache:
+    """
+    Persistent cache of the reverse DNS and RDAP lookups, a sqlite file keyed
+    by address.  The same customer addresses come back month after month, so
+    a run only has to go to the network for the ones it hasn't seen lately.
+    Only used from the main thread.
+    """
+    def __init__(self, path, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS lookups ("
+                        " addr TEXT PRIMARY KEY,"
+                        " domain TEXT,"
+                        " arin_data TEXT,"      # json
+                        " ok INTEGER,"          # 0 if the lookup failed
+                        " fetched REAL)")
+        self.db.commit()
+
+    def get(self, addr, now=None):
+        """(domain, arin_data) of addr, None if not cached or expired"""
+        row = self.db.execute("SELECT domain, arin_data, ok, fetched"
+                              " FROM lookups WHERE addr = ?",
+                              (addr,)).fetchone()
+        if row is None:
+            return None
+        domain, arin_data, ok, fetched = row
+        if now is None:
+            now = time.time()
+        if now - fetched > (self.ttl if ok else self.negative_ttl):
+            return None
+        return (domain, json.loads(arin_data))
+
+    def put(self, results, now=None):
+        """Save (addr, domain, arin_data, ok) lookup results"""
+        if now is None:
+            now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO lookups"
+                            " VALUES (?, ?, ?, ?, ?)",
+                            [(addr, domain, json.dumps(arin_data), int(ok), now)
+                             for addr, domain, arin_data, ok in results])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class FollowState:
+    """
+    What --state keeps between runs: how far each log has been read, every
+    address seen (with its lookups and session count) and the sessions that
+    were still open, so the next run only has to read what was appended.
+    """
+    def __init__(self):
+        self.positions = {}     # path -> (inode, offset) read up to
+        self.src_ips = {}       # SrcIPs, with only the open sessions
+        self.durations = {}     # Durations of the open sessions
+        self.carry = {"keyfinger": "", "accepted": None}   # see merge_chunks
+
+    @classmethod
+    def load(cls, path):
+        """The state saved in path, a new one if there isn't any"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "rb") as f:
+            return cPickle.load(f)
+
+    def save(self, path):
+        """Write the state to path by way of a rename, never half of it"""
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+class KeyIndex:
+    """
+    Persistent index of the customer keys in --keydir, a sqlite file with
+    the fingerprints, e-mail and options of every key and the mtime and
+    size of the key file it came from.  Only the key files that are new or
+    changed since the last run are parsed, everything is then read back in
+    a single query.  Only used from the main thread.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript("CREATE TABLE IF NOT EXISTS files ("
+                              " name TEXT PRIMARY KEY,"
+                              " mtime REAL,"
+                              " size INTEGER);"
+                              "CREATE TABLE IF NOT EXISTS keys ("
+                              " file TEXT,"
+                              " line INTEGER,"
+                              " md5 TEXT,"
+                              " sha256 TEXT,"
+                              " e_mail TEXT,"
+                              " options BLOB);"     # pickled
+                              "CREATE INDEX IF NOT EXISTS keys_file"
+                              " ON keys (file);")
+        self.db.commit()
+
+    def update(self, keydir):
+        """
+        Bring the index up to date with the key files in keydir, returns
+        the number of files parsed and the number of files that are gone
+        """
+        known = dict((name, (mtime, size)) for name, mtime, size in
+                     self.db.execute("SELECT name, mtime, size FROM files"))
+        parsed = 0
+        for name in os.listdir(keydir):
+            path = os.path.join(keydir, name)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            if known.pop(name, None) == (stat.st_mtime, stat.st_size):
+                continue
+            self.db.execute("DELETE FROM keys WHERE file = ?", (name,))
+            self.db.executemany(
+                "INSERT INTO keys VALUES (?, ?, ?, ?, ?, ?)",
+                [(name, n, md5, sha256, e_mail,
+                  sqlite3.Binary(cPickle.dumps(options,
+                                               cPickle.HIGHEST_PROTOCOL)))
+                 for n, (md5, sha256, e_mail, options)
+                 in enumerate(read_keyfile(path))])
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                            (name, stat.st_mtime, stat.st_size))
+            parsed += 1
+        for name in known:
+            self.db.execute("DELETE FROM keys WHERE file = ?", (name,))
+            self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+        self.db.commit()
+        return parsed, len(known)
+
+    def keys(self):
+        """(md5, sha256, e_mail, options) of every key, by file and line"""
+        return [(md5, sha256, e_mail, cPickle.loads(str(options)))
+                for md5, sha256, e_mail, options in
+                self.db.execute("SELECT md5, sha256, e_mail, options"
+                                " FROM keys ORDER BY file, line")]
+
+    def close(self):
+        self.db.close()
 ################################################################################
 
+class CIDRIndex:
+    """
+    CIDR blocks as sorted, non overlapping [first, last] ranges of integer
+    addresses, one table per IP version.  An address is in one of the
+    blocks if the last range that starts at or below it also ends at or
+    above it: a binary search over the ranges instead of a mask compare
+    against every block.
+    """
+    def __init__(self, networks=()):
+        self.load(networks)
+
+    def load(self, networks):
+        """(Re)build the index from netaddr IPNetworks"""
+        blocks = {4: [], 6: []}
+        for ipnet in networks:
+            blocks[ipnet.version].append((ipnet.first, ipnet.last))
+        self.firsts = {}
+        self.lasts = {}
+        for version, ranges in blocks.iteritems():
+            ranges.sort()
+            firsts = []
+            lasts = []
+            for first, last in ranges:
+                # merge blocks that overlap or touch
+                if lasts and first <= lasts[-1] + 1:
+                    lasts[-1] = max(lasts[-1], last)
+                else:
+                    firsts.append(first)
+                    lasts.append(last)
+            self.firsts[version] = firsts
+            self.lasts[version] = lasts
+
+    def contains(self, value, version=4):
+        """True if the integer address value is in one of the blocks"""
+        n = bisect.bisect_right(self.firsts[version], value) - 1
+        return n >= 0 and value <= self.lasts[version][n]
+
+    def classify(self, values, version=4):
+        """
+        contains() of a sequence of integer addresses (a list, an array
+        ...) of the same IP version, as a list of booleans
+        """
+        firsts = self.firsts[version]
+        lasts = self.lasts[version]
+        search = bisect.bisect_right
+        result = []
+        for value in values:
+            n = search(firsts, value) - 1
+            result.append(n >= 0 and value <= lasts[n])
+        return result
+
+# vcrcidrdb indexed for isaVCRaddr()
+vcrindex = CIDRIndex()
+
+def addr_value(addr):
+    """(IP version, integer value) of an address"""
+    try:
+        return 4, struct.unpack("!L", socket.inet_pton(socket.AF_INET,
+                                                       addr))[0]
+    except socket.error:
+        pass
+    try:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6,
+                                                          addr))
+        return 6, high << 64 | low
+    except socket.error:
+        ipaddr = IPAddress(addr)    # anything else netaddr takes, or raise
+        return ipaddr.version, ipaddr.value
+
 def isaVCRaddr(addr):
     """Return True if the Address is a VCR address, false otherwise"""
     if addr == "UNKNOWN":
         print ("UNKNOWN IP! suspect Hacking Attempt")
         return False
-    ipaddr = IPAddress(addr)
-    for entry in vcrcidrdb :
-        ipnet = entry
-        # let's try for the quick-win match
-        if ipaddr == ipnet.ip and (ipnet.netmask ==
-                                   IPAddress('255.255.255.255')):
-            return True
-        # Have to do examine subnet masks
-        elif (ipaddr & ipnet.netmask) == ipnet.network :
-            return True
-        else:
+    version, value = addr_value(addr)
+    return vcrindex.contains(value, version)
+
+def isaVCRaddrs(addrs):
+    """isaVCRaddr() of a list of addresses, as a list of booleans"""
+    result = [False] * len(addrs)
+    values = {4: [], 6: []}
+    where = {4: [], 6: []}
+    for n, addr in enumerate(addrs):
+        if addr == "UNKNOWN":
+            print ("UNKNOWN IP! suspect Hacking Attempt")
             continue
-    return False
+        version, value = addr_value(addr)
+        values[version].append(value)
+        where[version].append(n)
+    for version in values:
+        for n, isvcr in izip(where[version],
+                             vcrindex.classify(values[version], version)):
+            result[n] = isvcr
+    return result
 
 def process_VCR_database(av):
     """ Load up the VCR netmask database"""
     with open(av.vcrcidrs) as netblk:
         for line in netblk:
-            vcrcidrdb.append(IPNetwork(line))
+            if line.strip() == "":
+                continue
+            vcrcidrdb.append(IPNetwork(line.strip()))
+    vcrindex.load(vcrcidrdb)
     return
 
+def read_keyfile(path):
+    """(md5, sha256, e_mail, options) of the keys in a key file"""
+    keys = []
+    with open(path, "rb") as file:
+        for sshkey in file:
+            if sshkey.rstrip() == "":
+                continue
+            try:
+                ssh = sshpubkeys.SSHKey(sshkey.rstrip(),
+                                        strict_mode=False)
+                ssh.parse()
+            except sshpubkeys.exceptions.InvalidKeyException as err:
+                print(("Invalid key:%s %s" % (sshkey.rstrip(), err)))
+                continue
+            except UnicodeDecodeError  as err:
+                print(("Invalid key:%s %s" % (sshkey.rstrip(), err)))
+                continue
+            keys.append((ssh.hash_md5()[4:], #delete "MD5:"
+                         str(ssh.hash_sha256()), ssh.comment, ssh.options))
+    return keys
+
 def process_sshkeys(av):
     """ Process the ssh key directory if present"""
     if av.keydir:
-        for keyfile in os.listdir(av.keydir):
+        if av.keyindex:
+            index = KeyIndex(av.keyindex)
+            parsed, removed = index.update(av.keydir)
+            keys = index.keys()
+            index.close()
+            print ("keys: %d key files parsed, %d removed, %d keys" %
+                   (parsed, removed, len(keys)))
+        else:
+            keys = []
+            for keyfile in sorted(os.listdir(av.keydir)):
                 current_file = os.path.join(av.keydir, keyfile)
-                with open(current_file, "rb") as file:
-                    for sshkey in file:
-                        if sshkey.rstrip() == "":
-                            continue
-                        try:
-                            ssh = sshpubkeys.SSHKey(sshkey.rstrip(),
-                                                    strict_mode=False)
-                            ssh.parse()
-                        except sshpubkeys.exceptions.InvalidKeyException as err:
-                            print(("Invalid key:%s %s" % (sshkey.rstrip(), err)))
-                            continue
-                        except UnicodeDecodeError  as err:
-                            print(("Invalid key:%s %s" % (sshkey.rstrip(), err)))
-                            continue
-                        key_fingerprint = ssh.hash_md5()[4:] #delete "MD5:"
-                        key_email = ssh.comment
-                        key_options = ssh.options
-                        if key_fingerprint in CustomerKeys:
-                            print(
-                              "Warning: key %s already in Database as e-mail: %s"
-                              ", this is %s"  %
-                                 (key_fingerprint,
-                                   CustomerKeys[key_fingerprint]["e_mail"],
-                                   key_email) )
-                            continue
-                        CustomerKeys[key_fingerprint] = {"e_mail" : key_email,
-                                                         "options" : key_options}
+                if os.path.isfile(current_file):
+                    keys.extend(read_keyfile(current_file))
+        for key_fingerprint, key_sha256, key_email, key_options in keys:
+            if key_fingerprint in CustomerKeys:
+                print(
+                  "Warning: key %s already in Database as e-mail: %s"
+                  ", this is %s"  %
+                     (key_fingerprint,
+                       CustomerKeys[key_fingerprint]["e_mail"],
+                       key_email) )
+                continue
+            CustomerKeys[key_fingerprint] = CustomerKeys[key_sha256] = {
+                "e_mail" : key_email, "options" : key_options}
     return
 
-def process_logfile(av):
-    """Open and process an sshd logfile"""
-    logentry = re.compile('(?P<ss_timestamp>'
-                          '[JFMAMSOND][a-z]{2}\s+\d{1,2}\s\d{2}\:\d{2}\:\d{2})'
-                         '\s(?P<ss_hostname>'
-                          '(([a-zA-Z0-9]+|[a-zA-Z0-9][a-zA-Z0-9\-]*'
-                          '[a-zA-Z0-9])\.)*'
-                          '([A-Za-z0-9]+|[A-Za-z0-9][A-Za-z0-9\-]*))'
-                          '\s(?P<ss_process>[a-zA-Z0-9\-\[\]]*\:\s)'
-                          '(?P<ss_message>.+$)'
-                          )
-# set up resolver so it doesn't take forever
-    dns_resolver = resolver.Resolver()
-    dns_resolver.timeout = 1
-    dns_resolver.lifetime = 1
-
-    def lookups(addr):
-       """worker function to do reverse DNS and ARIN lookups"""
+#############################   Log parsing  ##################################
+# An sshd log line: timestamp, hostname, process and message.  Each line is
+# matched once, the message is then dispatched on its first two words.
+# Besides the traditional syslog format this takes the ISO 8601 timestamps
+# of rsyslog (RSYSLOG_FileFormat) and RFC 5424 lines, whose process part is
+# "APP-NAME PROCID MSGID STRUCTURED-DATA " instead of "sshd[PID]: ".
+LOGENTRY = re.compile(r'(?:<\d{1,3}>1 )?'
+                      r'(?P<ss_timestamp>'
+                      r'[JFMAMSOND][a-z]{2}\s+\d{1,2}\s\d{2}:\d{2}:\d{2}'
+                      r'|\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?'
+                      r'(?:Z|[+-]\d\d:\d\d)?)'
+                      r'\s(?P<ss_hostname>[A-Za-z0-9][A-Za-z0-9.\-]*)'
+                      r'\s(?P<ss_process>[a-zA-Z0-9\-\[\]]*:\s'
+                      r'|\S+ \d+ \S+ (?:-|\[[^\]]*\]) )'
+                      r'(?P<ss_message>[^\r\n]+)'
+                      )
+PROCESS_PID = re.compile(r"[0-9]+")
+
+# Message kinds
+CONNECTION = 1      # Connection from ADDR port PORT
+FOUND_KEY = 2       # Found matching RSA key: FINGERPRINT
+ACCEPTED = 3        # Accepted publickey for USER from ADDR port PORT ssh2
+                    # [: RSA FINGERPRINT]  (newer sshd, SHA256:...)
+CHILD_PID = 4       # User child is on pid PID  (the line after ACCEPTED)
+DISCONNECT = 5      # Received disconnect from ADDR: ...
+CLOSING = 6         # Closing connection to ADDR port PORT
+
+# First two words of a message -> kind, anything else is ignored
+MESSAGE_KINDS = {
+    "Connection from": CONNECTION,
+    "Found matching": FOUND_KEY,
+    "Accepted publickey": ACCEPTED,
+    "User child": CHILD_PID,
+    "Received disconnect": DISCONNECT,
+    "Closing connection": CLOSING,
+    }
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+               "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+MONTHS = dict((month, n + 1) for n, month in enumerate(MONTH_NAMES))
+# A syslog timestamp later than this after the log was last written is from
+# the year before
+CLOCK_SKEW = 86400
+# Minutes a TimeDecoder remembers before it starts over
+TIME_CACHE = 10000
+# Bits of a duration_key() for the pid, Linux pids are below 2**22
+PID_BITS = 22
+################################################################################
+
+class TimeDecoder:
+    """
+    Epoch seconds of log timestamps, so durations are a subtraction.
+    Traditional syslog timestamps, "Aug  3 10:11:12", are local time (see
+    --timezone) and have no year: they are taken to be in the year that
+    makes them no later than reference, when the log was last written, so
+    a session from Dec 31 to Jan 1 comes out right.  ISO 8601 timestamps,
+    "2014-08-03T10:11:12.345678-07:00", carry their year and usually their
+    offset.  Lines come a lot of them to the minute, the conversion
+    (mktime() or timegm()) is only done once per minute.
+    """
+    def __init__(self, reference=None):
+        if reference is None:
+            reference = time.time()
+        self.year = time.localtime(reference).tm_year
+        self.latest = reference + CLOCK_SKEW
+        self.minutes = {}       # timestamp up to the seconds -> epoch
+
+    def __call__(self, timestamp):
+        if timestamp[4] == "-":
+            # ISO: "2014-08-03T10:11" ":12" [".345678"] ["Z" | "-07:00"]
+            minute = timestamp[:16]
+            zone = timestamp[19:]
+            if zone[:1] == ".":
+                zone = zone.lstrip(".0123456789")
+            key = minute + zone
+            if key not in self.minutes:
+                self.remember(key, self.iso_minute(minute, zone))
+            return self.minutes[key] + int(timestamp[17:19])
+        minute = timestamp[:-3]
+        if minute not in self.minutes:
+            self.remember(minute, self.syslog_minute(minute))
+        return self.minutes[minute] + int(timestamp[-2:])
+
+    def remember(self, key, epoch):
+        if len(self.minutes) >= TIME_CACHE:
+            self.minutes.clear()
+        self.minutes[key] = epoch
+
+    def syslog_minute(self, minute):
+        month, day, hour_minute = minute.split()
+        hour, minute = hour_minute.split(":")
+        local = [self.year, MONTHS[month], int(day), int(hour), int(minute),
+                 0, 0, 0, -1]
+        epoch = time.mktime(local)
+        if epoch > self.latest:
+            local[0] -= 1
+            epoch = time.mktime(local)
+        return int(epoch)
+
+    def iso_minute(self, minute, zone):
+        fields = (int(minute[0:4]), int(minute[5:7]), int(minute[8:10]),
+                  int(minute[11:13]), int(minute[14:16]), 0, 0, 0, -1)
+        if not zone:
+            return int(time.mktime(fields))
+        epoch = calendar.timegm(fields)
+        if zone != "Z":
+            offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+            epoch += -offset if zone[0] == "+" else offset
+        return epoch
+
+def format_time(seconds):
+   """Epoch seconds as a syslog timestamp, in local time"""
+   tm = time.localtime(seconds)
+   return "%s %2d %02d:%02d:%02d" % (MONTH_NAMES[tm.tm_mon - 1], tm.tm_mday,
+                                     tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+def format_duration(seconds):
+   """A duration in seconds as h:mm:ss"""
+   if seconds < 0:
+       return "__:__:__"
+   return str(datetime.timedelta(seconds=seconds))
+
+def duration_key(pid, addr):
+   """
+   Durations key of the session pid had from addr: the address as an
+   integer with the pid in the low bits, instead of the two strings
+   concatenated.  Anything that isn't an address ("UNKNOWN") gets a tuple.
+   """
+   value = AddrInts.get(addr)
+   if value is None:
        try:
-           reverse_name = reversename.from_address(addr)
-           domain = dns_resolver.query(reverse_name,
-                                       "PTR")[0].to_text()[:-1]
-           arin_obj = IPWhois(addr)
-           arin_data = arin_obj.lookup_rdap(depth=1)
-
-       except:
-           domain = ""
-           arin_data = {}
-       return (addr,domain, arin_data)
-
-    def get_duration(starttime,stoptime):
-       """Calculate session duration from start and stop times"""
-       fmt = "%b %d %H:%M:%S"
-       start = datetime.datetime.strptime(starttime,fmt)
-       stop = datetime.datetime.strptime(stoptime,fmt)
-       duration = stop - start
-       if duration.days < 0:
-           return "__:__:__"
-       else:
-
-           return str(duration)
-
-# Process the log file
-    with open(av.file) as logfile:
-
-        # For each line in the log file, start by parsing out the timestamp,
-        # hostname, process id info and message body.
-        # Then, examine the message body looking for key messages that signal
-        # the start of an actual sftp connection via ssh key, When an
-        # "Accepted Public Key" message is received, look ahead one line
-        # to see if you find an entry that has the pid for the session,
-        # this will be used to match up with a message signaling the disconnect
-        # or teardown of the session, this is used to derive Duration
-        # information
-
-        for line, next_line in get_next(logfile):
-            timestamp = logentry.match(line).group("ss_timestamp")
-            sshd_hostname = logentry.match(line).group("ss_hostname")
-            sshd_process = logentry.match(line).group("ss_process")
-            sshd_message = logentry.match(line).group("ss_message")
-            if "Connection from" in sshd_message:
-                connection_message = sshd_message
-                _,_,addr,_,port =  connection_message.split()
-                if addr in SrcIPs:
-                    srcip = SrcIPs[addr]
-                    srcip.counter+1
-                else:
-                    if addr is not "UNKNOWN":
-                        domain = ""
-                        arin_data = {}
-                    else:
-                        domain = "UNKNOWN"
-                        arin_data = {}
-
-                    SrcIPs[addr] = SourceIP(
-                                    domain,arin_data,isaVCRaddr(addr),addr)
+           version, value = addr_value(addr)
+           if version == 6:
+               value |= 1 << 128     # apart from the IPv4 addresses
+       except Exception:
+           value = -1
+       AddrInts[addr] = value
+   if value < 0:
+       return (pid, addr)
+   return value << PID_BITS | pid
+
+class LogChunk:
+    """
+    What the lines of one piece of a log add to the databases.  A log is
+    scanned a chunk at a time (in parallel with --workers) and the chunks
+    are merged in order by merge_chunks(), the first and last lines of a
+    chunk can depend on the chunks around it.
+    """
+    def __init__(self):
+        self.nlines = 0
+        self.src_ips = {}       # addr -> SourceIP with this chunk's sessions
+        self.new_addrs = []     # addresses in the order they were first seen
+        self.orphans = {}       # addr -> (time, user) first seen on Accepted
+        self.durations = {}     # sessions started in this chunk
+        self.ends = []          # (durkey, time) of sessions started earlier
+        self.keyless = []       # sessions accepted before the first key found
+        self.last_key = None    # last fingerprint found in the chunk
+        self.head_pid = None    # "User child is on pid" on the first line
+        self.tail = None        # (session, addr) Accepted on the last line
+
+def scan_logfile(logfile, reference=None):
+    """
+    Parse the lines of an sshd log (or a piece of one) into a LogChunk,
+    reference is when the log was last written, see TimeDecoder
+    """
+    # For each line in the log file, parse out the timestamp, hostname,
+    # process id info and message body with a single match.
+    # Then, look at the message kind for the key messages that signal the
+    # start of an actual sftp connection via ssh key.  When an "Accepted
+    # publickey" message is received, the line after it has the pid for the
+    # session if it is a "User child is on pid" message, this will be used to
+    # match up with a message signaling the disconnect or teardown of the
+    # session, this is used to derive Duration information.
+    # Hostnames, users, addresses and fingerprints repeat a lot, they are
+    # interned so every session doesn't hold copies of its own.
+    chunk = LogChunk()
+    src_ips = chunk.src_ips
+    durations = chunk.durations
+    match = LOGENTRY.match
+    kinds = MESSAGE_KINDS
+    hosts = {}          # hostname -> (interned hostname, data center)
+    keyfinger = None
+    accepted = None     # (session, addr) of the previous line
+    log_time = TimeDecoder(reference)
+    last_stamp = None   # the last timestamp converted, and its epoch
+    last_time = None
+    nlines = 0
+    for line in logfile:
+        nlines += 1
+        entry = match(line)
+        if entry is None:
+            accepted = None
+            continue
+        timestamp, sshd_hostname, sshd_process, sshd_message = entry.groups()
+        # the first two words of the message
+        kind = kinds.get(sshd_message[:sshd_message.find(
+                                    " ", sshd_message.find(" ") + 1)])
+        if kind == CHILD_PID:
+            if accepted is not None:
+                session, addr = accepted
+                session.procid = session_pid = int(sshd_message.split()[5])
+                durations[duration_key(session_pid, addr)] = session
+            elif nlines == 1:
+                # belongs to an Accepted at the end of the chunk before
+                chunk.head_pid = int(sshd_message.split()[5])
+            accepted = None
+            continue
+        accepted = None
+        if kind is None:
+            continue
+        if timestamp != last_stamp:
+            last_stamp = timestamp
+            last_time = log_time(timestamp)
+        if kind == CONNECTION:
+            addr = intern(sshd_message.split()[2])
+            if addr not in src_ips:
+                domain = "UNKNOWN" if addr == "UNKNOWN" else ""
+                src_ips[addr] = SourceIP(domain,{},None,addr)
+                chunk.new_addrs.append(addr)
+        elif kind == FOUND_KEY:
+            keyfinger = intern(sshd_message.split()[4])
+        elif kind == ACCEPTED:
+            fields = sshd_message.split()
+            userid = intern(fields[3])
+            addr = intern(fields[5])
+            if len(fields) > 10:
+                keyfinger = intern(fields[10])
+            if sshd_hostname in hosts:
+                sshd_hostname, dc = hosts[sshd_hostname]
+            else:
+                labels = sshd_hostname.split('.')
+                dc = labels[3] if len(labels) > 3 else ""
+                sshd_hostname = intern(sshd_hostname)
+                hosts[sshd_hostname] = (sshd_hostname, dc)
+            if addr in src_ips:
+                srcip = src_ips[addr]
+            else:
+                # no connection entry in this chunk, merge_chunks() warns
+                # if there wasn't one in the chunks before it either
+                srcip = src_ips[addr] = SourceIP("",{},None,addr)
+                chunk.new_addrs.append(addr)
+                chunk.orphans[addr] = (timestamp, userid)
+            session = Session(dc,sshd_hostname,
+                              userid, keyfinger,
+                              last_time,addr, 0 )
+            if keyfinger is None:
+                chunk.keyless.append(session)
+            srcip.new_session(session)
+            accepted = (session, addr)
+        elif kind == DISCONNECT or kind == CLOSING:
+            addr = sshd_message.split()[3]
+            if kind == DISCONNECT:
+                addr = addr[:-1] #Remove trailing :
+            durkey = duration_key(
+                int(PROCESS_PID.search(sshd_process).group(0)), addr)
+            if durkey in durations:
+                durations[durkey].stop_time = last_time
+            else:
+                chunk.ends.append((durkey, last_time))
+    chunk.nlines = nlines
+    chunk.last_key = keyfinger
+    chunk.tail = accepted
+    return chunk
+
+def merge_chunks(chunks, carry=None, lookups=None):
+    """
+    Merge the LogChunks of a log, in order, into SrcIPs, Durations and
+    IPvector, and find out which of the new addresses are VCR addresses,
+    all in one batch.  Returns the number of lines scanned.
+    carry is the last key found and the session accepted on the last line
+    of the lines before these, it is updated for the lines after them.
+    The new addresses of each chunk are handed to lookups, a LookupPipeline,
+    as soon as the chunk is merged.
+    """
+    if carry is None:
+        carry = {"keyfinger": "", "accepted": None}
+    keyfinger = carry["keyfinger"]
+    accepted = carry["accepted"]
+    nlines = 0
+    first_new = len(IPvector)
+    for chunk in chunks:
+        nlines += chunk.nlines
+        chunk_new = len(IPvector)
+        # the pid of the session accepted on the last line of the chunk before
+        if accepted is not None and chunk.head_pid is not None:
+            session, addr = accepted
+            session.procid = chunk.head_pid
+            Durations[duration_key(chunk.head_pid, addr)] = session
+        for durkey, stop_time in chunk.ends:
+            if durkey in Durations:
+                Durations[durkey].stop_time = stop_time
+        for session in chunk.keyless:
+            session.key_fingerprint = keyfinger
+        for addr in chunk.new_addrs:
+            srcip = chunk.src_ips[addr]
+            # a chunk scanned by another process comes back with its own
+            # copies of the strings, share them again
+            srcip.addr = addr = intern(addr)
+            for session in srcip.session_list:
+                session.sshdhost = intern(session.sshdhost)
+                session.userid = intern(session.userid)
+                if session.key_fingerprint is not None:
+                    session.key_fingerprint = intern(session.key_fingerprint)
+                session.source_ip = addr
+            if addr in SrcIPs:
+                for session in srcip.session_list:
+                    SrcIPs[addr].new_session(session)
                 continue
-            elif "Found matching" in sshd_message:
-                found_message = sshd_message
-                _,_,_,_,keyfinger = found_message.split()
+            if addr in chunk.orphans:
+                print "Accepted connection but no connection entry found!"
+                timestamp, userid = chunk.orphans[addr]
+                print ("time: %s address: %s user: %s" %
+                       ( timestamp, addr,userid))
+                print "Adding and continuing"
+            SrcIPs[addr] = srcip
+            IPvector.append(addr)
+        Durations.update(chunk.durations)
+        if lookups is not None:
+            lookups.submit(IPvector[chunk_new:])
+        if chunk.last_key is not None:
+            keyfinger = chunk.last_key
+        accepted = chunk.tail
+    carry["keyfinger"] = keyfinger
+    carry["accepted"] = accepted
+    new_addrs = IPvector[first_new:]
+    for addr, isvcr in izip(new_addrs, isaVCRaddrs(new_addrs)):
+        SrcIPs[addr].isVCRP = isvcr
+    return nlines
+
+def open_log(path):
+    """Open a log file, "-" is stdin and rotated .gz logs are decompressed"""
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path)
+
+def log_chunks(paths, chunk_size):
+    """
+    Split the logs into (path, start, end) pieces of about chunk_size bytes
+    that end on a line boundary.  A compressed log is a single piece.
+    """
+    chunks = []
+    for path in paths:
+        if path.endswith(".gz"):
+            chunks.append((path, 0, None))
+            continue
+        size = os.path.getsize(path)
+        with open(path) as logfile:
+            start = 0
+            while start < size:
+                end = start + chunk_size
+                if end < size:
+                    logfile.seek(end)
+                    logfile.readline()
+                    end = logfile.tell()
+                chunks.append((path, start, min(end, size)))
+                start = end
+    return chunks
+
+def log_reference(path):
+    """When the log was last written, now for stdin"""
+    if path == "-":
+        return None
+    return os.path.getmtime(path)
+
+def scan_chunk(piece):
+    """Process pool worker, scan a (path, start, end) piece of a log"""
+    path, start, end = piece
+    logfile = open_log(path)
+    try:
+        if end is None:
+            return scan_logfile(logfile, log_reference(path))
+        logfile.seek(start)
+        lines = logfile.read(end - start).split("\n")
+        if not lines[-1]:
+            lines.pop()
+        return scan_logfile(lines, log_reference(path))
+    finally:
+        logfile.close()
+
+def scan_logs(av, lookups=None):
+    """
+    Scan the logs given to --file, in order, with --workers processes, a
+    --chunk_size piece at a time so the lookups of the addresses found can
+    start while the rest is scanned.  Returns the number of lines scanned.
+    """
+    if "-" in av.file:
+        def chunks():
+            for path in av.file:
+                logfile = open_log(path)
+                try:
+                    yield scan_logfile(logfile, log_reference(path))
+                finally:
+                    if logfile is not sys.stdin:
+                        logfile.close()
+        return merge_chunks(chunks(), lookups=lookups)
+    pieces = log_chunks(av.file, av.chunk_size * 1024 * 1024)
+    if av.workers <= 1:
+        return merge_chunks(imap(scan_chunk, pieces), lookups=lookups)
+    pool = multiprocessing.Pool(av.workers)
+    try:
+        return merge_chunks(pool.imap(scan_chunk, pieces), lookups=lookups)
+    finally:
+        pool.close()
+        pool.join()
+
+def find_rotated(path, inode):
+    """The rotated log (secure.1, secure-20140831 ...) that has inode"""
+    directory, name = os.path.split(os.path.abspath(path))
+    for entry in os.listdir(directory):
+        if entry != name and entry.startswith(name):
+            rotated = os.path.join(directory, entry)
+            if os.stat(rotated).st_ino == inode:
+                return rotated
+    return None
+
+def appended_lines(path, state):
+    """
+    The lines appended to the log at path since the last run, like tail -F:
+    if the log was rotated since, the rest of the old log comes first.  A
+    last line that is still being written is left for the next run.
+    """
+    logfile = open(path)
+    try:
+        stat = os.fstat(logfile.fileno())
+        inode, offset = state.positions.get(path, (stat.st_ino, 0))
+        if inode != stat.st_ino:
+            rotated = find_rotated(path, inode)
+            if rotated is None:
+                print ("Warning: %s was rotated and the old log is gone,"
+                       " lines after offset %d of it are lost" %
+                       (path, offset))
+            else:
+                with open(rotated) as oldlog:
+                    oldlog.seek(offset)
+                    for line in oldlog:
+                        yield line
+            offset = 0
+        elif offset > stat.st_size:
+            print "Warning: %s was truncated, reading it from the start" % path
+            offset = 0
+        logfile.seek(offset)
+        for line in logfile:
+            if not line.endswith("\n"):
+                break
+            offset += len(line)
+            yield line
+        state.positions[path] = (stat.st_ino, offset)
+    finally:
+        logfile.close()
+
+def closed_sessions(carry):
+    """
+    Take the sessions that are over out of SrcIPs and Durations, returns a
+    dict of address to its closed sessions.  What stays is the sessions
+    still waiting for a disconnect and the one accepted on the last line
+    read, its pid is on the next line.
+    """
+    pending = carry["accepted"][0] if carry["accepted"] else None
+    closed = {}
+    for addr, srcip in SrcIPs.iteritems():
+        still_open = []
+        for sess in srcip.session_list:
+            if sess is pending or (sess.procid and sess.stop_time is None and
+                                   Durations.get(duration_key(sess.procid,
+                                                              addr)) is sess):
+                still_open.append(sess)
                 continue
-            elif "Postponed publickey" in sshd_message:
-                postponed_message = sshd_message
-                _,_,_,userid_post,_,addr_post,_,port,_ = postponed_message.split()
+            closed.setdefault(addr, []).append(sess)
+        srcip.session_list = still_open
+    for durkey in [durkey for durkey, sess in Durations.iteritems()
+                   if sess.stop_time is not None]:
+        del Durations[durkey]
+    return closed
+
+def follow_logfile(av):
+    """
+    Process what was appended to the --file logs since the last run, with
+    the state saved in --state, and add the sessions that ended to --output.
+    With --interval, do it again every so many seconds.
+    """
+    state = FollowState.load(av.state)
+    SrcIPs.update(state.src_ips)
+    Durations.update(state.durations)
+    while True:
+        del IPvector[:]
+        lines = chain.from_iterable(appended_lines(path, state)
+                                    for path in av.file)
+        lookups = LookupPipeline(av)
+        nlines = merge_chunks([scan_logfile(lines)], state.carry, lookups)
+        update_lookups(lookups.finish(av.lookup_deadline))
+        closed = closed_sessions(state.carry)
+        write_output(av, closed)
+        state.src_ips = SrcIPs
+        state.durations = Durations
+        state.save(av.state)
+        print ("%d new lines, %d new addresses, %d sessions ended,"
+               " %d still open" %
+               (nlines, len(IPvector),
+                sum(len(sessions) for sessions in closed.itervalues()),
+                sum(len(srcip.session_list) for srcip in SrcIPs.itervalues())))
+        if not av.interval:
+            return
+        time.sleep(av.interval)
+
+class TokenBucket:
+    """
+    Rate limit: rate tokens a second, up to burst of them saved up when
+    nothing is going on.  take() waits for a token.  Thread safe.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst else max(1.0, self.rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class LookupPipeline:
+    """
+    Reverse DNS and ARIN (RDAP) lookups of the source addresses, started as
+    merge_chunks() finds them so they overlap with the scan instead of
+    coming after it.  Each service has its own thread pool and token bucket
+    (--dns_rate, --rdap_rate), failed lookups are retried with a backoff and
+    finish() gives up on what isn't done by the --lookup_deadline.
+    With --cache only the addresses that aren't in the cache (or whose
+    entry expired) are looked up, --refresh looks them all up again and
+    --offline doesn't look anything up.  submit() and finish() are called
+    from the main thread, the cache is only used from there.
+    """
+    def __init__(self, av):
+        self.cache = LookupCache(av.cache) if av.cache else None
+        self.refresh = av.refresh
+        self.offline = av.offline
+        # set up resolver so it doesn't take forever
+        self.resolver = resolver.Resolver()
+        self.resolver.timeout = 1
+        self.resolver.lifetime = 1
+        self.dns_bucket = TokenBucket(av.dns_rate)
+        self.rdap_bucket = TokenBucket(av.rdap_rate)
+        self.dns_pool = concurrent.futures.ThreadPoolExecutor(DNS_WORKERS)
+        self.rdap_pool = concurrent.futures.ThreadPoolExecutor(RDAP_WORKERS)
+        self.pending = {}       # addr -> (dns future, rdap future)
+        self.cached = []        # (addr, domain, arin_data, ok) from the cache
+        self.skipped = 0
+        self.stopped = False
+
+    def submit(self, addrs):
+        """Start the lookups of addrs"""
+        for addr in addrs:
+            if addr in self.pending or addr == "UNKNOWN":
                 continue
-            elif "Accepted publickey" in sshd_message:
-                accepted_message = sshd_message
-                _,_,_,userid,_,addr,_,port,_ = sshd_message.split()
-                if "User child is on pid" in next_line:
-                    session_pid = logentry.match(
-                        next_line).group("ss_message").split()[5]
-                    Durations[session_pid+addr] = [addr,timestamp,"",""]
-                else:
-                    session_pid = ""
-                if addr in SrcIPs:
-                    srcip = SrcIPs[addr]
-                    dc = sshd_hostname.split('.')[3]
-                    session = Session(dc,sshd_hostname,
-                                      userid, keyfinger,
-                                      timestamp,addr, session_pid )
-                    if keyfinger in CustomerKeys:
-                        session.e_mail = CustomerKeys[keyfinger]["e_mail"]
-                        session.options = CustomerKeys[keyfinger]["options"]
-                    srcip.new_session(session)
+            if self.cache and not self.refresh:
+                cached = self.cache.get(addr)
+                if cached is not None:
+                    self.cached.append((addr,) + cached)
                     continue
-                else:
-                    print "Accepted connection but no connection entry found!"
-                    print ("time: %s address: %s user: %s" %
-                           ( timestamp, addr,userid))
-                    print "Adding and continuing"
-                    domain = ""
-                    arin_data = {}
-                    dc = sshd_hostname.split('.')[3]
-                    SrcIPs[addr] = SourceIP(
-                                    domain,arin_data,isaVCRaddr(addr),addr)
-                    srcip.session_list.append(Session(dc,sshd_hostname,userid,
-                                         keyfinger,timestamp,addr, session_pid))
-            elif "Received disconnect" in sshd_message:
-                addr = sshd_message.split()[3][:-1] #Remove trailing :
-                sess_pid_obj = re.search(r"[0-9]+", sshd_process)
-                sess_pid = sess_pid_obj.group(0)
-                durkey = sess_pid+addr
-                if durkey in Durations:
-                    Durations[durkey][2] = timestamp
-                    Durations[durkey][3] = get_duration(Durations[durkey][1],
-                                                        Durations[durkey][2])
-                continue
-            elif "Closing connection" in sshd_message:
-                addr = sshd_message.split()[3]
-                sess_pid_obj = re.search(r"[0-9]+", sshd_process)
-                sess_pid = sess_pid_obj.group(0)
-                durkey = sess_pid+addr
-                if durkey in Durations:
-                    Durations[durkey][2] = timestamp
-                    Durations[durkey][3] = get_duration(Durations[durkey][1],
-                                                        Durations[durkey][2])
-                continue
-            else:
+            if self.offline:
+                self.skipped += 1
                 continue
+            self.pending[addr] = (
+                self.dns_pool.submit(self.call, self.dns_bucket,
+                                     self.reverse_dns, addr),
+                self.rdap_pool.submit(self.call, self.rdap_bucket,
+                                      self.rdap, addr))
 
-    # We've processed the entire logfile and built in-memory databases of IP
-    # address and session information that will be used to write the csv info.
-    # Reverse DNS lookups, and ARIN data API calls take a significant amount of
-    # time, so let's parallize their execution using the concurrent.futures
-    # package with a pool size of 128 workers.
+    def reverse_dns(self, addr):
+        reverse_name = reversename.from_address(addr)
+        return self.resolver.query(reverse_name, "PTR")[0].to_text()[:-1]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers = 128) as pool:
-        IPresults = list(pool.map(lookups,IPvector))
+    def rdap(self, addr):
+        return IPWhois(addr).lookup_rdap(depth=1)
 
-    # Update the SrcIP database with the map results (reduce)
-    for ip_tuple in IPresults:
+    def call(self, bucket, lookup, addr):
+        """
+        lookup(addr) within the rate limit of bucket, retried if it fails.
+        Returns (result, ok), result is None if there isn't any.
+        """
+        for attempt in range(LOOKUP_RETRIES + 1):
+            if self.stopped:
+                break
+            bucket.take()
+            try:
+                return lookup(addr), True
+            except (resolver.NXDOMAIN, resolver.NoAnswer):
+                return None, True       # no PTR record, that is an answer
+            except Exception:
+                if attempt < LOOKUP_RETRIES:
+                    time.sleep(RETRY_BACKOFF * 2 ** attempt)
+        return None, False
+
+    def finish(self, timeout):
+        """
+        Wait up to timeout seconds for the lookups still going, then return
+        the (addr, domain, arin_data, ok) results of every address submitted
+        """
+        futures = [future for pair in self.pending.itervalues()
+                   for future in pair]
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        self.stopped = True
+        for future in not_done:
+            future.cancel()
+        self.dns_pool.shutdown(wait=False)
+        self.rdap_pool.shutdown(wait=False)
+        looked_up = []
+        for addr, (dns_future, rdap_future) in self.pending.iteritems():
+            if dns_future not in done or rdap_future not in done:
+                continue
+            domain, dns_ok = dns_future.result()
+            arin_data, rdap_ok = rdap_future.result()
+            looked_up.append((addr, domain or "", arin_data or {},
+                              dns_ok and rdap_ok))
+        if self.cache:
+            self.cache.put(looked_up)
+            self.cache.close()
+        timed_out = len(self.pending) - len(looked_up)
+        if self.cache or timed_out:
+            print ("lookups: %d cached, %d looked up (%d failed),"
+                   " %d timed out, %d skipped" %
+                   (len(self.cached), len(looked_up),
+                    len([res for res in looked_up if not res[3]]),
+                    timed_out, self.skipped))
+        return self.cached + looked_up
+
+def update_lookups(results):
+    """Update the SrcIP database with the lookup results (reduce)"""
+    for ip_tuple in results:
         addr = ip_tuple[0]
         revdns = ip_tuple[1]
         arin_data = ip_tuple[2]
@@ -288,91 +1064,346 @@ def process_logfile(av):
         SrcIPs[addr].whois_data = arin_data
     return
 
-def write_csv(av):
-    """Write out a csv file containing the results"""
-    with open(av.csv,'wb') as f:
-        writer = csv.writer(f)
-        header = ["Address","Domain","ARIN Network Name", "ASN CC", "VCR?",
-                  "Start Time", "Stop Time","Duration","Session #","Data Center",
-                  "SFTP Host","Userid",
-                  "key_fingerprint","e-mail","e-mail Domain","IP restrictions"]
-        writer.writerow(header)
-        for ipaddr, ipdata in SrcIPs.iteritems():
-            row_prefix = []
-            row_prefix.append(ipaddr)
-            row_prefix.append(ipdata.domain)
-            # Add change ARIN info here (results of IPwhois package)
-            if ipdata.whois_data == {}:
-                row_prefix.append("NONE") # Empty ARIA network name
-                row_prefix.append("NONE") # Empty ARIC country code
-            else:
-                row_prefix.append(ipdata.whois_data["network"]["name"])
-                row_prefix.append(ipdata.whois_data["asn_country_code"])
-
-            row_prefix.append(ipdata.isVCRP)
-            for sess in ipdata.session_list:
-                durkey = sess.procid+ipaddr
-                if durkey in Durations:
-                    sess.stop_time = Durations[durkey][2]
-                    sess.duration = Durations[durkey][3]
-                row = list(row_prefix)
-                row.append(sess.start_time)
-                row.append(sess.stop_time)
-                row.append(sess.duration)
-                row.append(sess.counter)
-                row.append(sess.dc)
-                row.append(sess.sshdhost)
-                row.append(sess.userid)
-                row.append(sess.key_fingerprint)
-                if sess.e_mail :
-                    row.append(sess.e_mail)
-                    row.append(sess.e_mail.split("@")[-1]) # create domain name
-                else:
-                    row.append("no-email")
-                    row.append("no-email-domain")
-                if sess.options :
-                    row.append(sess.options["from"])
-                else:
-                    row.append("NONE")
+def process_logfile(av):
+    """Open and process an sshd logfile"""
+    # Reverse DNS lookups, and ARIN data API calls take a significant amount
+    # of time, they run in the background while the log is scanned.
+    lookups = LookupPipeline(av)
+    scan_logs(av, lookups)
+    update_lookups(lookups.finish(av.lookup_deadline))
+
+#############################   Output  ########################################
+# Output columns: name in sqlite and parquet, csv header, type.  The first
+# ADDRESS_COLUMNS are the same for every session from an address.
+OUTPUT_COLUMNS = [
+    ("addr", "Address", str),
+    ("domain", "Domain", str),
+    ("network_name", "ARIN Network Name", str),
+    ("asn_cc", "ASN CC", str),
+    ("vcr", "VCR?", bool),
+    ("start_time", "Start Time", str),
+    ("stop_time", "Stop Time", str),
+    ("duration", "Duration", str),
+    ("session_no", "Session #", int),
+    ("dc", "Data Center", str),
+    ("sftp_host", "SFTP Host", str),
+    ("userid", "Userid", str),
+    ("key_fingerprint", "key_fingerprint", str),
+    ("e_mail", "e-mail", str),
+    ("e_mail_domain", "e-mail Domain", str),
+    ("ip_restrictions", "IP restrictions", str),
+    ]
+ADDRESS_COLUMNS = 5
+CSV_HEADER = [header for _, header, _ in OUTPUT_COLUMNS]
+SQL_TYPES = {str: "TEXT", bool: "INTEGER", int: "INTEGER"}
+# rows written to sqlite or parquet at a time
+OUTPUT_BATCH = 10000
+################################################################################
+
+def address_row(ipaddr, ipdata):
+    """The address columns of the sessions from ipaddr"""
+    row_prefix = []
+    row_prefix.append(ipaddr)
+    row_prefix.append(ipdata.domain)
+    # Add change ARIN info here (results of IPwhois package)
+    if ipdata.whois_data == {}:
+        row_prefix.append("NONE") # Empty ARIA network name
+        row_prefix.append("NONE") # Empty ARIC country code
+    else:
+        row_prefix.append(ipdata.whois_data["network"]["name"])
+        row_prefix.append(ipdata.whois_data["asn_country_code"])
+
+    row_prefix.append(ipdata.isVCRP)
+    return row_prefix
+
+def session_row(ipaddr, sess):
+    """The rest of the columns of a session from ipaddr"""
+    row = []
+    row.append(format_time(sess.start_time))
+    if sess.stop_time is None:
+        row.append("")
+    else:
+        row.append(format_time(sess.stop_time))
+    row.append(sess.duration)
+    row.append(sess.counter)
+    row.append(sess.dc)
+    row.append(sess.sshdhost)
+    row.append(sess.userid)
+    row.append(sess.key_fingerprint)
+    if sess.e_mail :
+        row.append(sess.e_mail)
+        row.append(sess.e_mail.split("@")[-1]) # create domain name
+    else:
+        row.append("no-email")
+        row.append("no-email-domain")
+    if sess.options :
+        row.append(sess.options["from"])
+    else:
+        row.append("NONE")
+    return row
 
-                writer.writerow(row)
+class CSVOutput:
+    """One csv row per session, the address columns repeated on each"""
+    def __init__(self, path, append):
+        new = (not append or not os.path.exists(path) or
+               os.path.getsize(path) == 0)
+        self.file = open(path, 'ab' if append else 'wb')
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(CSV_HEADER)
+
+    def add(self, address, sessions):
+        self.writer.writerows([address + session for session in sessions])
+
+    def close(self):
+        self.file.close()
+
+class SQLiteOutput:
+    """
+    A sqlite database with an addresses table and a sessions table, indexed
+    on address, user and key fingerprint.  The session_rows view has the
+    columns of the csv.
+    """
+    def __init__(self, path, append):
+        if not append and os.path.exists(path):
+            os.unlink(path)
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        columns = ["%s %s" % (name, SQL_TYPES[kind])
+                   for name, _, kind in OUTPUT_COLUMNS]
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS addresses (%s PRIMARY KEY, %s);"
+            "CREATE TABLE IF NOT EXISTS sessions (addr TEXT, %s);"
+            "CREATE INDEX IF NOT EXISTS sessions_addr ON sessions (addr);"
+            "CREATE INDEX IF NOT EXISTS sessions_userid ON sessions (userid);"
+            "CREATE INDEX IF NOT EXISTS sessions_key_fingerprint"
+            " ON sessions (key_fingerprint);"
+            "CREATE VIEW IF NOT EXISTS session_rows AS SELECT %s"
+            " FROM addresses JOIN sessions USING (addr);" %
+            (columns[0], ", ".join(columns[1:ADDRESS_COLUMNS]),
+             ", ".join(columns[ADDRESS_COLUMNS:]),
+             ", ".join(name for name, _, _ in OUTPUT_COLUMNS)))
+        self.addresses = []
+        self.sessions = []
+
+    def add(self, address, sessions):
+        self.addresses.append(address)
+        self.sessions.extend([[address[0]] + session for session in sessions])
+        if len(self.sessions) >= OUTPUT_BATCH:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO addresses VALUES (%s)" %
+                            ", ".join("?" * ADDRESS_COLUMNS), self.addresses)
+        self.db.executemany("INSERT INTO sessions VALUES (%s)" %
+                            ", ".join("?" * (len(OUTPUT_COLUMNS) -
+                                             ADDRESS_COLUMNS + 1)),
+                            self.sessions)
+        self.db.commit()
+        self.addresses = []
+        self.sessions = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+class ParquetOutput:
+    """
+    Parquet: columnar, with the string columns dictionary encoded so the
+    hosts, users and the address columns repeated on every session take
+    next to no room, a row group per batch of sessions.  A parquet file
+    can't be added to, with --state path is a directory and every pass
+    writes its sessions to a new part-*.parquet file in it.
+    """
+    def __init__(self, path, append):
+        if append:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            path = os.path.join(path, "part-%d.parquet" %
+                                int(time.time() * 1000))
+        types = {str: pyarrow.string(), bool: pyarrow.bool_(),
+                 int: pyarrow.int32()}
+        self.schema = pyarrow.schema([pyarrow.field(name, types[kind])
+                                      for name, _, kind in OUTPUT_COLUMNS])
+        self.path = path
+        self.append = append
+        self.writer = None
+        self.columns = [[] for _ in OUTPUT_COLUMNS]
+        self.nrows = 0
+
+    def add(self, address, sessions):
+        for session in sessions:
+            for column, value in izip(self.columns, address + session):
+                column.append(value)
+        self.nrows += len(sessions)
+        if self.nrows >= OUTPUT_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.path, self.schema, use_dictionary=True,
+                compression="snappy")
+        if not self.nrows:
+            return
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type)
+             for column, field in izip(self.columns, self.schema)],
+            schema=self.schema))
+        self.columns = [[] for _ in OUTPUT_COLUMNS]
+        self.nrows = 0
+
+    def close(self):
+        # an empty pass of --state doesn't leave an empty part behind
+        if self.nrows or not self.append:
+            self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+OUTPUT_FORMATS = {
+    "csv": CSVOutput,
+    "sqlite": SQLiteOutput,
+    "parquet": ParquetOutput,
+    }
+
+def write_output(av, closed=None):
+    """
+    Write out the results to --output in --format.  With closed, the
+    address -> sessions that ended in a --state run, only those are added
+    to what is there, otherwise every session in SrcIPs replaces it.
+    """
+    if closed is None:
+        items = ((ipaddr, ipdata.session_list)
+                 for ipaddr, ipdata in SrcIPs.iteritems())
+    else:
+        items = closed.iteritems()
+    output = OUTPUT_FORMATS[av.format](av.output, closed is not None)
+    try:
+        for ipaddr, sessions in items:
+            output.add(address_row(ipaddr, SrcIPs[ipaddr]),
+                       [session_row(ipaddr, sess) for sess in sessions])
+    finally:
+        output.close()
     return
 
 
 def main():
     """
-    usage: vcrquery.py [-h] [--file FILE] [--keydir KEYDIR] [--vcrcidrs VCRCIDRS]
-                       [--csv CSV]
+    usage: vcrquery.py [-h] [--file FILE [FILE ...]] [--keydir KEYDIR]
+                       [--vcrcidrs VCRCIDRS] [--output OUTPUT]
+                       [--format {csv,sqlite,parquet}] [--cache CACHE]
+                       [--refresh] [--offline] [--workers WORKERS]
+                       [--chunk_size CHUNK_SIZE] [--state STATE]
+                       [--interval INTERVAL] [--timezone TIMEZONE]
+                       [--dns_rate DNS_RATE] [--rdap_rate RDAP_RATE]
+                       [--keyindex KEYINDEX]
+                       [--lookup_deadline LOOKUP_DEADLINE]
            process sftp log data
            optional arguments:
             -h, --help            show this help message and exit
-            --file FILE, -f FILE  If present, file to get log from, else stdin
+            --file FILE [FILE ...], -f FILE [FILE ...]
+                                  If present, files to get log from (oldest
+                                  first, .gz is ok), else stdin
             --keydir KEYDIR, -k KEYDIR
                                   If present, directory to get sshkeys from
+            --keyindex KEYINDEX   sqlite file to index the --keydir keys in,
+                                  only changed key files are parsed again
             --vcrcidrs VCRCIDRS, -c VCRCIDRS
                                   If present, file that contains the vcr cidr block
-            --csv CSV, -o CSV     file to output the csv result to
+            --output OUTPUT, --csv OUTPUT, -o OUTPUT
+                                  file to output the result to
+            --format {csv,sqlite,parquet}
+                                  format of the --output file
+            --cache CACHE         sqlite file to cache DNS and ARIN lookups in
+            --refresh             look every address up again, updating the
+                                  --cache
+            --offline             no DNS or ARIN lookups, only use the --cache
+            --workers WORKERS, -w WORKERS
+                                  processes to parse the log with
+            --chunk_size CHUNK_SIZE
+                                  MB of log handed to a worker at a time
+            --state STATE         follow the logs: only read what was
+                                  appended since the last run, keep the open
+                                  sessions in this file and append the ended
+                                  ones to the --output
+            --interval INTERVAL   with --state, keep following the logs and
+                                  check every INTERVAL seconds
+            --timezone TIMEZONE   timezone of the log timestamps that don't
+                                  say, "America/Los_Angeles", default local
+            --dns_rate DNS_RATE   reverse DNS lookups per second at most
+            --rdap_rate RDAP_RATE
+                                  ARIN (RDAP) lookups per second at most
+            --lookup_deadline LOOKUP_DEADLINE
+                                  seconds to wait for the lookups after the
+                                  logs are scanned
 
     """
 
     def get_opts():
         parser = argparse.ArgumentParser(description='process sftp log data')
-        parser.add_argument('--file',"-f", default="-",
-                   help="If present, file to get log from, else stdin")
+        parser.add_argument('--file',"-f", default=["-"], nargs="+",
+                   help="If present, files to get log from (oldest first,"
+                        " .gz is ok), else stdin")
         parser.add_argument('--keydir',"-k", default= None,
                    help="If present, directory to get sshkeys from")
+        parser.add_argument('--keyindex', default=None,
+                   help="sqlite file to index the --keydir keys in, only"
+                        " changed key files are parsed again")
         parser.add_argument('--vcrcidrs',"-c", default="vcr-cidr-blocks.txt",
                    help="If present, file that contains the vcr cidr block")
-        parser.add_argument('--csv',"-o", default="some.csv",
-                   help="file to output the csv result to")
+        parser.add_argument('--output',"--csv","-o", default="some.csv",
+                   help="file to output the result to")
+        parser.add_argument('--format', default="csv",
+                   choices=sorted(OUTPUT_FORMATS),
+                   help="format of the --output file")
+        parser.add_argument('--cache', default=None,
+                   help="sqlite file to cache DNS and ARIN lookups in")
+        parser.add_argument('--refresh', action="store_true",
+                   help="look every address up again, updating the --cache")
+        parser.add_argument('--offline', action="store_true",
+                   help="no DNS or ARIN lookups, only use the --cache")
+        parser.add_argument('--workers',"-w", type=int, default=1,
+                   help="processes to parse the log with")
+        parser.add_argument('--chunk_size', type=int, default=64,
+                   help="MB of log handed to a worker at a time")
+        parser.add_argument('--state', default=None,
+                   help="follow the logs: only read what was appended since"
+                        " the last run, keep the open sessions in this file"
+                        " and append the ended ones to the --output")
+        parser.add_argument('--interval', type=int, default=None,
+                   help="with --state, keep following the logs and check"
+                        " every INTERVAL seconds")
+        parser.add_argument('--timezone', default=None,
+                   help="timezone of the log timestamps that don't say,"
+                        " \"America/Los_Angeles\", default local")
+        parser.add_argument('--dns_rate', type=float, default=100.0,
+                   help="reverse DNS lookups per second at most")
+        parser.add_argument('--rdap_rate', type=float, default=10.0,
+                   help="ARIN (RDAP) lookups per second at most")
+        parser.add_argument('--lookup_deadline', type=float, default=600.0,
+                   help="seconds to wait for the lookups after the logs are"
+                        " scanned")
         args = parser.parse_args()
+        if args.state and [path for path in args.file
+                           if path == "-" or path.endswith(".gz")]:
+            parser.error("--state can only follow plain log files")
+        if args.interval and not args.state:
+            parser.error("--interval needs --state")
+        if args.format == "parquet" and pyarrow is None:
+            parser.error("--format parquet needs pyarrow")
         return args
 
     argv= get_opts()
+    if argv.timezone:
+        os.environ["TZ"] = argv.timezone
+        time.tzset()
     process_VCR_database(argv)
     process_sshkeys(argv)
+    if argv.state:
+        follow_logfile(argv)
+        return
     process_logfile(argv)
-    write_csv(argv)
+    write_output(argv)
     return
 
 
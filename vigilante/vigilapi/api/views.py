@@ -1,11 +1,22 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from multiprocessing.pool import ThreadPool
+import threading
 import json
 import re
 import os.path
-from dbapi import VigDB
+from dbapi import VigDB, VigDBFS
 
-s = VigDB()
+# Threads evaluating the queries of one batch request
+BATCH_WORKERS = 8
+
+if getattr( settings, "VIGILANTE_DB", "fs" ) == "fs":
+    s = VigDBFS()
+else:
+    s = VigDB()
 collector = s.login()
 templates = s.login("template_library")
 
@@ -48,3 +59,79 @@ def query_match_env_template( request, version, template, envid ):
     data_dict = s.find( collector, {"domain" : envid } )
     rs = s.match( templates, template_dict, collector, data_dict )
     return HttpResponse( json.dumps( rs ), content_type='application/json' )
+
+class _BatchCache( object ):
+    """ The templates and collector data fetched for one batch, by key. A key
+is fetched once, by the first query that needs it, the queries that need it
+meanwhile wait for that fetch rather than repeat it """
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get( self, key, fetch ):
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry is None:
+                entry = self.entries[ key ] = { "lock" : threading.Lock() }
+        with entry[ "lock" ]:
+            if "value" not in entry and "error" not in entry:
+                try:
+                    entry[ "value" ] = fetch()
+                except Exception, e:
+                    entry[ "error" ] = e
+        if "error" in entry:
+            raise entry[ "error" ]
+        return entry[ "value" ]
+
+def _batch_query( query, cache ):
+    """ Evaluate one query of a batch, cache is the _BatchCache of the batch """
+    index, item = query
+    result = dict( item, id=index )
+    try:
+        name = item[ "template" ]
+        template_dict = cache.get( ( "template", name ),
+                                   lambda: s.find_one( templates, {"name" : name } ) )
+        if "env" in item:
+            key, query_dict = ( "env", item[ "env" ] ), {"domain" : item[ "env" ] }
+            fetch = s.find
+        else:
+            key, query_dict = ( "role", item[ "role" ] ), {"fqdn" : item[ "role" ] }
+            fetch = s.find_one
+        data_dict = cache.get( key, lambda: fetch( collector, query_dict ) )
+        result[ "result" ] = s.match( templates, template_dict, collector, data_dict )
+    except Exception, e:
+        result[ "error" ] = "%s: %s" % ( e.__class__.__name__, e )
+    return result
+
+@csrf_exempt
+@require_POST
+def query_batch( request, version ):
+    """ Audit a list of {"template" : name, "env" : envid} and
+{"template" : name, "role" : fqdn} queries in parallel. The results are
+streamed back as newline delimited JSON as they complete, one object per
+query: the query, its "id" (the index of the query in the list) and either
+the "result" of the match or the "error" it failed with """
+    try:
+        queries = json.loads( request.body )
+    except ValueError:
+        return HttpResponseBadRequest( "request body is not JSON\n" )
+    if ( type( queries ) is not list or
+            not all( type( item ) is dict and "template" in item and
+                     ( "env" in item ) != ( "role" in item ) for item in queries ) ):
+        return HttpResponseBadRequest( 'expected a list of {"template" : name, '
+                                       '"env" : envid} or {"template" : name, "role" : fqdn}\n' )
+    cache = _BatchCache()
+
+    def stream():
+        if not queries:
+            return
+        pool = ThreadPool( min( BATCH_WORKERS, len( queries ) ) )
+        try:
+            for result in pool.imap_unordered(
+                    lambda query: _batch_query( query, cache ),
+                    enumerate( queries ) ):
+                yield json.dumps( result ) + "\n"
+        finally:
+            pool.terminate()
+    return StreamingHttpResponse( stream(), content_type='application/x-ndjson' )
@@ -80,3 +80,10 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Vigilante data store the API answers from, "fs" for the auditor tree and
+# template library on the NAS (dbapi.VigDBFS) or "mongo" (dbapi.VigDB, which
+# only answers current role queries so far)
+
+VIGILANTE_DB = 'fs'
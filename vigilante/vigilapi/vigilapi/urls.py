@@ -24,4 +24,6 @@ urlpatterns = patterns('',
         'api.views.query_match_template'),
     url(r'^vigilante/api/v([\d\.]+)/query/template/([^\/]+)/collector/env/current/(.*)$',
         'api.views.query_match_env_template'),
+    url(r'^vigilante/api/v([\d\.]+)/query/batch$',
+        'api.views.query_batch'),
 )
@@ -99,6 +99,12 @@ class VigilanteApi(VigApiHelper):
         return self.ws_get("/vigilante/api/v0.1/query/template/%s/collector/env/%s/%s" %
                            (tmplt, iso8601, envid))
 
+    def query_batch(self, queries):
+        '''queries is a list of {"template": name, "env": envid} and
+        {"template": name, "role": fqdn}, returns the results as newline
+        delimited JSON, one line per query in the order they completed'''
+        return self.ws_post("/vigilante/api/v0.1/query/batch", json.dumps(queries))
+
 # These are non-API helper functions
     
     def pretty_print(self,obj, ofd=sys.stdout): #TBD: this should be removed from the list of functions available to the user
@@ -5,12 +5,122 @@ import yaml
 import os.path
 import sys
 import collections
+import copy
+import sqlite3
+import threading
+import time
+import bisect
+from multiprocessing.pool import ThreadPool
 from os import listdir
-from datetime import datetime, timedelta
+from datetime import datetime
 from pymongo import MongoClient
 
 class DBUnimplementedError(Exception) : pass
 class DBIDnotpresentError(Exception) : pass
+class DBTemplateNotFoundError(Exception) : pass
+
+# Seconds an env is answered from the fact index before its directories are
+# looked at again
+SYNC_INTERVAL = 30
+# Threads reading history files for a time range query of an env
+READ_WORKERS = 16
+# A directory changed less than this many seconds ago may still change within
+# the same mtime, it is listed again the next time it is looked at
+MTIME_SETTLE = 2
+RANGE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FILE_TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+# Role patterns are combined into as few alternations as this many groups
+# allow, python's re supports 100 per expression
+MAX_GROUPS = 99
+# Role patterns that don't keep their meaning inside a bigger alternation:
+# inline flags apply to the whole expression and group references change
+UNCOMBINABLE = re.compile(r"\(\?[iLmsux]+\)|\\[1-9]|\(\?P=")
+
+class MatchPlan(object):
+    """ A template compiled for match.
+
+A role template becomes a list of (key, failed) checks, failed being a
+function of the collector value that is true if the value doesn't match.
+Numeric thresholds are parsed and "~" expressions are compiled here, once,
+rather than for every host matched. The "None" keys, which match anything,
+are left out.
+
+For an env template the role name patterns are combined into alternations,
+so ruling out a role no pattern matches is one regular expression match
+instead of one per pattern. Only the roles the alternations let through are
+matched against every pattern, as several patterns may match a role.
+"""
+
+    def __init__(self, template_dict):
+        self.type = template_dict['meta']['type']
+        self.checks = []
+        self.alternations = []
+        self.patterns = []
+        if self.type == "role":
+            for template_key, template_value in template_dict['body'].iteritems():
+                if template_value == "None":
+                    pass
+                elif type(template_value) is list:
+                    self.checks.append( ( template_key, self.operator( template_value ) ) )
+                elif type(template_value) is str:
+                    self.checks.append( ( template_key, self.operator( [ "=", template_value ] ) ) )
+                else:
+                    raise NotImplementedError
+        elif self.type == "env":
+            self.patterns = [ ( pattern, re.compile( pattern ) )
+                              for pattern in template_dict['body'] ]
+            self._combine( template_dict['body'].keys() )
+
+    @staticmethod
+    def operator(operator_list):
+        """ The check function of an [ operator, operand ] template value """
+        operator = operator_list[0]
+        if operator == ">":
+            threshold = int(operator_list[1])
+            return lambda data_value: not int(data_value) > threshold
+        elif operator == "<":
+            threshold = int(operator_list[1])
+            return lambda data_value: not int(data_value) < threshold
+        elif operator == "=":
+            operand = operator_list[1]
+            return lambda data_value: data_value != operand
+        elif operator == "!=":
+            operand = operator_list[1]
+            return lambda data_value: data_value == operand
+        elif operator == "~":
+            regex = re.compile( r"%s" % operator_list[1] )
+            return lambda data_value: not regex.match( data_value )
+        else:
+            raise NotImplementedError
+
+    def _combine(self, patterns):
+        """ Build the alternations of patterns. A pattern that can't be
+combined is matched on its own """
+        group, groups = [], 0
+        for pattern in patterns:
+            pattern_groups = re.compile( pattern ).groups
+            if UNCOMBINABLE.search( pattern ) or groups + pattern_groups > MAX_GROUPS:
+                self._add_alternation( group )
+                group, groups = [], 0
+            if UNCOMBINABLE.search( pattern ) or pattern_groups > MAX_GROUPS:
+                self.alternations.append( re.compile( pattern ) )
+                continue
+            group.append( pattern )
+            groups += pattern_groups
+        self._add_alternation( group )
+
+    def _add_alternation(self, patterns):
+        if patterns:
+            self.alternations.append( re.compile(
+                "|".join( "(?:%s)" % pattern for pattern in patterns ) ) )
+
+    def role_keys(self, role):
+        """ The set of template keys whose pattern matches role """
+        if not any( regex.match( role ) for regex in self.alternations ):
+            return set()
+        return set( pattern for pattern, regex in self.patterns
+                    if regex.match( role ) )
 
 class DbBaseAPI(object):
     """This is a Base or Abstract class and is not meant to be instantiated
@@ -72,35 +182,31 @@ calls match on each role lookup found.
 
         # Different processing for Roles and envs
         result_dict = {"meta" : template_dict['meta'].copy(), "body": {}, "summary" : "success" }
+        plan = self._plan( template_dict )
 
-        if template_dict['meta']['type'] == "role":
+        if plan.type == "role":
             result_dict['meta']['type'] = "role-diff"
-            for template_key, template_value in template_dict['body'].iteritems():
-                if template_value == "None":
-                    pass
-                elif type(template_value) is list:
-                    rval = self._match_operator( template_value, data_dict['body'][ template_key ] )
-                    if rval :
-                        result_dict['body'][template_key] = data_dict['body'][template_key]
-                        result_dict['summary'] = 'fail'
-                elif type(template_value) is str:
-                    if ( template_value != data_dict['body'][ template_key ] ):
-                        result_dict['body'][template_key] = data_dict['body'][template_key]
-                        result_dict['summary'] = 'fail'
-                else:
-                    raise NotImplementedError
+            data_body = data_dict['body']
+            for template_key, failed in plan.checks:
+                data_value = data_body[ template_key ]
+                if failed( data_value ):
+                    result_dict['body'][template_key] = data_value
+                    result_dict['summary'] = 'fail'
             return result_dict
-        elif template_dict['meta']['type'] == "env":
+        elif plan.type == "env":
             result_dict['meta']['type'] = "env-diff"
             result_dict['template'] = {}  # env-diffs have a template dict added
-            role_list = data_dict['body'].keys()
-            for template_key, template_value in template_dict['body'].iteritems():
-
-                role_matches = []
-                for element in role_list:
-                    if re.match(template_key, element):
-                        role_matches.append(element)
-                for matched_key in role_matches:    
+            role_templates = {}
+            for matched_key in data_dict['body']:
+                template_keys = plan.role_keys( matched_key )
+                if not template_keys:
+                    continue
+                # every pattern matching the role is matched, in template
+                # order: a failure of any of them fails the env, the role's
+                # result is the one of the last
+                for template_key, template_value in template_dict['body'].iteritems():
+                    if template_key not in template_keys:
+                        continue
                     result_dict['body'][matched_key] = []
                     if template_value == "None":
                         pass
@@ -111,9 +217,11 @@ calls match on each role lookup found.
                         # collector data to. Which means that we need to use this name to fetch
                         # the template to do a match with the provided collector data in
                         # data_dict['body'][template_key][0]['current']
-                        role_match_template = self.find_one(tdbid, {"name" : template_value})
+                        if template_value not in role_templates:
+                            role_templates[template_value] = self._template(tdbid, template_value)
+                        role_match_template = role_templates[template_value]
                         result_dict['template'][matched_key] = role_match_template
-                        if matched_key in data_dict['body'] and data_dict['body'][matched_key] :
+                        if data_dict['body'][matched_key] :
                             role_match = self.match( tdbid, role_match_template, 
                                             cdbid, data_dict['body'][matched_key][0]['current'] )
                             if role_match['summary'] == 'fail':
@@ -125,35 +233,21 @@ calls match on each role lookup found.
         else:
             raise NotImplementedError
 
+    def _template(self, tdbid, name):
+        """ The resolved template called name, for use by match. Backends with a
+template cache return the cached template, which must not be changed """
+        return self.find_one(tdbid, {"name" : name})
+
+    def _plan(self, template_dict):
+        """ The MatchPlan of a template, backends with a template cache keep it
+with the cached template """
+        return MatchPlan(template_dict)
+
     def _match_operator( self, operator_list, data_value ):
-        operator = operator_list[0]
-        if operator == ">":
-            if not int(data_value) > int(operator_list[1]):
-                return data_value
-            else:
-                return None
-        elif operator == "<":
-            if not int(data_value) < int(operator_list[1]):
-                return data_value
-            else:
-                return None
-        elif operator == "=":
-            if not data_value == operator_list[1]:
-                return data_value
-            else:
-                return None
-        elif operator == "!=":
-            if not data_value != operator_list[1]:
-                return data_value
-            else:
-                return None
-        elif operator == "~":
-            if not re.match( r"%s" % operator_list[1], data_value ):
-                return data_value
-            else:
-                return None
+        if MatchPlan.operator( operator_list )( data_value ):
+            return data_value
         else:
-            raise NotImplementedError
+            return None
 
     def _update(self,d, u):
         for k, v in u.iteritems():
@@ -173,15 +267,329 @@ calls match on each role lookup found.
             merged_template = self._resolve_template(dbid, next_template)
             return self._update(merged_template, template_dict)
 
+class FactIndex(object):
+    """ Local SQLite copy of the current facts in the auditor tree.
+
+The auditor tree is <auditroot>/<envid>/<hostname>/ with a "current" symlink
+to the latest phaktor record of the host. Every host's current record is
+kept decoded in the index, keyed by (env, host, timestamp), so answering a
+query doesn't mean opening and parsing a file per host on the NAS. The index
+is kept in sync by mtime: the host list of an env is only listed again when
+the env directory changes, and a record is only read again when the file
+"current" points to has a different mtime or size. An env is synced at most
+once every interval seconds, in between it is answered from the index alone.
+path is the SQLite file, the default keeps the index in memory.
+"""
+
+    def __init__(self, auditroot, path=":memory:", interval=SYNC_INTERVAL):
+        self.auditroot_path = auditroot
+        self.interval = interval
+        self.synced = {}
+        self.lock = threading.Lock()         # the SQLite connection
+        self.env_locks = {}                  # envid -> lock held while syncing it
+        self.db = sqlite3.connect( path, check_same_thread=False )
+        self.db.text_factory = str
+        self.db.executescript( """
+            CREATE TABLE IF NOT EXISTS envs (
+                env TEXT PRIMARY KEY, mtime REAL);
+            CREATE TABLE IF NOT EXISTS hosts (
+                env TEXT, host TEXT, PRIMARY KEY (env, host));
+            CREATE TABLE IF NOT EXISTS facts (
+                env TEXT, host TEXT, timestamp TEXT, mtime REAL, size INTEGER,
+                data TEXT, PRIMARY KEY (env, host, timestamp));
+            """ )
+
+    def sync(self, envid, force=False):
+        """ Bring the index of envid up to date with the auditor tree, raises
+OSError if there is no such env. The auditor tree is read without holding
+the index lock, so a slow sync of one env doesn't hold up queries of the
+others; syncs of the same env wait for each other """
+        with self.lock:
+            if not force and time.time() - self.synced.get( envid, 0 ) < self.interval:
+                return
+            env_lock = self.env_locks.setdefault( envid, threading.Lock() )
+        with env_lock:
+            with self.lock:
+                # synced by another thread while this one waited
+                if not force and time.time() - self.synced.get( envid, 0 ) < self.interval:
+                    return
+            now = time.time()
+            env_path = os.path.join( self.auditroot_path, envid )
+            try:
+                env_mtime = os.stat( env_path ).st_mtime
+            except OSError:
+                with self.lock:
+                    self._forget( envid )
+                    self.synced.pop( envid, None )
+                raise
+            with self.lock:
+                row = self.db.execute( "SELECT mtime FROM envs WHERE env = ?",
+                                       ( envid, ) ).fetchone()
+            if row is None or row[0] != env_mtime:
+                hosts = set( host for host in listdir( env_path )
+                             if os.path.isdir( os.path.join( env_path, host ) ) )
+                # a directory that just changed may change again within the
+                # same mtime, don't record it until it has settled
+                if now - env_mtime < MTIME_SETTLE:
+                    env_mtime = None
+                with self.lock:
+                    self._sync_hosts( envid, hosts )
+                    self.db.execute( "INSERT OR REPLACE INTO envs VALUES (?, ?)",
+                                     ( envid, env_mtime ) )
+            with self.lock:
+                known = dict( ( host, ( mtime, size ) ) for host, mtime, size in
+                    self.db.execute( "SELECT hosts.host, facts.mtime, facts.size "
+                                     "FROM hosts LEFT JOIN facts ON "
+                                     "facts.env = hosts.env AND facts.host = hosts.host "
+                                     "AND facts.timestamp = 'current' "
+                                     "WHERE hosts.env = ?", ( envid, ) ) )
+            changes = [ ( host, self._read_current( os.path.join( env_path, host, "current" ),
+                                                    known[ host ] ) )
+                        for host in known ]
+            with self.lock:
+                for host, current in changes:
+                    if current is False:
+                        self.db.execute( "DELETE FROM facts WHERE env = ? AND host = ?",
+                                         ( envid, host ) )
+                    elif current is not None:
+                        self.db.execute( "INSERT OR REPLACE INTO facts VALUES "
+                                         "(?, ?, 'current', ?, ?, ?)",
+                                         ( envid, host ) + current )
+                self.db.commit()
+                self.synced[ envid ] = now
+
+    def _forget(self, envid):
+        for table in ( "envs", "hosts", "facts" ):
+            self.db.execute( "DELETE FROM %s WHERE env = ?" % table, ( envid, ) )
+        self.db.commit()
+
+    def _sync_hosts(self, envid, hosts):
+        known = set( host for ( host, ) in self.db.execute(
+                "SELECT host FROM hosts WHERE env = ?", ( envid, ) ) )
+        for host in known - hosts:
+            self.db.execute( "DELETE FROM hosts WHERE env = ? AND host = ?",
+                             ( envid, host ) )
+            self.db.execute( "DELETE FROM facts WHERE env = ? AND host = ?",
+                             ( envid, host ) )
+        self.db.executemany( "INSERT INTO hosts VALUES (?, ?)",
+                             [ ( envid, host ) for host in hosts - known ] )
+
+    @staticmethod
+    def _read_current(current_path, known):
+        """ The (mtime, size, data) to index for current_path, None to keep
+what is indexed, False if there is no current record. known is the (mtime,
+size) indexed for it """
+        try:
+            st = os.stat( current_path )
+        except OSError:
+            return False
+        if known == ( st.st_mtime, st.st_size ):
+            return None
+        try:
+            data = json.dumps( json.loads( open( current_path ).read() ) )
+        except ( IOError, ValueError ):
+            # phaktor links current before it writes the record, leave what
+            # we had until the next sync finds it complete
+            return None
+        return ( st.st_mtime, st.st_size, data )
+
+    def hosts(self, envid):
+        """ The host directories of envid, sorted """
+        self.sync( envid )
+        with self.lock:
+            return [ host for ( host, ) in self.db.execute(
+                "SELECT host FROM hosts WHERE env = ? ORDER BY host", ( envid, ) ) ]
+
+    def current(self, envid, hostname):
+        """ The current facts of a host, None if it has none """
+        self.sync( envid )
+        with self.lock:
+            row = self.db.execute( "SELECT data FROM facts WHERE env = ? AND "
+                                   "host = ? AND timestamp = 'current'",
+                                   ( envid, hostname ) ).fetchone()
+        return json.loads( row[0] ) if row is not None else None
+
+    def env_current(self, envid):
+        """ The current facts of every host of envid that has them, as a dict
+of hostname to facts"""
+        self.sync( envid )
+        with self.lock:
+            rows = self.db.execute( "SELECT host, data FROM facts WHERE env = ? "
+                                    "AND timestamp = 'current'",
+                                    ( envid, ) ).fetchall()
+        return dict( ( host, json.loads( data ) ) for host, data in rows )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class TemplateCache(object):
+    """ Resolved templates of the template library, parsed once per change.
+
+Every template is kept merged with its ancestors (see _resolve_template)
+along with the mtime and size of its file and of the files of all of its
+ancestors. A template is read again when any of those files changes, and
+because each template knows the templates that inherit from it, editing a
+parent evicts all of its children as well. The MatchPlan of a cached
+template is kept with it, and is found for copies of the template (what
+find_one hands out) by the template's content. merge is the function that
+merges a child template into its resolved parent.
+"""
+
+    def __init__(self, tlroot, merge):
+        self.templib_path = tlroot
+        self.merge = merge
+        self.entries = {}
+        self.children = collections.defaultdict( set )
+        self.by_id = {}
+        self.by_content = {}
+        self.lock = threading.RLock()
+
+    def _path(self, name):
+        return "%s/%s.yaml" % ( self.templib_path, name )
+
+    def _stat(self, name):
+        try:
+            st = os.stat( self._path( name ) )
+        except OSError:
+            return None
+        return ( st.st_mtime, st.st_size )
+
+    def get(self, name):
+        """ The resolved template called name, None if there is no such file.
+The template is shared, copy it before changing it """
+        with self.lock:
+            entry = self.entries.get( name )
+            if entry is not None:
+                for dep, stat in entry['files'].iteritems():
+                    if self._stat( dep ) != stat:
+                        self.evict( dep )
+                        entry = None
+                        break
+            if entry is None:
+                entry = self._load( name )
+            return entry['template'] if entry is not None else None
+
+    def _load(self, name):
+        stat = self._stat( name )
+        if stat is None:
+            return None
+        template_dict = yaml.load( open( self._path( name ) ).read() )
+        files = { name : stat }
+        super = template_dict["meta"]["super"]
+        if super and super not in ( "none", "None" ):
+            parent = self.get( super )
+            if parent is None:
+                raise DBTemplateNotFoundError( "%s: no template %s" % ( name, super ) )
+            files.update( self.entries[ super ]['files'] )
+            self.children[ super ].add( name )
+            template_dict = self.merge( copy.deepcopy( parent ), template_dict )
+        entry = { 'template' : template_dict, 'files' : files, 'plan' : None,
+                  'content' : self._content( template_dict ) }
+        self.entries[ name ] = entry
+        self.by_id[ id( template_dict ) ] = entry
+        self.by_content[ entry['content'] ] = entry
+        return entry
+
+    @staticmethod
+    def _content(template_dict):
+        return repr( ( template_dict['meta'].get( 'type' ),
+                       sorted( template_dict['body'].items() ) ) )
+
+    def evict(self, name):
+        """ Forget the template called name and every template inheriting from it """
+        with self.lock:
+            entry = self.entries.pop( name, None )
+            if entry is not None:
+                del self.by_id[ id( entry['template'] ) ]
+                if self.by_content.get( entry['content'] ) is entry:
+                    del self.by_content[ entry['content'] ]
+            for child in self.children.pop( name, () ):
+                self.evict( child )
+
+    def plan(self, template_dict):
+        """ The MatchPlan of a template returned by get() or of a copy of one,
+templates that aren't in the cache are compiled every time """
+        with self.lock:
+            entry = self.by_id.get( id( template_dict ) )
+            if entry is None or entry['template'] is not template_dict:
+                entry = self.by_content.get( self._content( template_dict ) )
+            if entry is None:
+                return MatchPlan( template_dict )
+            if entry['plan'] is None:
+                entry['plan'] = MatchPlan( template_dict )
+            return entry['plan']
+
+class TimeIndex(object):
+    """ Sorted timestamps of the history files of every role directory.
+
+phaktor names its records <hostname>.<YYYYmmddTHHMMSS>, and keeps a number
+of them next to "current". A role directory is listed again only when its
+mtime changes, and then only the new file names are parsed, so a time range
+query is a binary search in the directory's sorted timestamps rather than a
+listdir and a strptime per file.
+"""
+
+    def __init__(self):
+        self.dirs = {}
+        self.lock = threading.Lock()
+
+    def _update(self, role_dir_path):
+        mtime = os.stat( role_dir_path ).st_mtime
+        entry = self.dirs.get( role_dir_path )
+        if entry is not None and entry['mtime'] == mtime:
+            return entry
+        names = set( listdir( role_dir_path ) )
+        names.discard( "current" )
+        known = entry['known'] if entry is not None else {}
+        known = dict( ( name, stamp ) for name, stamp in known.iteritems()
+                      if name in names )
+        for name in names.difference( known ):
+            m = re.match( r"[^\.]+\.([^\.]+)$", name )
+            try:
+                file_time = datetime.strptime( m.group( 1 ), FILE_TIME_FORMAT )
+            except ( AttributeError, ValueError ):
+                known[ name ] = None        # not a phaktor record
+                continue
+            known[ name ] = ( m.group( 1 ), file_time.strftime( RANGE_TIME_FORMAT ), name )
+        # a directory that just changed may change again within the same
+        # mtime, don't trust it until it has settled
+        settled = time.time() - mtime >= MTIME_SETTLE
+        entry = { 'mtime' : mtime if settled else None, 'known' : known,
+                  'stamps' : sorted( stamp for stamp in known.itervalues() if stamp ) }
+        self.dirs[ role_dir_path ] = entry
+        return entry
+
+    def range(self, role_dir_path, starttime, endtime):
+        """ The history files of role_dir_path strictly between starttime and
+endtime (datetimes), as a list of (time as RANGE_TIME_FORMAT, path) in time
+order """
+        start = starttime.strftime( FILE_TIME_FORMAT )
+        end = endtime.strftime( FILE_TIME_FORMAT )
+        with self.lock:
+            stamps = self._update( role_dir_path )['stamps']
+            first = bisect.bisect_right( stamps, ( start, "\xff" ) )
+            last = bisect.bisect_left( stamps, ( end, ) )
+            return [ ( iso, os.path.join( role_dir_path, name ) )
+                     for stamp, iso, name in stamps[ first:last ] ]
+
 class VigDBFS(DbBaseAPI):
     """ This is the current implementation that store data in the file system.
 Don't call this implementation dependent class, use the generic wrapper instead.
 """
 
     def __init__(self,auditroot='/nas/reg/log/jiralab/vigilante/auditor'
-                 , tlroot='/nas/reg/log/jiralab/vigilante/template_library'):
+                 , tlroot='/nas/reg/log/jiralab/vigilante/template_library'
+                 , factdb=":memory:"):
+        """ factdb is the SQLite file of the fact index the current facts are
+answered from, see FactIndex """
         self.auditroot_path = auditroot
         self.templib_path = tlroot
+        self.facts = FactIndex( auditroot, factdb )
+        self.templates = TemplateCache( tlroot, self._update )
+        self.history = TimeIndex()
+        self.read_pool = None
+        self.read_pool_lock = threading.Lock()
         super(VigDBFS,self).__init__()
 
     def login(self,space="collector"):
@@ -210,15 +618,14 @@ are used in matching operations
             m = re.match( r"(^[A-z]+[0-9]{2})", hostname)
             envid = m.group(1)
             if timestamp == "current":
-                result_path = "%s/%s/%s/current" % ( self.auditroot_path, envid, hostname)
-                if ( os.path.isfile( result_path ) ):
-                    return_dict = json.loads( open( result_path ).read() )
+                try:
+                    return_dict = self.facts.current( envid, hostname ) or {}
+                except OSError:
+                    pass
         elif dbtype == "template_library":
-            name = query_dict["name"]
-            result_path = "%s/%s.yaml" % (self.templib_path, name)
-            if ( os.path.isfile( result_path ) ):
-                return_dict = yaml.load(open( result_path ).read() )
-                return_dict = self._resolve_template( dbid, return_dict )
+            template_dict = self.templates.get( query_dict["name"] )
+            if template_dict is not None:
+                return_dict = copy.deepcopy( template_dict )
         return return_dict
 
     def find(self, dbid, query_dict):
@@ -235,44 +642,63 @@ are used in matching operations
             envid = query_dict["domain"]
             m = re.match( r"(^[A-z]+[0-9]{2})", envid)
             return_dict['meta'][ 'envid' ] = envid
+            if timestamp == "current":
+                current = self.facts.env_current( envid )
+                for role_path in self.facts.hosts( envid ):
+                    if role_path in current:
+                        return_dict['body'][ role_path ] = [ { "current" : current[ role_path ] } ]
+                    else:
+                        return_dict['body'][ role_path ] = []
+                return return_dict
             result_set_path = "%s/%s" % ( self.auditroot_path, envid )
-            env_role_paths = [ role_path for role_path in listdir( result_set_path ) 
-                              if os.path.isdir( os.path.join( result_set_path, role_path ) ) ]
-            for role_path in env_role_paths:
+            reads = []
+            for role_path in self.facts.hosts( envid ):
                 file_dict = self._find_file_in_time( os.path.join( result_set_path, role_path ), timestamp )
-                role_facter_in_time_range = []
-                for file_key, file_value in file_dict.iteritems():
-                    if ( os.path.isfile( file_value ) ):
-                        role_facter_in_time_range.append( { file_key: json.loads( open( file_value ).read() ) } )
-                return_dict['body'][ role_path ] = role_facter_in_time_range
+                return_dict['body'][ role_path ] = []
+                reads.extend( ( role_path, file_key, file_value )
+                              for file_key, file_value in sorted( file_dict.iteritems() ) )
+            # the history files are on the NAS, read them all at once
+            with self.read_pool_lock:
+                if self.read_pool is None:
+                    self.read_pool = ThreadPool( READ_WORKERS )
+            for ( role_path, file_key, file_value ), data in zip(
+                    reads, self.read_pool.map( self._read_facts, [ read[2] for read in reads ] ) ):
+                if data is not None:
+                    return_dict['body'][ role_path ].append( { file_key: data } )
         elif dbtype == "template_library":
             return_dict = {'meta' : { 'type' : 'template-bundle'}, 'body' : {}}
             tl_list = os.listdir(self.templib_path)
             for file in tl_list :
-                result_path = "%s/%s" % (self.templib_path, file)
-                return_dict['body'][os.path.splitext(file)[0]] = self._resolve_template( dbid, yaml.load( open( result_path ).read() ) )
+                name, ext = os.path.splitext(file)
+                if ext != ".yaml":
+                    continue
+                return_dict['body'][name] = copy.deepcopy( self.templates.get( name ) )
         return return_dict
 
+    def _template(self, tdbid, name):
+        if tdbid not in self.threads :
+            raise DBIDnotpresentError
+        return self.templates.get( name ) or {}
+
+    def _plan(self, template_dict):
+        return self.templates.plan( template_dict )
+
+    @staticmethod
+    def _read_facts(path):
+        # phaktor may have removed the file since the directory was indexed
+        try:
+            return json.loads( open( path ).read() )
+        except IOError:
+            return None
+
     # Find the files in the directory based on timestamp
     def _find_file_in_time(self, role_dir_path, timestamp):
         if timestamp == "current":
             return { "current" : os.path.join( role_dir_path, "current" ) }
         elif "starttime" in timestamp and "endtime" in timestamp:
-            RANGE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
-            FILE_TIME_FORMAT = '%Y%m%dT%H%M%S'
             range_start_time = datetime.strptime( timestamp[ "starttime"], RANGE_TIME_FORMAT )
             range_end_time = datetime.strptime( timestamp[ "endtime"], RANGE_TIME_FORMAT )
-            historical_file_paths = [ hist_file for hist_file in listdir( role_dir_path ) ]
-            file_dict = {}
-            for hist_file in historical_file_paths:
-                if not hist_file == "current":
-                    m = re.match( r"[^\.]+\.([^\.]+)", hist_file )
-                    file_timestamp = m.group( 1 )
-                    file_time = datetime.strptime( file_timestamp, FILE_TIME_FORMAT )
-                    if ( ( file_time - range_start_time ) > timedelta( seconds = 0 )
-                            and ( range_end_time - file_time ) > timedelta( seconds = 0 ) ):
-                        file_dict[ file_time.strftime( RANGE_TIME_FORMAT ) ] = os.path.join( role_dir_path, hist_file )
-            return file_dict
+            return dict( self.history.range( role_dir_path, range_start_time, range_end_time ) )
 
 class VigDBMongo(DbBaseAPI):
     """ This is the current implementation that store data in the file system.
@@ -0,0 +1,229 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark vigilante env audits on a synthetic fleet.
+
+Writes an auditor tree of --envs environments with --roles hosts each, a
+phaktor record per host, and a template library with a generic template,
+one template per role type inheriting from it and an env template per
+environment, unless --dir points at one written before. Then audits every
+environment through VigDBFS the way the query API does (find_one for the
+env template, find for the collector data, match) and prints envs/sec for
+the whole audit and for match alone, with --legacy also for the match loop
+match used to run (a regular expression match per template key and role
+name, operator dispatch and int() of the thresholds for every host).
+
+    dbbench.py --envs 500 --roles 50 --legacy
+    dbbench.py --dir /var/tmp/fleet --rounds 5
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import dbapi
+
+# role type, template body of the role type
+ROLE_TYPES = [
+    ("sws", {"processorcount": [">", "1"], "memorysize": ["~", r"[48]\.00 GB"]}),
+    ("api", {"processorcount": [">", "3"], "uptime_days": ["<", "365"]}),
+    ("dbs", {"memorysize": ["~", r"(16|32)\.00 GB"], "swapsize": "8.00 GB"}),
+    ("mqm", {"kernelrelease": ["!=", "2.6.18-308.4.1.el5"]}),
+    ("bpm", {"processorcount": ["=", "4"], "is_virtual": "true"}),
+    ("lcx", {"uptime_days": ["<", "100"], "virtual": "vmware"}),
+    ("ccs", {"memorysize": ["~", r"\d+\.00 GB"]}),
+    ("jms", {"swapsize": ["~", r"[0-9.]+ GB"], "processorcount": [">", "1"]}),
+    ("abi", {"operatingsystemrelease": ["=", "5.8"]}),
+    ("slr", {"processorcount": [">", "7"], "memorysize": ["~", r"32\.00 GB"]}),
+    ]
+GENERIC = {
+    "architecture": "x86_64",
+    "operatingsystem": "CentOS",
+    "operatingsystemrelease": ["~", r"5\.\d+"],
+    "hostname": "None",
+    "fqdn": "None",
+    }
+
+
+def env_names(envs):
+    """srwd00 ... srwq00 ... as many env ids as asked for"""
+    return ["srw%s%02d" % ("dqeabcfghijklmnoprstuvwxyz"[n / 100], n % 100)
+            for n in range(envs)]
+
+
+def facts(host, env, rnd):
+    return {
+        "hostname": host,
+        "fqdn": "%s.%s.com" % (host, env),
+        "architecture": "x86_64",
+        "operatingsystem": "CentOS",
+        "operatingsystemrelease": rnd.choice(["5.8", "5.8", "6.2"]),
+        "kernelrelease": rnd.choice(["2.6.18-308.4.1.el5", "2.6.32-220"]),
+        "processorcount": str(rnd.choice([2, 4, 8])),
+        "memorysize": rnd.choice(["4.00 GB", "8.00 GB", "16.00 GB", "32.00 GB"]),
+        "swapsize": rnd.choice(["1.97 GB", "8.00 GB"]),
+        "is_virtual": rnd.choice(["true", "false"]),
+        "virtual": rnd.choice(["vmware", "physical"]),
+        "uptime_days": str(rnd.randint(0, 500)),
+        }
+
+
+def make_fleet(root, envs, roles):
+    """Write the auditor tree and template library of the fleet under root,
+returns (auditroot, tlroot)"""
+    rnd = random.Random(envs * 1000 + roles)
+    auditroot = os.path.join(root, "auditor")
+    tlroot = os.path.join(root, "template_library")
+    os.makedirs(tlroot)
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+
+    def template(name, meta, body):
+        with open(os.path.join(tlroot, name + ".yaml"), "w") as f:
+            json.dump({"meta": meta, "body": body}, f, indent=4)  # JSON is YAML
+
+    template("generic", {"super": "None", "type": "role", "version": "0.1"},
+             GENERIC)
+    for role_type, body in ROLE_TYPES:
+        template("role-" + role_type, {"super": "generic"}, body)
+    for env in env_names(envs):
+        template(env, {"super": "None", "type": "env", "version": "0.1"},
+                 dict(("%s%s\\d{3}" % (env, role_type), "role-" + role_type)
+                      for role_type, body in ROLE_TYPES))
+        for n in range(roles):
+            host = "%s%s%03d" % (env, ROLE_TYPES[n % len(ROLE_TYPES)][0], n)
+            host_dir = os.path.join(auditroot, env, host)
+            os.makedirs(host_dir)
+            record = "%s.%s" % (host, stamp)
+            with open(os.path.join(host_dir, record), "w") as f:
+                json.dump({"meta": {"type": "phaktor", "name": "Generic",
+                                    "version": "0.1"},
+                           "body": facts(host, env, rnd)}, f)
+            os.symlink(record, os.path.join(host_dir, "current"))
+    return auditroot, tlroot
+
+
+def legacy_match(s, tdbid, template_dict, cdbid, data_dict):
+    """The match loop before match plans, minus the template reads"""
+    result_dict = {"meta": template_dict['meta'].copy(), "body": {},
+                   "summary": "success"}
+    if template_dict['meta']['type'] == "role":
+        result_dict['meta']['type'] = "role-diff"
+        for template_key, template_value in template_dict['body'].iteritems():
+            if template_value == "None":
+                pass
+            elif type(template_value) is list:
+                rval = legacy_match_operator(template_value,
+                                             data_dict['body'][template_key])
+                if rval:
+                    result_dict['body'][template_key] = data_dict['body'][template_key]
+                    result_dict['summary'] = 'fail'
+            elif template_value != data_dict['body'][template_key]:
+                result_dict['body'][template_key] = data_dict['body'][template_key]
+                result_dict['summary'] = 'fail'
+        return result_dict
+    result_dict['meta']['type'] = "env-diff"
+    result_dict['template'] = {}
+    role_list = data_dict['body'].keys()
+    for template_key, template_value in template_dict['body'].iteritems():
+        role_matches = [element for element in role_list
+                        if re.match(template_key, element)]
+        for matched_key in role_matches:
+            result_dict['body'][matched_key] = []
+            if type(template_value) is str and template_value != "None":
+                role_match_template = s._template(tdbid, template_value)
+                result_dict['template'][matched_key] = role_match_template
+                if data_dict['body'][matched_key]:
+                    role_match = legacy_match(s, tdbid, role_match_template, cdbid,
+                                              data_dict['body'][matched_key][0]['current'])
+                    if role_match['summary'] == 'fail':
+                        result_dict['summary'] = 'fail'
+                    result_dict['body'][matched_key].append(role_match)
+    return result_dict
+
+
+def legacy_match_operator(operator_list, data_value):
+    operator = operator_list[0]
+    if operator == ">":
+        return data_value if not int(data_value) > int(operator_list[1]) else None
+    elif operator == "<":
+        return data_value if not int(data_value) < int(operator_list[1]) else None
+    elif operator == "=":
+        return data_value if not data_value == operator_list[1] else None
+    elif operator == "!=":
+        return data_value if not data_value != operator_list[1] else None
+    elif operator == "~":
+        return data_value if not re.match(r"%s" % operator_list[1], data_value) else None
+    raise NotImplementedError
+
+
+def audit(s, envs, match):
+    """Audit every env, returns (seconds for all of it, seconds in match,
+failed envs)"""
+    collector = s.login()
+    templates = s.login("template_library")
+    total = in_match = 0.0
+    failed = 0
+    for env in envs:
+        start = time.time()
+        template_dict = s.find_one(templates, {"name": env})
+        data_dict = s.find(collector, {"domain": env})
+        matched = time.time()
+        rs = match(s, templates, template_dict, collector, data_dict)
+        end = time.time()
+        total += end - start
+        in_match += end - matched
+        failed += rs['summary'] == 'fail'
+    return total, in_match, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time vigilante env audits on a synthetic fleet")
+    parser.add_argument('--envs', "-e", type=int, default=500,
+                        help="environments in the fleet")
+    parser.add_argument('--roles', "-r", type=int, default=50,
+                        help="hosts in every environment")
+    parser.add_argument('--dir', "-d", default=None,
+                        help="fleet written by an earlier run, kept")
+    parser.add_argument('--rounds', type=int, default=3,
+                        help="audits of the whole fleet, the first one loads "
+                        "the fact index and the template cache")
+    parser.add_argument('--legacy', action="store_true",
+                        help="also time the old match loop")
+    av = parser.parse_args()
+
+    if av.dir and os.path.isdir(os.path.join(av.dir, "auditor")):
+        root = av.dir
+        auditroot = os.path.join(root, "auditor")
+        tlroot = os.path.join(root, "template_library")
+        envs = sorted(os.listdir(auditroot))
+    else:
+        root = av.dir or tempfile.mkdtemp(prefix="dbbench")
+        start = time.time()
+        auditroot, tlroot = make_fleet(root, av.envs, av.roles)
+        envs = env_names(av.envs)
+        print "fleet of %d envs x %d roles written to %s in %.1fs" % (
+            len(envs), av.roles, root, time.time() - start)
+    try:
+        s = dbapi.VigDBFS(auditroot, tlroot)
+        runs = [("match plans", lambda s, *args: s.match(*args))]
+        if av.legacy:
+            runs.append(("legacy", legacy_match))
+        for name, match in runs:
+            for n in range(av.rounds):
+                total, in_match, failed = audit(s, envs, match)
+                print "%-12s round %d: %7.1f envs/s audited, %8.1f envs/s " \
+                    "matched, %d failed" % (name, n + 1, len(envs) / total,
+                                            len(envs) / in_match, failed)
+                sys.stdout.flush()
+    finally:
+        if not av.dir:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
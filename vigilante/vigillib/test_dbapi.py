@@ -0,0 +1,84 @@
+#!/usr/bin/env python2.7
+"""
+Tests of dbapi, run from this directory with
+
+    python -m unittest test_dbapi
+"""
+import unittest
+
+import dbapi
+
+
+class DictDB(dbapi.DbBaseAPI):
+    """ Templates from a dict, match doesn't need anything else """
+
+    def __init__(self, templates):
+        super(DictDB, self).__init__()
+        self.templates = templates
+
+    def find_one(self, dbid, query_dict):
+        return self.templates[ query_dict["name"] ]
+
+
+def role_template(body):
+    return {"meta" : {"type" : "role", "super" : "None"}, "body" : body}
+
+
+def env_template(body):
+    return {"meta" : {"type" : "env", "super" : "None"}, "body" : body}
+
+
+def env_data(hosts):
+    return {"meta" : {"type" : "phaktor-bundle"},
+            "body" : dict( ( host, [ {"current" : {"body" : facts}} ] )
+                           for host, facts in hosts.iteritems() )}
+
+
+class MatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s = DictDB({
+            "generic" : role_template({"memorysize_mb" : [">", "100"]}),
+            "sws" : role_template({"processorcount" : [">", "1"]}),
+            })
+        self.templates = self.s.login("template_library")
+        self.collector = self.s.login("collector")
+
+    def match(self, template_body, hosts):
+        return self.s.match(self.templates, env_template(template_body),
+                            self.collector, env_data(hosts))
+
+    def test_role_template(self):
+        rs = self.s.match(self.templates, self.s.templates["sws"],
+                          self.collector, {"body" : {"processorcount" : "1"}})
+        self.assertEqual(rs['summary'], 'fail')
+        self.assertEqual(rs['body'], {"processorcount" : "1"})
+
+    def test_overlapping_patterns_all_matched(self):
+        # the host passes sws but fails generic, the env fails whichever
+        # of the two patterns is matched last
+        hosts = {"srwd66sws001" : {"memorysize_mb" : "64", "processorcount" : "4"}}
+        rs = self.match({".*" : "generic", "srwd66sws.*" : "sws"}, hosts)
+        self.assertEqual(rs['summary'], 'fail')
+        self.assertEqual(len(rs['body']["srwd66sws001"]), 1)
+
+    def test_overlapping_patterns_last_shown(self):
+        hosts = {"srwd66sws001" : {"memorysize_mb" : "640", "processorcount" : "4"},
+                 "srwd66api001" : {"memorysize_mb" : "640", "processorcount" : "1"}}
+        body = {".*" : "generic", "srwd66sws.*" : "sws"}
+        rs = self.match(body, hosts)
+        self.assertEqual(rs['summary'], 'success')
+        last = [ key for key in body if key in (".*", "srwd66sws.*") ][-1]
+        self.assertEqual(rs['template']["srwd66sws001"], self.s.templates[ body[last] ])
+        self.assertEqual(rs['template']["srwd66api001"], self.s.templates["generic"])
+
+    def test_unmatched_roles_left_out(self):
+        hosts = {"srwd66sws001" : {"memorysize_mb" : "640", "processorcount" : "4"},
+                 "srwd66abc001" : {"memorysize_mb" : "6", "processorcount" : "0"}}
+        rs = self.match({"srwd66sws\\d+" : "sws", "(?i)SRWD66API.*" : "generic"}, hosts)
+        self.assertEqual(rs['summary'], 'success')
+        self.assertEqual(rs['body'].keys(), ["srwd66sws001"])
+
+
+if __name__ == "__main__":
+    unittest.main()